@@ -0,0 +1,189 @@
+import argparse
+import copy
+import json
+import logging
+import os
+import threading
+import time
+from concurrent.futures import ThreadPoolExecutor, Future, wait, FIRST_COMPLETED
+from typing import Dict, List, Set
+
+from app.lib import grab
+from app.models import InternalWebhookContent, InternalWebhookField
+from app.settings import BackfillConfig, get_settings
+from formbricks.client import FormbricksClient
+from formbricks.handler import normalize_response
+from formbricks.models import FormbricksWebhookData
+from grist.client import GristClient
+from grist.handler import build_table, ensure_table, upsert_webhook_rows
+from grist.router import GristRouter
+
+logger = logging.getLogger(__name__)
+
+
+class BackfillCheckpoint:
+    """
+    keeps track of all Formbricks response IDs which have already been written to Grist.
+    Stored as JSON file, so an interrupted backfill can be resumed.
+    """
+
+    def __init__(self, checkpoint_dir: str, survey_id: str):
+        self.file_name = os.path.join(checkpoint_dir, f"backfill_{survey_id}.json")
+        self.done: Set[str] = set()
+        self._lock = threading.Lock()
+
+    def load(self):
+        if not os.path.exists(self.file_name):
+            return
+
+        with open(self.file_name) as f:
+            self.done = set(json.load(f).get("done") or list())
+
+        logger.info(f"resuming backfill from checkpoint with {len(self.done)} responses already written")
+
+    def add(self, response_ids: List[str]):
+        with self._lock:
+            self.done.update(response_ids)
+            self.save()
+
+    def save(self):
+        os.makedirs(os.path.dirname(self.file_name) or ".", exist_ok=True)
+
+        # write to a temp file first, so an interruption never leaves a broken checkpoint behind
+        with open(f"{self.file_name}.tmp", "w") as f:
+            json.dump({"done": sorted(self.done)}, f)
+        os.replace(f"{self.file_name}.tmp", self.file_name)
+
+    def reset(self):
+        self.done = set()
+        if os.path.exists(self.file_name):
+            os.remove(self.file_name)
+
+
+def run_backfill(survey_id: str, form_client: FormbricksClient, grist: GristClient,
+                 settings: BackfillConfig, restart: bool = False, table_name: str = None) -> Dict:
+    """
+    replay all finished Formbricks responses of a survey into Grist.
+
+    The survey is only fetched once, responses are written in batches of 'batch_size'
+    with at most 'concurrency' parallel Grist requests. Schema changes are applied
+    sequentially before a batch is handed to the writers.
+    """
+
+    start_time = time.monotonic()
+
+    checkpoint = BackfillCheckpoint(settings.checkpoint_dir, survey_id)
+    if restart is True:
+        checkpoint.reset()
+    checkpoint.load()
+
+    survey_data = form_client.get_survey(survey_id)
+    if survey_data is None or survey_data.get("data") is None:
+        raise RuntimeError(f"unable to get survey with ID: {survey_id}")
+
+    survey_name = table_name or grab(survey_data, "data.name", fallback="Registrations")
+
+    # pygrister keeps the last request/response per instance, use one client per thread
+    thread_data = threading.local()
+
+    def write_batch(batch: List[InternalWebhookContent], table_id: str) -> List[str]:
+        if getattr(thread_data, "grist", None) is None:
+            thread_data.grist = copy.deepcopy(grist)
+
+        upsert_webhook_rows(batch, thread_data.grist, table_id)
+        response_ids = [x.webhook_id for x in batch]
+        checkpoint.add(response_ids)
+        return response_ids
+
+    stats = {
+        "survey_id": survey_id,
+        "responses": 0,
+        "written": 0,
+        "skipped": 0
+    }
+
+    pending: Set[Future] = set()
+    batch: List[InternalWebhookContent] = list()
+
+    def collect(futures: Set[Future]):
+        for future in futures:
+            stats["written"] += len(future.result())
+
+    def flush(executor: ThreadPoolExecutor):
+        nonlocal batch, pending
+
+        if len(batch) == 0:
+            return
+
+        # union of all fields in this batch, not every response answers every question
+        fields: Dict[str, InternalWebhookField] = dict()
+        for schema in {id(x.schema): x.schema for x in batch}.values():
+            for field in schema.fields:
+                fields.setdefault(field.id, field)
+
+        # schema changes are only applied here, writers just upsert
+        table_id = ensure_table(grist, build_table(survey_name, list(fields.values())))
+
+        # bound the number of requests in flight
+        while len(pending) >= settings.concurrency:
+            done, pending = wait(pending, return_when=FIRST_COMPLETED)
+            collect(done)
+
+        pending.add(executor.submit(write_batch, batch, table_id))
+        batch = list()
+
+    with ThreadPoolExecutor(max_workers=settings.concurrency) as executor:
+
+        for response in form_client.iter_responses(survey_id):
+            stats["responses"] += 1
+
+            response_data = FormbricksWebhookData(**response)
+            if response_data.finished is not True or response_data.id in checkpoint.done:
+                stats["skipped"] += 1
+                continue
+
+            batch.append(normalize_response(response_data, survey_data))
+
+            if len(batch) >= settings.batch_size:
+                flush(executor)
+                logger.info(f"backfill of survey {survey_id}: {stats['written']} responses written")
+
+        flush(executor)
+
+        done, pending = wait(pending)
+        collect(done)
+
+    stats["seconds"] = round(time.monotonic() - start_time, 3)
+
+    logger.info(f"backfill of survey {survey_id} finished: {stats}")
+
+    return stats
+
+
+if __name__ == "__main__":
+
+    parser = argparse.ArgumentParser(description="replay all Formbricks responses of a survey into Grist")
+    parser.add_argument("survey_id", help="Formbricks survey ID")
+    parser.add_argument("--batch-size", type=int, help="number of responses per Grist request")
+    parser.add_argument("--concurrency", type=int, help="number of concurrent Grist requests")
+    parser.add_argument("--restart", action="store_true", help="ignore existing checkpoint and start over")
+    args = parser.parse_args()
+
+    settings = get_settings()
+
+    logging.basicConfig(level=settings.logging.level, format=settings.logging.format)
+
+    backfill_settings = settings.backfill.model_copy(update={
+        k: v for k, v in {"batch_size": args.batch_size, "concurrency": args.concurrency}.items() if v is not None
+    })
+
+    router = GristRouter(settings.grist)
+    target = router.target(args.survey_id)
+
+    form_client = FormbricksClient(settings.formbricks)
+    form_client.validate()
+
+    result = run_backfill(args.survey_id, form_client, router.client(target),
+                          backfill_settings, restart=args.restart, table_name=target.table_name)
+
+    print(json.dumps(result, indent=2))
@@ -0,0 +1,174 @@
+import asyncio
+import fcntl
+import json
+import logging
+import os
+import threading
+import time
+from functools import lru_cache
+from typing import Dict, Iterable, Optional
+
+from app.settings import get_settings
+
+logger = logging.getLogger(__name__)
+
+
+class BootstrapState:
+    """
+    resolved Grist document IDs and document schemas persisted to a local JSON file,
+    so restarted or newly spawned workers don't need to look them up again
+    """
+
+    def __init__(self, file_name: str):
+        self.file_name = file_name
+        self.lock = threading.Lock()
+        self.data = {"documents": dict(), "schemas": dict()}
+        # modification time of the state file when it was read last
+        self.read_mtime = None
+
+        self.merge(self.read())
+
+    def read(self) -> Dict:
+        try:
+            self.read_mtime = os.stat(self.file_name).st_mtime_ns
+            with open(self.file_name) as f:
+                return json.load(f)
+        except FileNotFoundError:
+            pass
+        except Exception as e:
+            logger.warning(f"ignoring unreadable bootstrap state file '{self.file_name}': {e}")
+
+        return dict()
+
+    def merge(self, data: Dict):
+        """merge state written by other processes, the newest schema per document wins"""
+
+        self.data["documents"].update(data.get("documents") or dict())
+
+        for document_id, schema in (data.get("schemas") or dict()).items():
+            own_schema = self.data["schemas"].get(document_id)
+            if own_schema is None or own_schema.get("saved_at", 0) < schema.get("saved_at", 0):
+                self.data["schemas"][document_id] = schema
+
+    def refresh(self) -> bool:
+        """
+        merge the state file if it changed since it was read last, a single stat call otherwise
+
+        Returns
+        -------
+        bool
+            True if the state file was read
+        """
+
+        try:
+            mtime = os.stat(self.file_name).st_mtime_ns
+        except FileNotFoundError:
+            return False
+
+        if mtime == self.read_mtime:
+            return False
+
+        with self.lock:
+            self.merge(self.read())
+
+        return True
+
+    def save(self, forget_documents: Iterable[str] = ()):
+        os.makedirs(os.path.dirname(self.file_name) or ".", exist_ok=True)
+
+        # pool workers write the same file, no other process may save between reading and replacing it
+        with self.lock, open(f"{self.file_name}.lock", "w") as lock_file:
+            fcntl.flock(lock_file, fcntl.LOCK_EX)
+
+            stored = self.read()
+            stored_documents = {k: v for k, v in (stored.get("documents") or dict()).items()
+                                if k not in forget_documents}
+            # document IDs of this process are the most recent ones
+            self.data["documents"] = {**stored_documents, **self.data["documents"]}
+            self.merge({"schemas": stored.get("schemas")})
+
+            temp_file_name = f"{self.file_name}.{os.getpid()}.tmp"
+            with open(temp_file_name, "w") as f:
+                json.dump(self.data, f)
+            os.replace(temp_file_name, self.file_name)
+
+    @staticmethod
+    def document_key(host_name: str, team_name: str, document_name: str) -> str:
+        return f"{host_name}|{team_name}|{document_name}"
+
+    def get_document_id(self, key: str) -> Optional[str]:
+        return self.data["documents"].get(key)
+
+    def set_document_id(self, key: str, document_id: str):
+        if self.data["documents"].get(key) == document_id:
+            return
+
+        self.data["documents"][key] = document_id
+        self.save()
+
+    def forget_document_id(self, key: str):
+        self.data["documents"].pop(key, None)
+        self.save(forget_documents=[key])
+
+    def get_schema(self, document_id: str, max_age: float) -> Optional[Dict]:
+        """returns the stored schema of a document if its table list isn't older than 'max_age' seconds"""
+
+        schema = self.data["schemas"].get(document_id)
+        if schema is None or time.time() - schema.get("loaded_at", 0) > max_age:
+            return None
+
+        return schema
+
+    def schema_saved_at(self, document_id: str) -> float:
+        return (self.data["schemas"].get(document_id) or dict()).get("saved_at", 0)
+
+    def set_schema(self, document_id: str, tables: Dict, aliases: Dict, loaded_at: float) -> float:
+        """store the schema of a document, returns the time it was saved at"""
+
+        saved_at = time.time()
+        self.data["schemas"][document_id] = {
+            "tables": tables,
+            "aliases": aliases,
+            "loaded_at": loaded_at,
+            "saved_at": saved_at
+        }
+        self.save()
+
+        return saved_at
+
+
+@lru_cache()
+def get_bootstrap_state() -> BootstrapState:
+    return BootstrapState(get_settings().bootstrap.state_file)
+
+
+async def validate_upstreams(form_client, router) -> Dict[str, str]:
+    """
+    check the Formbricks credentials and resolve the document IDs of all Grist targets
+    in parallel. Failures are logged, webhooks are still accepted and retried by the pipeline.
+
+    Returns
+    -------
+    dict
+        upstream -> "ok" or error message
+    """
+
+    loop = asyncio.get_running_loop()
+
+    checks = {"formbricks": loop.run_in_executor(None, form_client.validate)}
+
+    targets = [router.default_target()] + [router.target(x) for x in router.settings.routes.keys()]
+    for target in {x.key(): x for x in targets}.values():
+        checks[f"grist:{target.team_name}/{target.document_name}"] = loop.run_in_executor(None, router.client, target)
+
+    results = dict()
+    for name, result in zip(checks.keys(), await asyncio.gather(*checks.values(), return_exceptions=True)):
+        if isinstance(result, Exception):
+            logger.error(f"failed to connect to {name}: {result}")
+            results[name] = str(result)
+        else:
+            results[name] = "ok"
+
+    logger.info(f"upstream validation finished: {results}")
+
+    return results
@@ -0,0 +1,232 @@
+import abc
+import contextlib
+import importlib
+import logging
+import os
+import socket
+import sqlite3
+import threading
+import time
+import uuid
+from typing import Iterator, List, Optional, Tuple
+
+from app.limits import TokenBucket
+from app.settings import CoordinationConfig, get_settings
+
+logger = logging.getLogger(__name__)
+
+_instance_id = uuid.uuid4().hex[:8]
+
+
+def get_owner_id() -> str:
+    """identifies this process as lease and queue item owner, forked pool workers get their own ID"""
+    return f"{socket.gethostname()}:{os.getpid()}:{_instance_id}"
+
+
+class Coordinator(abc.ABC):
+    """
+    shared state between uvicorn workers and nodes: a work queue, named leases and token
+    buckets. Network backends implement this interface and are configured with
+    COORDINATION__BACKEND=module.ClassName and COORDINATION__URL, backends missing a
+    method can't be instantiated.
+    """
+
+    def __init__(self, settings: CoordinationConfig):
+        self.settings = settings
+
+    # ---------------------------
+    # Queue
+    # ---------------------------
+    @abc.abstractmethod
+    def enqueue(self, queue_name: str, payload: str):
+        raise NotImplementedError
+
+    @abc.abstractmethod
+    def claim(self, queue_name: str, owner: str) -> Optional[Tuple[int, str]]:
+        """hand out the oldest visible item, it becomes visible again after the visibility timeout"""
+        raise NotImplementedError
+
+    @abc.abstractmethod
+    def extend_claims(self, item_ids: List[int], owner: str):
+        """keep items claimed by 'owner' invisible for another visibility timeout"""
+        raise NotImplementedError
+
+    @abc.abstractmethod
+    def ack(self, item_id: int):
+        raise NotImplementedError
+
+    @abc.abstractmethod
+    def queue_size(self, queue_name: str) -> int:
+        raise NotImplementedError
+
+    # ---------------------------
+    # Leases
+    # ---------------------------
+    @abc.abstractmethod
+    def acquire_lease(self, name: str, owner: str, ttl: float) -> bool:
+        raise NotImplementedError
+
+    @abc.abstractmethod
+    def release_lease(self, name: str, owner: str):
+        raise NotImplementedError
+
+    # ---------------------------
+    # Rate limits
+    # ---------------------------
+    @abc.abstractmethod
+    def take_token(self, name: str, rate: float, burst: float, reserve: float = 0.0) -> float:
+        """take a token of a shared bucket, see TokenBucket.take"""
+        raise NotImplementedError
+
+    @abc.abstractmethod
+    def block_tokens(self, name: str, until: float):
+        """hand out no tokens of a shared bucket before 'until' (epoch seconds)"""
+        raise NotImplementedError
+
+    @contextlib.contextmanager
+    def lease(self, name: str, timeout: float = None) -> Iterator[None]:
+        """block until the lease is acquired, raises TimeoutError after 'timeout' seconds"""
+
+        timeout = timeout if timeout is not None else self.settings.lease_seconds * 2
+        deadline = time.monotonic() + timeout
+        owner_id = get_owner_id()
+        while not self.acquire_lease(name, owner_id, self.settings.lease_seconds):
+            if time.monotonic() > deadline:
+                raise TimeoutError(f"unable to acquire lease '{name}' within {timeout} seconds")
+            time.sleep(0.05)
+
+        try:
+            yield
+        finally:
+            self.release_lease(name, owner_id)
+
+
+class SQLiteCoordinator(Coordinator):
+    """coordinator for all workers on one node sharing a sqlite database file"""
+
+    def __init__(self, settings: CoordinationConfig):
+        super().__init__(settings)
+        self._local = threading.local()
+
+        os.makedirs(os.path.dirname(settings.sqlite_path) or ".", exist_ok=True)
+        self._execute("PRAGMA journal_mode=WAL")
+        self._execute("CREATE TABLE IF NOT EXISTS queue (id INTEGER PRIMARY KEY AUTOINCREMENT, name TEXT, "
+                      "payload TEXT, visible_at REAL, owner TEXT, attempts INTEGER DEFAULT 0)")
+        self._execute("CREATE INDEX IF NOT EXISTS queue_visible ON queue (name, visible_at, id)")
+        self._execute("CREATE TABLE IF NOT EXISTS leases (name TEXT PRIMARY KEY, owner TEXT, expires_at REAL)")
+        self._execute("CREATE TABLE IF NOT EXISTS buckets (name TEXT PRIMARY KEY, tokens REAL, updated_at REAL, "
+                      "blocked_until REAL)")
+
+    def _connection(self) -> sqlite3.Connection:
+        # sqlite connections can't be shared between threads or forked processes
+        connection = getattr(self._local, "connection", None)
+        if connection is None or getattr(self._local, "pid", None) != os.getpid():
+            connection = sqlite3.connect(self.settings.sqlite_path, timeout=10, isolation_level=None)
+            connection.execute("PRAGMA synchronous=NORMAL")
+            self._local.connection = connection
+            self._local.pid = os.getpid()
+        return connection
+
+    def _execute(self, sql: str, parameters: Tuple = ()) -> sqlite3.Cursor:
+        return self._connection().execute(sql, parameters)
+
+    def enqueue(self, queue_name: str, payload: str):
+        self._execute("INSERT INTO queue (name, payload, visible_at) VALUES (?, ?, ?)",
+                      (queue_name, payload, time.time()))
+
+    def claim(self, queue_name: str, owner: str) -> Optional[Tuple[int, str]]:
+        now = time.time()
+        return self._execute(
+            "UPDATE queue SET visible_at = ?, owner = ?, attempts = attempts + 1 WHERE id = "
+            "(SELECT id FROM queue WHERE name = ? AND visible_at <= ? ORDER BY id LIMIT 1) RETURNING id, payload",
+            (now + self.settings.visibility_timeout_seconds, owner, queue_name, now)
+        ).fetchone()
+
+    def extend_claims(self, item_ids: List[int], owner: str):
+        if len(item_ids) == 0:
+            return
+        self._execute(f"UPDATE queue SET visible_at = ? WHERE owner = ? AND id IN ({', '.join('?' * len(item_ids))})",
+                      (time.time() + self.settings.visibility_timeout_seconds, owner, *item_ids))
+
+    def ack(self, item_id: int):
+        self._execute("DELETE FROM queue WHERE id = ?", (item_id,))
+
+    def queue_size(self, queue_name: str) -> int:
+        return self._execute("SELECT COUNT(*) FROM queue WHERE name = ?", (queue_name,)).fetchone()[0]
+
+    def acquire_lease(self, name: str, owner: str, ttl: float) -> bool:
+        now = time.time()
+        cursor = self._execute(
+            "INSERT INTO leases (name, owner, expires_at) VALUES (?, ?, ?) ON CONFLICT (name) DO UPDATE "
+            "SET owner = excluded.owner, expires_at = excluded.expires_at "
+            "WHERE leases.expires_at < ? OR leases.owner = excluded.owner",
+            (name, owner, now + ttl, now)
+        )
+        return cursor.rowcount == 1
+
+    def release_lease(self, name: str, owner: str):
+        self._execute("DELETE FROM leases WHERE name = ? AND owner = ?", (name, owner))
+
+    @contextlib.contextmanager
+    def _bucket(self, name: str, burst: float) -> Iterator[TokenBucket]:
+        """bucket read and written back in one write transaction"""
+
+        connection = self._connection()
+        connection.execute("BEGIN IMMEDIATE")
+        try:
+            row = connection.execute("SELECT tokens, updated_at, blocked_until FROM buckets WHERE name = ?",
+                                     (name,)).fetchone()
+            bucket = TokenBucket(*row) if row is not None else TokenBucket(float(burst), time.time())
+
+            yield bucket
+
+            connection.execute("INSERT OR REPLACE INTO buckets (name, tokens, updated_at, blocked_until) "
+                               "VALUES (?, ?, ?, ?)", (name, bucket.tokens, bucket.updated_at, bucket.blocked_until))
+            connection.execute("COMMIT")
+        except BaseException:
+            connection.execute("ROLLBACK")
+            raise
+
+    def take_token(self, name: str, rate: float, burst: float, reserve: float = 0.0) -> float:
+        with self._bucket(name, burst) as bucket:
+            return bucket.take(time.time(), rate, burst, reserve)
+
+    def block_tokens(self, name: str, until: float):
+        with self._bucket(name, 0) as bucket:
+            bucket.block(until)
+
+
+_coordinator: Optional[Coordinator] = None
+_coordinator_lock = threading.Lock()
+
+
+def get_coordinator() -> Optional[Coordinator]:
+    """returns the configured coordinator of this process, None if coordination is disabled"""
+    global _coordinator
+
+    settings = get_settings().coordination
+    if settings.backend is None or len(settings.backend) == 0:
+        return None
+
+    with _coordinator_lock:
+        if _coordinator is None:
+            if settings.backend == "sqlite":
+                backend_class = SQLiteCoordinator
+            else:
+                module_name, class_name = settings.backend.rsplit(".", 1)
+                backend_class = getattr(importlib.import_module(module_name), class_name)
+
+            logger.info(f"using coordination backend '{settings.backend}'")
+            _coordinator = backend_class(settings)
+
+    return _coordinator
+
+
+def lease(name: str) -> contextlib.AbstractContextManager:
+    """lease context of the configured coordinator, does nothing if coordination is disabled"""
+
+    coordinator = get_coordinator()
+    if coordinator is None:
+        return contextlib.nullcontext()
+
+    return coordinator.lease(name)
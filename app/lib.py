@@ -1,7 +1,5 @@
 import functools
 import time
-from html.parser import HTMLParser
-from io import StringIO
 
 
 def grab(structure=None, path=None, separator=".", fallback=None):
@@ -85,25 +83,13 @@ def grab(structure=None, path=None, separator=".", fallback=None):
     return traverse(structure, path)
 
 
-class MLStripper(HTMLParser):
-    def __init__(self):
-        super().__init__()
-        self.reset()
-        self.strict = False
-        self.convert_charrefs = True
-        self.text = StringIO()
+def build_base_url(host_name: str) -> str:
+    """returns an https url for a host name, host names which already contain a scheme are kept"""
 
-    def handle_data(self, d):
-        self.text.write(d)
+    if host_name.startswith("http://") or host_name.startswith("https://"):
+        return host_name.rstrip("/")
 
-    def get_data(self):
-        return self.text.getvalue()
-
-
-def strip_tags(html):
-    s = MLStripper()
-    s.feed(html)
-    return s.get_data()
+    return f"https://{host_name}"
 
 
 def time_cache(max_age, maxsize=128, typed=False):
@@ -124,6 +110,9 @@ def time_cache(max_age, maxsize=128, typed=False):
         def _wrapped(*args, **kwargs):
             return _new(*args, **kwargs, __time_salt=int(time.time() / max_age))
 
+        _wrapped.cache_info = _new.cache_info
+        _wrapped.cache_clear = _new.cache_clear
+
         return _wrapped
 
     return _decorator
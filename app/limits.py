@@ -0,0 +1,189 @@
+import asyncio
+import logging
+import time
+
+from pydantic import BaseModel, Field
+
+logger = logging.getLogger(__name__)
+
+
+class LimitConfig(BaseModel):
+    """adaptive concurrency and circuit breaker settings of an upstream service"""
+
+    initial_concurrency: int = Field(
+        default=4,
+        description="number of items processed in parallel before any latency was observed",
+        ge=1
+    )
+    min_concurrency: int = Field(
+        default=1,
+        description="lower bound of the adaptive concurrency limit",
+        ge=1
+    )
+    max_concurrency: int = Field(
+        default=32,
+        description="upper bound of the adaptive concurrency limit",
+        ge=1
+    )
+    latency_target_seconds: float = Field(
+        default=2.0,
+        description="requests slower than this reduce the concurrency limit",
+        gt=0
+    )
+    decrease_factor: float = Field(
+        default=0.7,
+        description="factor the concurrency limit is multiplied with on errors or slow requests",
+        gt=0,
+        lt=1
+    )
+    failure_threshold: int = Field(
+        default=5,
+        description="consecutive failed requests which open the circuit breaker",
+        ge=1
+    )
+    open_seconds: float = Field(
+        default=30,
+        description="time the circuit breaker stays open before a single trial request is let through",
+        gt=0
+    )
+
+
+class AdaptiveLimiter:
+    """
+    AIMD concurrency limit combined with a circuit breaker for one upstream service.
+
+    The limit grows by one after a full window of fast successful requests and shrinks
+    by 'decrease_factor' on errors or requests slower than the latency target. After
+    'failure_threshold' consecutive errors the breaker opens and no new items are started
+    for 'open_seconds', queued items wait instead of piling up in the retry path. Then
+    a single item is let through, its outcome closes or opens the breaker again.
+
+    Used from the event loop only, so no locking is needed.
+    """
+
+    closed = "closed"
+    open = "open"
+    half_open = "half_open"
+
+    def __init__(self, name: str, settings: LimitConfig):
+        self.name = name
+        self.settings = settings
+        self.limit = float(min(max(settings.initial_concurrency, settings.min_concurrency), settings.max_concurrency))
+        self.in_flight = 0
+        self.state = self.closed
+        self.consecutive_failures = 0
+        self.opened_until = 0.0
+        self.last_decrease = 0.0
+        self._changed = asyncio.Event()
+
+    def _notify(self):
+        self._changed.set()
+        self._changed = asyncio.Event()
+
+    def _can_start(self) -> bool:
+        if self.state == self.open and time.monotonic() >= self.opened_until:
+            logger.info(f"circuit breaker of {self.name} is half open, sending a trial request")
+            self.state = self.half_open
+
+        if self.state == self.open:
+            return False
+        if self.state == self.half_open:
+            return self.in_flight == 0
+
+        return self.in_flight < int(self.limit)
+
+    async def acquire(self):
+        while not self._can_start():
+            changed = self._changed
+            timeout = max(self.opened_until - time.monotonic(), 0.05) if self.state == self.open else None
+            try:
+                await asyncio.wait_for(changed.wait(), timeout)
+            except asyncio.TimeoutError:
+                pass
+
+        self.in_flight += 1
+
+    def release(self):
+        self.in_flight -= 1
+        self._notify()
+
+    def observe(self, duration: float, error: bool):
+        """feed the outcome of a single upstream request"""
+
+        if error:
+            self.consecutive_failures += 1
+            self._decrease()
+
+            if self.state == self.half_open or self.consecutive_failures >= self.settings.failure_threshold:
+                if self.state != self.open:
+                    logger.warning(f"opening circuit breaker of {self.name} for {self.settings.open_seconds} seconds "
+                                   f"after {self.consecutive_failures} failed requests")
+                self.state = self.open
+                self.opened_until = time.monotonic() + self.settings.open_seconds
+        else:
+            self.consecutive_failures = 0
+
+            if self.state == self.half_open:
+                logger.info(f"closing circuit breaker of {self.name}")
+                self.state = self.closed
+
+            if duration > self.settings.latency_target_seconds:
+                self._decrease()
+            else:
+                self.limit = min(self.limit + 1 / self.limit, float(self.settings.max_concurrency))
+
+        self._notify()
+
+    def _decrease(self):
+        # a burst of slow responses from the same window only counts once
+        now = time.monotonic()
+        if now - self.last_decrease < self.settings.latency_target_seconds:
+            return
+
+        self.last_decrease = now
+        self.limit = max(self.limit * self.settings.decrease_factor, float(self.settings.min_concurrency))
+
+
+class TokenBucket:
+    """
+    request budget refilled with 'rate' tokens per second up to 'burst' tokens.
+
+    Callers of lower priority pass a 'reserve', they only get a token while more than
+    'reserve' tokens are left, so the remaining budget goes to callers without reserve.
+    """
+
+    __slots__ = ("tokens", "updated_at", "blocked_until")
+
+    def __init__(self, tokens: float, updated_at: float, blocked_until: float = 0.0):
+        self.tokens = tokens
+        self.updated_at = updated_at
+        self.blocked_until = blocked_until
+
+    def take(self, now: float, rate: float, burst: float, reserve: float = 0.0) -> float:
+        """
+        take a token
+
+        Returns
+        -------
+        float
+            0 if a token was taken, otherwise the seconds to wait before trying again
+        """
+
+        if now < self.blocked_until:
+            return self.blocked_until - now
+
+        self.tokens = min(float(burst), self.tokens + max(now - self.updated_at, 0.0) * rate)
+        self.updated_at = now
+
+        if self.tokens - 1 >= reserve:
+            self.tokens -= 1
+            return 0.0
+
+        return (reserve + 1 - self.tokens) / rate
+
+    def block(self, until: float):
+        """no tokens are handed out before 'until', e.g. after the upstream answered with 429"""
+        self.blocked_until = max(self.blocked_until, until)
+        self.tokens = 0.0
+        # refill from the end of the block, not with the tokens of the blocked time
+        self.updated_at = max(self.updated_at, self.blocked_until)
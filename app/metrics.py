@@ -0,0 +1,225 @@
+"""
+minimal metrics registry which renders the Prometheus text exposition format.
+
+Upstream calls done inside ProcessPoolExecutor workers can't update the registry
+of the API process directly. Functions submitted to the pool are wrapped with
+'run_instrumented', which collects the observations made in the worker and hands
+them back to the API process together with the result.
+"""
+import bisect
+import functools
+import threading
+import time
+from contextlib import contextmanager
+from typing import Callable, Dict, List, Tuple
+
+
+default_buckets = (0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1.0, 2.5, 5.0, 10.0, 30.0)
+
+
+def _escape(value) -> str:
+    return str(value).replace("\\", "\\\\").replace('"', '\\"').replace("\n", "\\n")
+
+
+def _format_labels(label_names: Tuple[str, ...], label_values: Tuple[str, ...], extra: str = "") -> str:
+    labels = [f'{k}="{_escape(v)}"' for k, v in zip(label_names, label_values)]
+    if extra:
+        labels.append(extra)
+    return "{" + ",".join(labels) + "}" if labels else ""
+
+
+class Metric:
+    type = ""
+
+    def __init__(self, name: str, description: str, label_names: Tuple[str, ...] = ()):
+        self.name = name
+        self.description = description
+        self.label_names = label_names
+        self._lock = threading.Lock()
+
+    def render(self) -> List[str]:
+        return [f"# HELP {self.name} {self.description}", f"# TYPE {self.name} {self.type}"] + self.samples()
+
+    def samples(self) -> List[str]:
+        return list()
+
+
+class Counter(Metric):
+    type = "counter"
+
+    def __init__(self, name: str, description: str, label_names: Tuple[str, ...] = ()):
+        super().__init__(name, description, label_names)
+        self.values: Dict[Tuple[str, ...], float] = dict()
+
+    def inc(self, *label_values: str, amount: float = 1):
+        with self._lock:
+            self.values[label_values] = self.values.get(label_values, 0) + amount
+
+    def samples(self) -> List[str]:
+        return [f"{self.name}{_format_labels(self.label_names, k)} {v}" for k, v in list(self.values.items())]
+
+
+class Gauge(Metric):
+    """gauge which reads its values with a callback at scrape time"""
+    type = "gauge"
+
+    def __init__(self, name: str, description: str, label_names: Tuple[str, ...] = (),
+                 callback: Callable[[], Dict[Tuple[str, ...], float]] = None):
+        super().__init__(name, description, label_names)
+        self.callback = callback
+
+    def samples(self) -> List[str]:
+        if self.callback is None:
+            return list()
+        return [f"{self.name}{_format_labels(self.label_names, k)} {v}" for k, v in self.callback().items()]
+
+
+class Histogram(Metric):
+    type = "histogram"
+
+    def __init__(self, name: str, description: str, label_names: Tuple[str, ...] = (),
+                 buckets: Tuple[float, ...] = default_buckets):
+        super().__init__(name, description, label_names)
+        self.buckets = buckets
+        # label values -> [bucket counts..., sum, count]
+        self.values: Dict[Tuple[str, ...], List[float]] = dict()
+
+    def observe(self, value: float, *label_values: str):
+        index = bisect.bisect_left(self.buckets, value)
+        with self._lock:
+            data = self.values.get(label_values)
+            if data is None:
+                data = self.values[label_values] = [0] * (len(self.buckets) + 2)
+            if index < len(self.buckets):
+                data[index] += 1
+            data[-2] += value
+            data[-1] += 1
+
+    def samples(self) -> List[str]:
+        lines = list()
+        for label_values, data in list(self.values.items()):
+            cumulative = 0
+            for bucket, count in zip(self.buckets, data):
+                cumulative += count
+                bucket_labels = _format_labels(self.label_names, label_values, f'le="{bucket}"')
+                lines.append(f"{self.name}_bucket{bucket_labels} {cumulative}")
+            bucket_labels = _format_labels(self.label_names, label_values, 'le="+Inf"')
+            lines.append(f"{self.name}_bucket{bucket_labels} {data[-1]}")
+            lines.append(f"{self.name}_sum{_format_labels(self.label_names, label_values)} {data[-2]}")
+            lines.append(f"{self.name}_count{_format_labels(self.label_names, label_values)} {data[-1]}")
+        return lines
+
+
+class Registry:
+
+    def __init__(self):
+        self.metrics: Dict[str, Metric] = dict()
+
+    def register(self, metric: Metric) -> Metric:
+        self.metrics[metric.name] = metric
+        return metric
+
+    def render(self) -> str:
+        lines = list()
+        for metric in self.metrics.values():
+            lines.extend(metric.render())
+        return "\n".join(lines) + "\n"
+
+
+registry = Registry()
+
+stage_duration = registry.register(Histogram(
+    "pipeline_stage_duration_seconds", "duration of a pipeline stage per item", ("stage",)))
+stage_items = registry.register(Counter(
+    "pipeline_items_total", "items processed per pipeline stage", ("stage", "result")))
+upstream_duration = registry.register(Histogram(
+    "upstream_request_duration_seconds", "duration of requests to upstream services", ("upstream", "operation")))
+upstream_errors = registry.register(Counter(
+    "upstream_errors_total", "failed requests to upstream services", ("upstream", "operation")))
+queue_depth = registry.register(Gauge(
+    "pipeline_queue_depth", "items waiting per pipeline stage", ("stage",)))
+upstream_concurrency_limit = registry.register(Gauge(
+    "upstream_concurrency_limit", "adaptive concurrency limit per upstream service", ("upstream",)))
+upstream_in_flight = registry.register(Gauge(
+    "upstream_in_flight", "items processed in parallel per upstream service", ("upstream",)))
+upstream_circuit_open = registry.register(Gauge(
+    "upstream_circuit_open", "1 if the circuit breaker of an upstream service is open or half open", ("upstream",)))
+public_list_cache = registry.register(Gauge(
+    "public_list_cache_requests", "public list cache lookups by result", ("result",)))
+public_list_cache_ratio = registry.register(Gauge(
+    "public_list_cache_hit_ratio", "ratio of public list requests served from cache"))
+
+
+# ========================
+# Upstream instrumentation
+# ========================
+
+# upstream, operation, start time (epoch ns), duration (seconds), error
+Observation = Tuple[str, str, int, float, bool]
+
+_collecting = False
+_observations: List[Observation] = list()
+
+
+def record_upstream(upstream: str, operation: str, start_ns: int, duration: float, error: bool):
+    if _collecting is True:
+        _observations.append((upstream, operation, start_ns, duration, error))
+        return
+
+    upstream_duration.observe(duration, upstream, operation)
+    if error is True:
+        upstream_errors.inc(upstream, operation)
+
+
+def merge_observations(observations: List[Observation]):
+    for upstream, operation, _, duration, error in observations or list():
+        upstream_duration.observe(duration, upstream, operation)
+        if error is True:
+            upstream_errors.inc(upstream, operation)
+
+
+@contextmanager
+def measure_upstream(upstream: str, operation: str):
+    start_ns = time.time_ns()
+    start_time = time.perf_counter()
+    error = True
+    try:
+        yield
+        error = False
+    finally:
+        record_upstream(upstream, operation, start_ns, time.perf_counter() - start_time, error)
+
+
+def upstream_call(upstream: str):
+    """decorator to measure every call of a client method as upstream request named like the method"""
+
+    def _decorator(fn):
+        @functools.wraps(fn)
+        def _wrapped(*args, **kwargs):
+            with measure_upstream(upstream, fn.__name__):
+                return fn(*args, **kwargs)
+
+        return _wrapped
+
+    return _decorator
+
+
+def run_instrumented(fn: Callable, *args):
+    """
+    runs inside a pool worker and returns the result together with all upstream
+    observations made while running 'fn'. On failure the observations are attached
+    to the exception.
+    """
+    global _collecting
+
+    _collecting = True
+    _observations.clear()
+    try:
+        result = fn(*args)
+    except Exception as e:
+        e.upstream_observations = list(_observations)
+        raise
+    finally:
+        _collecting = False
+
+    return result, list(_observations)
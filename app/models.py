@@ -1,17 +1,24 @@
 from __future__ import annotations
 
 from datetime import datetime
-from typing import Any, Optional, List, Union
+from typing import Any, Dict, Iterable, NamedTuple, Optional, List, Tuple, Union
 
-from pydantic import BaseModel
+from pydantic import BaseModel, ConfigDict
 
+from app.tracing import ItemTrace
 from formbricks.models import FormbricksWebhook
+from grist.models import GristTarget
 
 
 class QueueItem(BaseModel):
     """contains a queue item"""
+    model_config = ConfigDict(arbitrary_types_allowed=True)
+
     data: Any
     retries: Optional[int] = 0
+    trace: Optional[ItemTrace] = None
+    queued_ns: Optional[int] = None
+    claim_id: Optional[int] = None
 
 
 class QueueItemWebhookIncoming(QueueItem):
@@ -21,7 +28,9 @@ class QueueItemWebhookIncoming(QueueItem):
 
 class QueueItemWebhookNormalized(QueueItem):
     data: InternalWebhookContent
-    pass
+    target: Optional[GristTarget] = None
+    # False for responses still in progress, these are stored as partial rows only
+    finished: Optional[bool] = True
 
 
 class QueueItemWebhookStored(QueueItem):
@@ -29,7 +38,7 @@ class QueueItemWebhookStored(QueueItem):
     pass
 
 
-class InternalWebhookField(BaseModel):
+class InternalWebhookField(NamedTuple):
     id: Optional[str] = ""
     value: Optional[Any] = ""
     label: Optional[str] = ""
@@ -42,18 +51,105 @@ class InternalWebhookField(BaseModel):
             return str(self.value)
 
 
-class InternalWebhookContent(BaseModel):
-    webhook_id: Optional[str] = ""
-    survey_id: Optional[str] = ""
-    survey_name: Optional[str] = ""
-    data: Optional[List[InternalWebhookField]] = list()
+class InternalWebhookSchema:
+    """
+    id, label and type of all fields of a normalized response. Responses with the same
+    field layout share one instance, use 'get' instead of creating instances directly.
+    """
+
+    __slots__ = ("fields", "ids", "labels", "index_by_id", "index_by_label")
+
+    def __init__(self, fields: Tuple[Tuple[str, str, str], ...]):
+        self.fields = tuple(InternalWebhookField(id=x[0], label=x[1], type=x[2]) for x in fields)
+        self.ids = tuple(x.id for x in self.fields)
+        self.labels = tuple(x.label for x in self.fields)
+        self.index_by_id = {x: i for i, x in reversed(list(enumerate(self.ids)))}
+        self.index_by_label = {x: i for i, x in reversed(list(enumerate(self.labels)))}
+
+    @staticmethod
+    def get(fields: Tuple[Tuple[str, str, str], ...]) -> InternalWebhookSchema:
+        schema = _webhook_schemas.get(fields)
+        if schema is None:
+            if len(_webhook_schemas) >= 1000:
+                _webhook_schemas.clear()
+            schema = _webhook_schemas[fields] = InternalWebhookSchema(fields)
+        return schema
+
+    def key(self) -> Tuple[Tuple[str, str, str], ...]:
+        return tuple((x.id, x.label, x.type) for x in self.fields)
+
+    def __reduce__(self):
+        # unpickled in pool workers as the shared instance of that process
+        return InternalWebhookSchema.get, (self.key(),)
+
+    def __len__(self) -> int:
+        return len(self.fields)
+
+
+_webhook_schemas: Dict[Tuple[Tuple[str, str, str], ...], InternalWebhookSchema] = dict()
+
+
+class InternalWebhookContent:
+    """
+    a normalized response: the shared field schema of its survey and a tuple of values
+    in the order of the schema fields. Lookups by field id or label are dict based.
+    """
+
+    __slots__ = ("webhook_id", "survey_id", "survey_name", "schema", "values")
+
+    def __init__(self, webhook_id: Optional[str] = "", survey_id: Optional[str] = "", survey_name: Optional[str] = "",
+                 schema: InternalWebhookSchema = None, values: Tuple = ()):
+        self.webhook_id = webhook_id
+        self.survey_id = survey_id
+        self.survey_name = survey_name
+        self.schema = schema or InternalWebhookSchema.get(())
+        self.values = tuple(values)
+
+    @classmethod
+    def from_fields(cls, fields: Iterable[InternalWebhookField], **kwargs) -> InternalWebhookContent:
+        fields = list(fields)
+        return cls(schema=InternalWebhookSchema.get(tuple((x.id, x.label, x.type) for x in fields)),
+                   values=tuple(x.value for x in fields), **kwargs)
+
+    @property
+    def data(self) -> List[InternalWebhookField]:
+        return [x._replace(value=v) for x, v in zip(self.schema.fields, self.values)]
+
+    def get_value(self, field_id: str, default: Any = None) -> Any:
+        index = self.schema.index_by_id.get(field_id)
+        return self.values[index] if index is not None else default
 
     def get_item_by_id(self, needle: str) -> Union[InternalWebhookField | None]:
-        for item in self.data:
-            if item.id == needle:
-                return item
+        index = self.schema.index_by_id.get(needle)
+        if index is not None:
+            return self.schema.fields[index]._replace(value=self.values[index])
 
     def get_item_by_label(self, needle: str) -> Union[InternalWebhookField | None]:
-        for item in self.data:
-            if item.label == needle:
-                return item
+        index = self.schema.index_by_label.get(needle)
+        if index is not None:
+            return self.schema.fields[index]._replace(value=self.values[index])
+
+    def subset(self, field_ids: Iterable[str]) -> InternalWebhookContent:
+        """content with only the given fields, in schema order"""
+        field_ids = set(field_ids)
+        indexes = [i for i, x in enumerate(self.schema.ids) if x in field_ids]
+        return InternalWebhookContent(
+            webhook_id=self.webhook_id, survey_id=self.survey_id, survey_name=self.survey_name,
+            schema=InternalWebhookSchema.get(tuple(self.schema.key()[i] for i in indexes)),
+            values=tuple(self.values[i] for i in indexes))
+
+    def as_record(self) -> Dict[str, Any]:
+        """field id -> value, as sent to Grist"""
+        return dict(zip(self.schema.ids, self.values))
+
+    def __reduce__(self):
+        return InternalWebhookContent, (self.webhook_id, self.survey_id, self.survey_name, self.schema, self.values)
+
+    def __eq__(self, other) -> bool:
+        if not isinstance(other, InternalWebhookContent):
+            return NotImplemented
+        return self.__reduce__()[1] == other.__reduce__()[1]
+
+    def __repr__(self) -> str:
+        return f"InternalWebhookContent(webhook_id={self.webhook_id!r}, survey_id={self.survey_id!r}, " \
+               f"fields={len(self.schema)})"
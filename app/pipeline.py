@@ -0,0 +1,708 @@
+import asyncio
+import contextlib
+import functools
+import logging
+import os
+import time
+import uuid
+from collections import OrderedDict
+from concurrent.futures import ProcessPoolExecutor
+from typing import Awaitable, Callable, Dict, List, Optional, Set, Tuple
+
+from app import metrics, registrations
+from app.coordination import Coordinator, get_owner_id
+from app.limits import AdaptiveLimiter
+from app.models import InternalWebhookContent, QueueItem, QueueItemWebhookIncoming, QueueItemWebhookNormalized, \
+    QueueItemWebhookStored
+from app.registrations import RegistrationIndex
+from app.settings import get_settings
+from app.tracing import ItemTrace, Span, TraceExporter
+from formbricks.client import FormbricksClient
+from formbricks.handler import normalize_webhook_content
+from formbricks.models import FormbricksWebhook
+from grist.handler import paid_column_id, registration_id_column_id, upsert_webhook_row
+from grist.models import GristTarget
+from grist.router import GristRouter
+from notification.handler import send_email_for_record
+
+logger = logging.getLogger(__name__)
+
+max_retries = 3
+# claimed items in flight in any stage of this worker, everything beyond stays in the shared queue for other workers
+max_claimed = 32
+# responses for which the fields written to Grist are remembered to only write changed fields
+max_written_responses = 10000
+
+# Formbricks events of responses still in progress, their answers are written as partial rows
+update_events = ("responseCreated", "responseUpdated")
+
+# upstream service each stage depends on
+stage_upstreams = {
+    "normalize": "formbricks",
+    "store": "grist",
+    "notify": "smtp"
+}
+
+
+def process_exists(pid: str) -> bool:
+    try:
+        os.kill(int(pid), 0)
+    except (ValueError, ProcessLookupError):
+        return False
+    except PermissionError:
+        pass
+    return True
+
+
+class Pipeline:
+    """
+    processes received webhooks in three stages: normalize -> store -> notify
+
+    The store stage runs one worker per Grist target (team and document), so a slow
+    document doesn't block writing registrations to other documents.
+
+    Items of a stage are processed in parallel, bounded by an adaptive concurrency limit
+    and circuit breaker per upstream service, and per document for Grist, which is fed
+    with the upstream calls made by every item.
+
+    Stage queues are bounded by the queue high watermark. Once the intake reaches it,
+    received webhooks are rejected or spilled to disk until it drained to the low
+    watermark, so memory use stays bounded while an upstream is down.
+
+    Each item carries a trace with spans for the time waited in each queue, each stage
+    and every upstream call made while processing it.
+
+    With a coordinator, received webhooks are put into the shared queue and every worker
+    claims items from it as long as it has less than 'max_claimed' items in flight. Claims
+    are extended while the items are processed and acknowledged once they are finished,
+    items of a crashed worker are handed out again after the visibility timeout.
+
+    Responses in progress (responseCreated/responseUpdated) are written as partial rows.
+    Updates of the same response within 'update_coalesce_seconds' are combined into one
+    item and only fields which changed since the last write are sent, so the final
+    responseFinished only writes the remaining fields before the mail is sent. Updates
+    reuse the survey definition a pool worker requested within 'survey_cache_seconds'.
+
+    The stage and mail status of every response, and its registration ID once stored, are
+    written to the registration index if one is given.
+    """
+
+    def __init__(self, form_client: FormbricksClient, router: GristRouter, pool: ProcessPoolExecutor,
+                 exporter: TraceExporter, coordinator: Coordinator = None, index: RegistrationIndex = None):
+        self.form_client = form_client
+        self.router = router
+        self.pool = pool
+        self.exporter = exporter
+        self.coordinator = coordinator
+        self.index = index
+        self.claim_wakeup = asyncio.Event()
+        # claim IDs of shared queue items in flight in this worker
+        self.claimed: Set[int] = set()
+
+        settings = get_settings()
+        # Grist limiters are added per document, see 'limiter'
+        self.limiters: Dict[str, AdaptiveLimiter] = {
+            "formbricks": AdaptiveLimiter("formbricks", settings.formbricks.limits),
+            "smtp": AdaptiveLimiter("smtp", settings.mail.limits)
+        }
+        self.grist_limits = settings.grist.limits
+        # tables which were written to already, the first item of a new table is stored alone
+        # so parallel items don't try to create the same table
+        self.known_tables = set()
+        self.table_locks: Dict[Tuple, asyncio.Lock] = dict()
+
+        self.queue_settings = settings.queue
+        self.survey_cache_seconds = settings.formbricks.survey_cache_seconds
+        self.saturated = False
+        # every worker spills to and drains its own directory, so no webhook is replayed twice
+        self.spill_dir = os.path.join(self.queue_settings.spill_dir, f"worker-{os.getpid()}")
+        self.spilled = len(self.spilled_files())
+
+        # note that asyncio.Queue() is not thread safe
+        self.intake_queue = asyncio.Queue(maxsize=self.queue_settings.high_watermark)
+        self.notify_queue = asyncio.Queue(maxsize=self.queue_settings.high_watermark)
+        self.store_queues: Dict[Tuple[str, str], asyncio.Queue] = dict()
+        self.tasks: List[asyncio.Task] = list()
+        self.running: Set[asyncio.Task] = set()
+
+        # response ID -> update waiting for the coalescing window to end
+        self.pending_updates: Dict[str, Tuple[QueueItemWebhookIncoming, asyncio.TimerHandle]] = dict()
+        # response ID -> fields written to Grist, None once the response is finished
+        self.written: OrderedDict[str, Optional[Dict]] = OrderedDict()
+        # response ID -> lock and number of items using it, updates of a response are stored in order
+        self.response_locks: Dict[str, List] = dict()
+
+    def start(self):
+        metrics.queue_depth.callback = self.queue_depths
+        metrics.upstream_concurrency_limit.callback = \
+            lambda: {(k,): int(v.limit) for k, v in self.limiters.items()}
+        metrics.upstream_in_flight.callback = lambda: {(k,): v.in_flight for k, v in self.limiters.items()}
+        metrics.upstream_circuit_open.callback = \
+            lambda: {(k,): int(v.state != v.closed) for k, v in self.limiters.items()}
+
+        self.tasks.append(asyncio.create_task(
+            self.run_stage("normalize", self.intake_queue, self.normalize, self.limiter(stage_upstreams["normalize"]))))
+        self.tasks.append(asyncio.create_task(
+            self.run_stage("notify", self.notify_queue, self.notify, self.limiter(stage_upstreams["notify"]))))
+
+        if self.coordinator is not None:
+            self.tasks.append(asyncio.create_task(self.claim_shared()))
+            self.tasks.append(asyncio.create_task(self.extend_claims()))
+        else:
+            self.tasks.append(asyncio.create_task(self.drain_spilled()))
+
+    async def stop(self):
+        tasks = self.tasks + list(self.running)
+        for task in tasks:
+            task.cancel()
+        await asyncio.gather(*tasks, return_exceptions=True)
+
+    async def submit(self, item: QueueItemWebhookIncoming) -> bool:
+        """
+        accept a received webhook, goes through the shared queue if a coordinator is used
+
+        Returns
+        -------
+        bool
+            False if the intake is saturated and the webhook was rejected
+        """
+
+        loop = asyncio.get_running_loop()
+
+        if self.coordinator is not None:
+            depth = await loop.run_in_executor(None, self.intake_depth)
+        else:
+            depth = self.intake_depth()
+
+        if self.check_saturation(depth):
+            if self.queue_settings.overflow_policy == "reject":
+                return False
+
+            # the shared queue is stored on disk already
+            if self.coordinator is None:
+                await loop.run_in_executor(None, self.spill, item)
+                return True
+
+        if self.coordinator is None:
+            self.put(item)
+            return True
+
+        await loop.run_in_executor(None, self.coordinator.enqueue, "intake", item.data.model_dump_json())
+        self.claim_wakeup.set()
+
+        return True
+
+    def intake_depth(self) -> int:
+        if self.coordinator is not None:
+            return self.coordinator.queue_size("intake")
+        return self.intake_queue.qsize() + self.spilled + len(self.pending_updates)
+
+    def check_saturation(self, depth: int) -> bool:
+        """saturated from the high watermark until the intake drained to the low watermark"""
+
+        if self.saturated is False and depth >= self.queue_settings.high_watermark:
+            logger.warning(f"intake is saturated with {depth} items, applying '{self.queue_settings.overflow_policy}'")
+            self.saturated = True
+        elif self.saturated is True and depth <= self.queue_settings.low_watermark:
+            logger.info(f"intake drained to {depth} items, accepting webhooks again")
+            self.saturated = False
+
+        return self.saturated
+
+    @staticmethod
+    def list_spilled(directory: str) -> List[str]:
+        if not os.path.isdir(directory):
+            return list()
+        return sorted(x for x in os.listdir(directory) if x.endswith(".json"))
+
+    def spilled_files(self) -> List[str]:
+        return self.list_spilled(self.spill_dir)
+
+    def spill(self, item: QueueItemWebhookIncoming):
+
+        os.makedirs(self.spill_dir, exist_ok=True)
+
+        file_name = os.path.join(self.spill_dir, f"{time.time_ns()}_{uuid.uuid4().hex}.json")
+        with open(f"{file_name}.tmp", "w") as f:
+            f.write(item.data.model_dump_json())
+        os.replace(f"{file_name}.tmp", file_name)
+
+        self.spilled += 1
+
+    def adopt_spilled(self) -> int:
+        """
+        move webhooks spilled by workers which exited to the directory of this worker,
+        a file moved by another worker first is skipped
+
+        Returns
+        -------
+        int
+            number of adopted webhooks
+        """
+
+        spill_root = self.queue_settings.spill_dir
+        if not os.path.isdir(spill_root):
+            return 0
+
+        # files in the spill directory itself were spilled before every worker had its own directory
+        directories = [spill_root]
+        for name in os.listdir(spill_root):
+            directory = os.path.join(spill_root, name)
+            if name.startswith("worker-") and directory != self.spill_dir and os.path.isdir(directory):
+                if not process_exists(name.removeprefix("worker-")):
+                    directories.append(directory)
+
+        adopted = 0
+        for directory in directories:
+            for file_name in self.list_spilled(directory):
+                os.makedirs(self.spill_dir, exist_ok=True)
+                try:
+                    os.rename(os.path.join(directory, file_name), os.path.join(self.spill_dir, file_name))
+                except FileNotFoundError:
+                    continue
+                adopted += 1
+
+            if directory != spill_root:
+                # files which failed to load are kept
+                with contextlib.suppress(OSError):
+                    os.rmdir(directory)
+
+        if adopted > 0:
+            logger.info(f"adopted {adopted} webhooks spilled by other workers")
+
+        return adopted
+
+    async def drain_spilled(self):
+        """feed spilled webhooks back into the intake once it dropped below the low watermark"""
+
+        loop = asyncio.get_running_loop()
+        adopted_at = 0
+
+        while True:
+            if self.spilled == 0:
+                if time.monotonic() - adopted_at > 5:
+                    adopted_at = time.monotonic()
+                    try:
+                        self.spilled += await loop.run_in_executor(None, self.adopt_spilled)
+                    except Exception as e:
+                        logger.error(f"unable to adopt spilled webhooks: {e}")
+                if self.spilled == 0:
+                    await asyncio.sleep(0.5)
+                continue
+            if self.intake_queue.qsize() >= self.queue_settings.low_watermark:
+                await asyncio.sleep(0.05)
+                continue
+
+            file_names = await loop.run_in_executor(None, self.spilled_files)
+            self.spilled = len(file_names)
+
+            for file_name in file_names:
+                if self.intake_queue.qsize() >= self.queue_settings.low_watermark:
+                    break
+
+                file_path = os.path.join(self.spill_dir, file_name)
+                try:
+                    with open(file_path) as f:
+                        webhook_data = FormbricksWebhook.model_validate_json(f.read())
+                except FileNotFoundError:
+                    self.spilled -= 1
+                    continue
+                except Exception as e:
+                    logger.error(f"unable to read spilled webhook {file_name}: {e}")
+                    with contextlib.suppress(FileNotFoundError):
+                        os.replace(file_path, f"{file_path}.failed")
+                    self.spilled -= 1
+                    continue
+
+                self.put(QueueItemWebhookIncoming(data=webhook_data))
+                with contextlib.suppress(FileNotFoundError):
+                    os.remove(file_path)
+                self.spilled -= 1
+
+    async def claim_shared(self):
+
+        loop = asyncio.get_running_loop()
+        owner = get_owner_id()
+
+        while True:
+            if len(self.claimed) >= min(max_claimed, self.queue_settings.high_watermark):
+                await asyncio.sleep(0.05)
+                continue
+
+            try:
+                claimed = await loop.run_in_executor(None, self.coordinator.claim, "intake", owner)
+            except Exception as e:
+                logger.error(f"unable to claim item from shared queue: {e}")
+                claimed = None
+
+            if claimed is None:
+                self.claim_wakeup.clear()
+                try:
+                    await asyncio.wait_for(self.claim_wakeup.wait(), self.coordinator.settings.poll_interval_seconds)
+                except asyncio.TimeoutError:
+                    pass
+                continue
+
+            claim_id, payload = claimed
+            self.claimed.add(claim_id)
+            self.put(QueueItemWebhookIncoming(data=FormbricksWebhook.model_validate_json(payload), claim_id=claim_id))
+
+    async def finish(self, item: QueueItem, error: bool = False):
+
+        self.exporter.finish(item.trace, error=error)
+
+        if self.coordinator is not None and item.claim_id is not None:
+            loop = asyncio.get_running_loop()
+            try:
+                await loop.run_in_executor(None, self.coordinator.ack, item.claim_id)
+            finally:
+                self.claimed.discard(item.claim_id)
+
+    async def extend_claims(self):
+        """
+        keep claimed items invisible to other workers while they are processed, so slow
+        items aren't handed out a second time and written or mailed twice
+        """
+
+        loop = asyncio.get_running_loop()
+        owner = get_owner_id()
+        interval = self.coordinator.settings.visibility_timeout_seconds / 3
+
+        while True:
+            await asyncio.sleep(interval)
+
+            if len(self.claimed) == 0:
+                continue
+
+            try:
+                await loop.run_in_executor(None, self.coordinator.extend_claims, list(self.claimed), owner)
+            except Exception as e:
+                logger.error(f"unable to extend claims of {len(self.claimed)} items: {e}")
+
+    def put(self, item: QueueItem):
+        if item.trace is None:
+            item.trace = ItemTrace(item_id=self.item_id(item))
+
+        if isinstance(item.data, FormbricksWebhook) and item.data.data is not None:
+            if self.coalesce(item) is True:
+                return
+
+        # the intake is never filled beyond the high watermark, see submit()
+        item.queued_ns = time.time_ns()
+        self.intake_queue.put_nowait(item)
+
+    def coalesce(self, item: QueueItemWebhookIncoming) -> bool:
+        """
+        hold back updates of a response until the coalescing window ended, a later update
+        replaces the waiting one. The window starts with the first update and isn't extended.
+
+        Returns
+        -------
+        bool
+            True if the item is held back
+        """
+
+        response_id = item.data.data.id
+        pending = self.pending_updates.pop(response_id, None)
+
+        if pending is not None:
+            superseded, timer = pending
+            if item.data.event in update_events:
+                # keep answers only the earlier update contained
+                item.data.data.data = {**superseded.data.data.data, **item.data.data.data}
+                self.pending_updates[response_id] = (item, timer)
+            else:
+                # the finished response contains all answers, it's put into the intake right away
+                timer.cancel()
+
+            self.finish_superseded(superseded)
+            return item.data.event in update_events
+
+        delay = self.queue_settings.update_coalesce_seconds
+        if item.data.event not in update_events or delay <= 0:
+            return False
+
+        timer = asyncio.get_running_loop().call_later(delay, self.flush_update, response_id)
+        self.pending_updates[response_id] = (item, timer)
+
+        return True
+
+    def flush_update(self, response_id: str):
+
+        item, _ = self.pending_updates.pop(response_id)
+
+        if self.intake_queue.full():
+            timer = asyncio.get_running_loop().call_later(0.1, self.flush_update, response_id)
+            self.pending_updates[response_id] = (item, timer)
+            return
+
+        item.queued_ns = time.time_ns()
+        self.intake_queue.put_nowait(item)
+
+    def finish_superseded(self, item: QueueItem):
+        metrics.stage_items.inc("normalize", "coalesced")
+        task = asyncio.create_task(self.finish(item))
+        self.running.add(task)
+        task.add_done_callback(self.running.discard)
+
+    @staticmethod
+    async def enqueue(queue: asyncio.Queue, item: QueueItem):
+        """put an item into a stage queue, waits while the queue is full"""
+        item.queued_ns = time.time_ns()
+        await queue.put(item)
+
+    @staticmethod
+    def item_id(item: QueueItem) -> str:
+        if isinstance(item.data, FormbricksWebhook):
+            return item.data.data.id if item.data.data is not None else item.data.webhookId
+        return item.data.webhook_id
+
+    def qsize(self) -> int:
+        return sum(self.queue_depths().values())
+
+    def queue_depths(self) -> Dict[Tuple[str], int]:
+        return {
+            ("normalize",): self.intake_queue.qsize(),
+            ("store",): sum(x.qsize() for x in self.store_queues.values()),
+            ("notify",): self.notify_queue.qsize(),
+            ("shared",): self.coordinator.queue_size("intake") if self.coordinator is not None else 0,
+            ("spilled",): self.spilled,
+            ("coalescing",): len(self.pending_updates)
+        }
+
+    def store_queue(self, target: GristTarget) -> asyncio.Queue:
+
+        queue = self.store_queues.get(target.key())
+        if queue is None:
+            queue = self.store_queues[target.key()] = asyncio.Queue(maxsize=self.queue_settings.high_watermark)
+            self.tasks.append(asyncio.create_task(
+                self.run_stage("store", queue, self.store, self.limiter(stage_upstreams["store"], target))))
+
+        return queue
+
+    def limiter(self, upstream: str, target: GristTarget = None) -> AdaptiveLimiter:
+        """
+        limiter of an upstream service. Every Grist document has its own limiter, so a slow
+        or failing document doesn't open the breaker for the others.
+        """
+
+        if upstream != "grist":
+            return self.limiters[upstream]
+
+        name = f"grist:{target.team_name}/{target.document_name}"
+        limiter = self.limiters.get(name)
+        if limiter is None:
+            limiter = self.limiters[name] = AdaptiveLimiter(name, self.grist_limits)
+
+        return limiter
+
+    async def run_stage(self, stage: str, queue: asyncio.Queue, handler: Callable[[QueueItem, Span], Awaitable],
+                        limiter: AdaptiveLimiter):
+
+        while True:
+            item: QueueItem = await queue.get()
+            # wait for a free slot, the queue absorbs the load while the upstream is slow or down
+            await limiter.acquire()
+
+            task = asyncio.create_task(self.process(stage, queue, handler, limiter, item))
+            self.running.add(task)
+            task.add_done_callback(self.running.discard)
+
+    async def process(self, stage: str, queue: asyncio.Queue, handler: Callable[[QueueItem, Span], Awaitable],
+                      limiter: AdaptiveLimiter, item: QueueItem):
+
+        start_time = time.perf_counter()
+
+        item.trace.spans.append(Span(name=f"queue.{stage}", parent_id=item.trace.root.span_id,
+                                     start_ns=item.queued_ns or time.time_ns(), end_ns=time.time_ns()))
+        span = item.trace.start_span(f"stage.{stage}", retry=item.retries)
+        error = None
+        try:
+            await handler(item, span)
+            span.end()
+            metrics.stage_items.inc(stage, "success")
+        except Exception as e:
+            span.end(error=True)
+            error = e
+        finally:
+            metrics.stage_duration.observe(time.perf_counter() - start_time, stage)
+            limiter.release()
+            queue.task_done()  # tell the queue that the processing on the task is completed
+
+        if error is not None:
+            await self.retry(stage, queue, item, error)
+
+        logger.debug(f"queue size: {self.qsize()}")
+
+    async def run_in_pool(self, item: QueueItem, span: Span, fn: Callable, *args):
+        """run 'fn' in the process pool and record the upstream calls it made"""
+
+        loop = asyncio.get_running_loop()
+        try:
+            result, observations = await loop.run_in_executor(self.pool, metrics.run_instrumented, fn, *args)
+        except Exception as e:
+            self.observe(getattr(e, "upstream_observations", None), getattr(item, "target", None))
+            item.trace.add_observations(span, getattr(e, "upstream_observations", None))
+            raise
+
+        self.observe(observations, getattr(item, "target", None))
+        item.trace.add_observations(span, observations)
+
+        return result
+
+    def observe(self, observations: List[metrics.Observation], target: GristTarget = None):
+        """record upstream calls, Grist calls feed the limiter of the item's target document"""
+
+        metrics.merge_observations(observations)
+
+        for upstream, _, _, duration, error in observations or list():
+            if upstream == "grist":
+                if target is not None:
+                    self.limiter(upstream, target).observe(duration, error)
+            elif upstream in self.limiters:
+                self.limiters[upstream].observe(duration, error)
+
+    async def retry(self, stage: str, queue: asyncio.Queue, item: QueueItem, error: Exception):
+
+        if isinstance(item.data, FormbricksWebhook):
+            logger.error(f"processing of {item.data.webhookId} failed: {error}")
+        else:
+            logger.error(f"processing of {item.data.webhook_id} failed: {error}")
+
+        await asyncio.sleep(1)
+        item.retries += 1
+        if item.retries <= max_retries:
+            metrics.stage_items.inc(stage, "retry")
+            await self.enqueue(queue, item)
+        else:
+            metrics.stage_items.inc(stage, "dead_letter")
+            if stage == "notify":
+                await self.update_index(self.item_id(item), mail_status=registrations.mail_failed)
+            elif not isinstance(item.data, FormbricksWebhook) or item.data.data is not None:
+                await self.update_index(self.item_id(item), stage=registrations.stage_failed)
+            await self.finish(item, error=True)
+
+    async def update_index(self, response_id: str, **values):
+        """write to the registration index, a failing index doesn't fail the item"""
+
+        if self.index is None:
+            return
+
+        loop = asyncio.get_running_loop()
+        try:
+            await loop.run_in_executor(None, functools.partial(self.index.update, response_id, **values))
+        except Exception as e:
+            logger.warning(f"unable to update registration index for {response_id}: {e}")
+
+    async def index_stage(self, response_id: str) -> Optional[str]:
+        """stage of a registration in the index, None if it is unknown or the index fails"""
+
+        if self.index is None:
+            return None
+
+        loop = asyncio.get_running_loop()
+        try:
+            registration = await loop.run_in_executor(None, self.index.get, response_id)
+        except Exception as e:
+            logger.warning(f"unable to read registration index for {response_id}: {e}")
+            return None
+
+        return registration.get("stage") if registration is not None else None
+
+    async def normalize(self, item: QueueItemWebhookIncoming, span: Span):
+
+        # every update of a response in progress would request the survey again otherwise
+        survey_max_age = self.survey_cache_seconds if item.data.event in update_events else 0
+        data = await self.run_in_pool(item, span, normalize_webhook_content, item.data, self.form_client,
+                                      survey_max_age)
+        target = self.router.target(data.survey_id)
+
+        await self.enqueue(self.store_queue(target), QueueItemWebhookNormalized(
+            data=data, target=target, trace=item.trace, claim_id=item.claim_id,
+            finished=item.data.event not in update_events))
+
+    async def store(self, item: QueueItemWebhookNormalized, span: Span):
+
+        response_id = item.data.webhook_id
+
+        response_lock = self.response_locks.setdefault(response_id, [asyncio.Lock(), 0])
+        response_lock[1] += 1
+        try:
+            async with response_lock[0]:
+                data, row_id = await self.store_response(item, span)
+        finally:
+            response_lock[1] -= 1
+            if response_lock[1] == 0:
+                del self.response_locks[response_id]
+
+        if item.finished is False:
+            await self.update_index(response_id, survey_id=item.data.survey_id, stage=registrations.stage_partial)
+            await self.finish(item)
+            return
+
+        await self.update_index(response_id, survey_id=item.data.survey_id, row_id=row_id,
+                                registration_id=data.get_value(registration_id_column_id) or None,
+                                paid=data.get_value(paid_column_id) or None,
+                                stage=registrations.stage_stored, mail_status=registrations.mail_pending)
+
+        await self.enqueue(self.notify_queue, QueueItemWebhookStored(
+            data=data, trace=item.trace, claim_id=item.claim_id))
+
+    async def store_response(self, item: QueueItemWebhookNormalized,
+                             span: Span) -> Tuple[InternalWebhookContent, Optional[int]]:
+        """
+        write the fields which changed since the last write of this response, returns the
+        response as stored and its Grist row ID if it was read back
+        """
+
+        response_id = item.data.webhook_id
+
+        written = self.written.get(response_id, dict())
+        if written is not None and item.finished is False and \
+                await self.index_stage(response_id) in (registrations.stage_stored, registrations.stage_notified):
+            # finished by another worker or before a restart
+            written = None
+
+        if written is None and item.finished is False:
+            logger.info(f"ignoring update of finished response {response_id}")
+            return item.data, None
+
+        record = item.data.as_record()
+        changed = [k for k, v in record.items() if k not in (written or dict()) or written[k] != v]
+
+        # nothing to write, the pool and Grist are skipped
+        if len(changed) == 0 and item.finished is False:
+            return item.data, None
+
+        data = item.data.subset(changed) if len(changed) < len(record) else item.data
+
+        loop = asyncio.get_running_loop()
+        # creating a client resolves the document ID, don't block the event loop with it
+        grist = await loop.run_in_executor(None, self.router.client, item.target)
+
+        table_key = (item.target.key(), item.target.table_name or item.data.survey_name)
+        if table_key in self.known_tables:
+            data, row_id = await self.run_in_pool(item, span, upsert_webhook_row, data, grist,
+                                                  item.target.table_name, item.finished, len(written or dict()) > 0)
+        else:
+            async with self.table_locks.setdefault(table_key, asyncio.Lock()):
+                data, row_id = await self.run_in_pool(item, span, upsert_webhook_row, data, grist,
+                                                      item.target.table_name, item.finished, len(written or dict()) > 0)
+                self.known_tables.add(table_key)
+
+        self.written[response_id] = {**(written or dict()), **record} if item.finished is False else None
+        self.written.move_to_end(response_id)
+        if len(self.written) > max_written_responses:
+            self.written.popitem(last=False)
+
+        return data, row_id
+
+    async def notify(self, item: QueueItemWebhookStored, span: Span):
+
+        await self.run_in_pool(item, span, send_email_for_record, item.data)
+
+        await self.update_index(item.data.webhook_id, stage=registrations.stage_notified,
+                                mail_status=registrations.mail_sent if get_settings().mail.enabled
+                                else registrations.mail_disabled)
+
+        await self.finish(item)
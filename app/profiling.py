@@ -0,0 +1,182 @@
+import functools
+import logging
+import multiprocessing
+import multiprocessing.process
+import os
+import sys
+import threading
+import time
+from collections import Counter
+from typing import Dict, List
+
+logger = logging.getLogger(__name__)
+
+
+@functools.lru_cache(maxsize=16384)
+def frame_label(code) -> str:
+    return f"{code.co_name} ({os.path.basename(code.co_filename)}:{code.co_firstlineno})"
+
+
+class StackSampler:
+    """
+    counts the stacks of all threads of this process except the sampling one,
+    stacks end at 'root_code' if given
+    """
+
+    def __init__(self, root_code=None):
+        self.counts = Counter()
+        self.samples = 0
+        self.root_code = root_code
+
+    def sample(self):
+        own_thread_id = threading.get_ident()
+
+        for thread_id, frame in sys._current_frames().items():
+            if thread_id == own_thread_id:
+                continue
+
+            stack = list()
+            while frame is not None:
+                stack.append(frame_label(frame.f_code))
+                if frame.f_code is self.root_code:
+                    break
+                frame = frame.f_back
+
+            self.counts[";".join(reversed(stack))] += 1
+
+        self.samples += 1
+
+    def run(self, until: float, interval: float):
+        while time.monotonic() < until:
+            self.sample()
+            time.sleep(interval)
+
+
+class ProfileControl:
+    """shared between the API process and the pool workers, passed to the worker initializer"""
+
+    def __init__(self):
+        self.active = multiprocessing.Event()
+        self.session = multiprocessing.Value("i", 0)
+        self.interval = multiprocessing.Value("d", 0.01)
+        self.running_workers = multiprocessing.Value("i", 0)
+        # no feeder thread, it would show up in the samples of later profiles
+        self.results = multiprocessing.SimpleQueue()
+
+
+def init_worker(control: ProfileControl):
+    """pool initializer, the sampler thread blocks on the event until a profile is requested"""
+    threading.Thread(target=run_worker_sampler, args=(control,), name="profiler", daemon=True).start()
+
+
+def run_worker_sampler(control: ProfileControl):
+
+    while True:
+        control.active.wait()
+
+        session = control.session.value
+        with control.running_workers.get_lock():
+            control.running_workers.value += 1
+
+        try:
+            # forked workers inherit the frames of the parent which started them
+            sampler = StackSampler(root_code=multiprocessing.process.BaseProcess._bootstrap.__code__)
+            while control.active.is_set() and control.session.value == session:
+                sampler.sample()
+                time.sleep(control.interval.value)
+
+            control.results.put((session, os.getpid(), dict(sampler.counts), sampler.samples))
+        finally:
+            with control.running_workers.get_lock():
+                control.running_workers.value -= 1
+
+
+class Profiler:
+    """
+    time boxed sampling profile of the API process and all pool workers.
+
+    Nothing runs while no profile is requested, worker sampler threads block on an event.
+    """
+
+    def __init__(self):
+        self.control = ProfileControl()
+        self.lock = threading.Lock()
+
+    def profile(self, seconds: float, interval: float) -> Dict[str, Counter]:
+        """
+        sample for 'seconds', blocks the calling thread
+
+        Returns
+        -------
+        dict
+            process group ('api', 'pool') -> collapsed stack -> sample count
+        """
+
+        if not self.lock.acquire(blocking=False):
+            raise RuntimeError("another profile is running")
+
+        try:
+            with self.control.session.get_lock():
+                self.control.session.value += 1
+                session = self.control.session.value
+
+            self.control.interval.value = interval
+            self.control.active.set()
+
+            logger.info(f"profiling API process and pool workers for {seconds}s")
+
+            api_sampler = StackSampler()
+            api_sampler.run(time.monotonic() + seconds, interval)
+
+            self.control.active.clear()
+
+            pool_counts = Counter()
+            workers = 0
+            deadline = time.monotonic() + 5
+            while time.monotonic() < deadline:
+                if self.control.results.empty():
+                    if self.control.running_workers.value == 0:
+                        break
+                    time.sleep(0.05)
+                    continue
+
+                result_session, _, counts, _ = self.control.results.get()
+                if result_session == session:
+                    pool_counts.update(counts)
+                    workers += 1
+
+            logger.info(f"profile finished with {api_sampler.samples} API samples and {workers} pool workers")
+
+            return {"api": api_sampler.counts, "pool": pool_counts}
+        finally:
+            self.lock.release()
+
+
+def collapsed(profile: Dict[str, Counter]) -> str:
+    """folded stacks as read by flamegraph.pl and speedscope, one root frame per process group"""
+    return "\n".join(f"{group};{stack} {count}"
+                     for group, counts in profile.items() for stack, count in counts.most_common())
+
+
+def top_functions(profile: Dict[str, Counter], limit: int = 50) -> str:
+    """pstats like table of the functions with the most samples, on top of the stack (self) or anywhere (total)"""
+
+    lines = list()
+    for group, counts in profile.items():
+        samples = max(sum(counts.values()), 1)
+        self_counts = Counter()
+        total_counts = Counter()
+        for stack, count in counts.items():
+            frames: List[str] = stack.split(";")
+            self_counts[frames[-1]] += count
+            for frame in set(frames):
+                total_counts[frame] += count
+
+        lines.append(f"{group}: {sum(counts.values())} samples")
+        lines.append(f"{'self':>8} {'self%':>7} {'total':>8} {'total%':>7}  function")
+        for frame, total in total_counts.most_common(limit):
+            lines.append(f"{self_counts[frame]:>8} {self_counts[frame] / samples:>7.1%} "
+                         f"{total:>8} {total / samples:>7.1%}  {frame}")
+        lines.append("")
+
+    return "\n".join(lines)
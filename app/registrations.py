@@ -0,0 +1,129 @@
+import logging
+import os
+import sqlite3
+import threading
+import time
+from functools import lru_cache
+from typing import Dict, List, Optional, Tuple
+
+from app.settings import RegistrationIndexConfig, get_settings
+
+logger = logging.getLogger(__name__)
+
+# pipeline stage a registration reached
+stage_partial = "partial"
+stage_stored = "stored"
+stage_notified = "notified"
+stage_failed = "failed"
+
+# confirmation mail status
+mail_pending = "pending"
+mail_sent = "sent"
+mail_disabled = "disabled"
+mail_failed = "failed"
+
+columns = ("response_id", "survey_id", "row_id", "registration_id", "paid", "stage", "mail_status", "updated_at")
+
+
+class RegistrationIndex:
+    """
+    local index of stored registrations by Formbricks response ID, so their registration
+    ID and status can be looked up without requesting Grist. Written by the pipeline and
+    Grist webhooks, shared by all workers of a node through a sqlite database file.
+    """
+
+    def __init__(self, settings: RegistrationIndexConfig):
+        self.settings = settings
+        self._local = threading.local()
+
+        os.makedirs(os.path.dirname(settings.sqlite_path) or ".", exist_ok=True)
+        self._execute("PRAGMA journal_mode=WAL")
+        self._execute("CREATE TABLE IF NOT EXISTS registrations (response_id TEXT PRIMARY KEY, survey_id TEXT, "
+                      "row_id INTEGER, registration_id INTEGER, paid TEXT, stage TEXT, mail_status TEXT, "
+                      "updated_at REAL)")
+
+    def _connection(self) -> sqlite3.Connection:
+        # sqlite connections can't be shared between threads or forked processes
+        connection = getattr(self._local, "connection", None)
+        if connection is None or getattr(self._local, "pid", None) != os.getpid():
+            connection = sqlite3.connect(self.settings.sqlite_path, timeout=10, isolation_level=None)
+            connection.execute("PRAGMA synchronous=NORMAL")
+            self._local.connection = connection
+            self._local.pid = os.getpid()
+        return connection
+
+    def _execute(self, sql: str, parameters: Tuple = ()) -> sqlite3.Cursor:
+        return self._connection().execute(sql, parameters)
+
+    def get(self, response_id: str) -> Optional[Dict]:
+        row = self._execute(f"SELECT {', '.join(columns)} FROM registrations WHERE response_id = ?",
+                            (response_id,)).fetchone()
+        return dict(zip(columns, row)) if row is not None else None
+
+    def update(self, response_id: str, **values):
+        """
+        insert or update the registration, only the given columns are written.
+        A stage is never set back, e.g. by a late partial write of a stored registration.
+        """
+
+        values = {k: v for k, v in values.items() if v is not None}
+        unknown = set(values.keys()) - set(columns)
+        if len(unknown) > 0:
+            raise ValueError(f"unknown registration index columns: {', '.join(sorted(unknown))}")
+
+        names = ["response_id", *values.keys(), "updated_at"]
+        parameters = (response_id, *values.values(), time.time())
+
+        assignments = [f"{x} = excluded.{x}" for x in names[1:] if x != "stage"]
+        if "stage" in values:
+            assignments.append(f"stage = CASE WHEN registrations.stage IS NULL OR {stage_rank('registrations.stage')}"
+                               f" <= {stage_rank('excluded.stage')} THEN excluded.stage ELSE registrations.stage END")
+
+        self._execute(f"INSERT INTO registrations ({', '.join(names)}) VALUES ({', '.join('?' * len(names))}) "
+                      f"ON CONFLICT (response_id) DO UPDATE SET {', '.join(assignments)}", parameters)
+
+    def update_from_records(self, records: List[Dict], response_id_column: str, registration_id_column: str,
+                            paid_column: str, status_column: str, finished_status: str) -> int:
+        """
+        apply records changed in Grist, records without a response ID are skipped
+
+        Returns
+        -------
+        int
+            number of updated registrations
+        """
+
+        updated = 0
+        for record in records:
+            response_id = record.get(response_id_column)
+            if not response_id:
+                continue
+
+            status = record.get(status_column)
+            self.update(
+                response_id,
+                row_id=record.get("id"),
+                registration_id=record.get(registration_id_column),
+                paid=record.get(paid_column),
+                stage=(stage_stored if status == finished_status else stage_partial) if status else None
+            )
+            updated += 1
+
+        return updated
+
+
+def stage_rank(column: str) -> str:
+    """sql expression ordering the stages, a failed item can still be finished by a later delivery"""
+    return f"CASE {column} WHEN '{stage_partial}' THEN 0 WHEN '{stage_failed}' THEN 1 " \
+           f"WHEN '{stage_stored}' THEN 2 WHEN '{stage_notified}' THEN 3 ELSE 0 END"
+
+
+@lru_cache()
+def get_registration_index() -> Optional[RegistrationIndex]:
+    """returns the registration index or None if it is disabled"""
+
+    settings = get_settings().registrations
+    if not settings.sqlite_path:
+        return None
+
+    return RegistrationIndex(settings)
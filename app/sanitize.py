@@ -0,0 +1,63 @@
+import functools
+from html.parser import HTMLParser
+from io import StringIO
+from typing import Iterable, List
+
+# text without these characters is returned unchanged by the parser
+markup_characters = ("<", "&")
+
+
+class MLStripper(HTMLParser):
+    def __init__(self):
+        super().__init__()
+        self.reset()
+        self.strict = False
+        self.convert_charrefs = True
+        self.text = StringIO()
+
+    def handle_data(self, d):
+        self.text.write(d)
+
+    def get_data(self):
+        return self.text.getvalue()
+
+
+def strip_markup(html):
+    """remove tags and convert character references with a full HTML parser"""
+    s = MLStripper()
+    s.feed(html)
+    return s.get_data()
+
+
+def has_markup(text: str) -> bool:
+    return "<" in text or "&" in text
+
+
+def strip_tags(html):
+    """like 'strip_markup', plain text is returned without running the parser"""
+
+    if type(html) is str and not has_markup(html):
+        return html
+
+    return strip_markup(html)
+
+
+@functools.lru_cache(maxsize=4096)
+def strip_tags_cached(html: str) -> str:
+    """'strip_tags' for strings which repeat with every response, like question headlines"""
+    return strip_tags(html)
+
+
+def strip_tags_batch(values: Iterable) -> List:
+    """'strip_tags' for all values of a response, a single scan if none of them contains markup"""
+
+    values = list(values)
+
+    try:
+        if not has_markup("\0".join(values)):
+            return values
+    except TypeError:
+        # non string values raise the same error as 'strip_markup' below
+        pass
+
+    return [strip_tags(x) for x in values]
@@ -1,7 +1,7 @@
 from functools import lru_cache
-from typing import Annotated
+from typing import Annotated, Literal, Optional, Self
 
-from pydantic import BaseModel, Field, AfterValidator
+from pydantic import BaseModel, Field, AfterValidator, model_validator
 from pydantic_settings import BaseSettings
 
 from formbricks.settings import FormbricksConfig
@@ -15,7 +15,7 @@ import os
 # ========================
 
 # unset environment variables with config setting prefixes
-for VAR_NAME in ["MAIL", "SERVER", "LOGGING", "GRIST", "FORMBRICKS"]:
+for VAR_NAME in ["MAIL", "SERVER", "LOGGING", "GRIST", "FORMBRICKS", "BACKFILL", "TRACING", "COORDINATION", "QUEUE", "BOOTSTRAP", "REGISTRATIONS"]:
     if os.environ.get(VAR_NAME):
         del os.environ[VAR_NAME]
 
@@ -63,6 +63,144 @@ class LoggingConfig(BaseModel):
     )
 
 
+class BackfillConfig(BaseModel):
+    """backfill configuration"""
+
+    batch_size: int = Field(
+        default=500,
+        description="number of responses written to Grist with a single request",
+        ge=1,
+        le=5000
+    )
+    concurrency: int = Field(
+        default=4,
+        description="number of concurrent Grist write requests",
+        ge=1,
+        le=32
+    )
+    checkpoint_dir: str = Field(
+        default="checkpoints",
+        description="directory to store backfill progress checkpoints"
+    )
+
+
+class TracingConfig(BaseModel):
+    """tracing configuration"""
+
+    export_file: Optional[str] = Field(
+        default=None,
+        description="file to append finished traces to in OTLP JSON format (one export request per line)"
+    )
+    otlp_endpoint: Optional[str] = Field(
+        default=None,
+        description="OTLP/HTTP collector base url to send traces to, e.g. http://localhost:4318"
+    )
+    service_name: str = Field(
+        default="formbricks2grist-api",
+        description="service name reported with exported traces"
+    )
+    recent_items: int = Field(
+        default=500,
+        description="number of recently finished items kept for the /debug/slow endpoint",
+        ge=1
+    )
+
+
+class CoordinationConfig(BaseModel):
+    """coordination between uvicorn workers and nodes"""
+
+    backend: Optional[str] = Field(
+        default=None,
+        description="'sqlite' or the import path of a Coordinator class (module.ClassName), "
+                    "unset keeps queue and caches local to every worker"
+    )
+    url: Optional[str] = Field(
+        default=None,
+        description="connection url passed to a network coordination backend"
+    )
+    sqlite_path: str = Field(
+        default="state/coordination.sqlite3",
+        description="database file of the sqlite backend, needs to be shared by all workers"
+    )
+    lease_seconds: int = Field(
+        default=30,
+        description="time a schema change lease is held before it expires",
+        ge=1
+    )
+    visibility_timeout_seconds: int = Field(
+        default=300,
+        description="time after which a claimed but not finished queue item is handed out again",
+        ge=1
+    )
+    poll_interval_seconds: float = Field(
+        default=0.5,
+        description="interval to poll the shared queue when it is empty",
+        gt=0
+    )
+
+
+class QueueConfig(BaseModel):
+    """pipeline queue bounds and intake overload policy"""
+
+    high_watermark: int = Field(
+        default=1000,
+        description="maximum number of items per pipeline stage queue, "
+                    "the intake is considered saturated when reached",
+        ge=1
+    )
+    low_watermark: int = Field(
+        default=750,
+        description="saturated intake accepts items again once it dropped to this number of items",
+        ge=0
+    )
+    overflow_policy: Literal["reject", "spill"] = Field(
+        default="reject",
+        description="'reject' answers webhooks with 503 and Retry-After while the intake is saturated, "
+                    "'spill' writes them to 'spill_dir' and feeds them back once the intake drained"
+    )
+    retry_after_seconds: int = Field(
+        default=30,
+        description="Retry-After header value of rejected webhooks",
+        ge=1
+    )
+    spill_dir: str = Field(
+        default="state/spill",
+        description="directory for webhooks spilled to disk, every worker uses its own subdirectory "
+                    "and adopts the webhooks of workers which exited"
+    )
+    update_coalesce_seconds: float = Field(
+        default=2.0,
+        description="responseCreated/responseUpdated events of the same response within this time "
+                    "are combined into one partial write",
+        ge=0
+    )
+
+    @model_validator(mode='after')
+    def check_watermarks(self) -> Self:
+        if self.low_watermark >= self.high_watermark:
+            raise ValueError("low_watermark needs to be lower than high_watermark")
+        return self
+
+
+class BootstrapConfig(BaseModel):
+    """startup behaviour"""
+
+    state_file: str = Field(
+        default="state/bootstrap.json",
+        description="file to persist resolved Grist document IDs and document schemas between restarts"
+    )
+
+
+class RegistrationIndexConfig(BaseModel):
+    """local index of stored registrations served by /registration/{response_id}"""
+
+    sqlite_path: Optional[str] = Field(
+        default="state/registrations.sqlite3",
+        description="database file of the registration index, shared by all workers of a node, "
+                    "empty disables the index"
+    )
+
+
 class Settings(BaseSettings):
 
     # Server Config
@@ -80,6 +218,24 @@ class Settings(BaseSettings):
     # eMail Config
     mail: MailConfig = MailConfig()
 
+    # Backfill Config
+    backfill: BackfillConfig = BackfillConfig()
+
+    # Tracing Config
+    tracing: TracingConfig = TracingConfig()
+
+    # Coordination Config
+    coordination: CoordinationConfig = CoordinationConfig()
+
+    # Queue Config
+    queue: QueueConfig = QueueConfig()
+
+    # Bootstrap Config
+    bootstrap: BootstrapConfig = BootstrapConfig()
+
+    # Registration Index Config
+    registrations: RegistrationIndexConfig = RegistrationIndexConfig()
+
     class Config:
         env_file = (".env", ".env.local")
         env_file_encoding = "utf-8"
@@ -0,0 +1,179 @@
+import collections
+import json
+import logging
+import os
+import queue
+import threading
+import time
+from typing import Any, Deque, Dict, List, Optional
+
+import requests
+from pydantic import BaseModel, Field
+
+from app.metrics import Observation
+from app.settings import TracingConfig
+
+logger = logging.getLogger(__name__)
+
+
+def _new_id(length: int) -> str:
+    return os.urandom(length).hex()
+
+
+class Span(BaseModel):
+    span_id: str = Field(default_factory=lambda: _new_id(8))
+    parent_id: Optional[str] = None
+    name: str = ""
+    start_ns: int = Field(default_factory=time.time_ns)
+    end_ns: Optional[int] = None
+    error: bool = False
+    attributes: Dict[str, Any] = dict()
+
+    def end(self, error: bool = False):
+        self.end_ns = time.time_ns()
+        self.error = error
+
+    def duration(self) -> float:
+        return ((self.end_ns or time.time_ns()) - self.start_ns) / 1e9
+
+
+class ItemTrace(BaseModel):
+    """all spans of a single webhook as it moves through the pipeline"""
+    trace_id: str = Field(default_factory=lambda: _new_id(16))
+    item_id: str = ""
+    root: Span = Field(default_factory=lambda: Span(name="registration"))
+    spans: List[Span] = list()
+
+    def start_span(self, name: str, parent: Span = None, **attributes) -> Span:
+        span = Span(name=name, parent_id=(parent or self.root).span_id, attributes=attributes)
+        self.spans.append(span)
+        return span
+
+    def add_observations(self, parent: Span, observations: List[Observation]):
+        """add upstream calls recorded in a pool worker as child spans"""
+        for upstream, operation, start_ns, duration, error in observations or list():
+            self.spans.append(Span(
+                name=f"{upstream}.{operation}",
+                parent_id=parent.span_id,
+                start_ns=start_ns,
+                end_ns=start_ns + int(duration * 1e9),
+                error=error,
+                attributes={"upstream": upstream}
+            ))
+
+    def summary(self) -> Dict:
+        return {
+            "trace_id": self.trace_id,
+            "item_id": self.item_id,
+            "duration": round(self.root.duration(), 6),
+            "error": self.root.error,
+            "spans": [
+                {
+                    "name": x.name,
+                    "offset": round((x.start_ns - self.root.start_ns) / 1e9, 6),
+                    "duration": round(x.duration(), 6),
+                    "error": x.error
+                } for x in sorted(self.spans, key=lambda x: x.start_ns)
+            ]
+        }
+
+
+def _otlp_value(value: Any) -> Dict:
+    if isinstance(value, bool):
+        return {"boolValue": value}
+    if isinstance(value, int):
+        return {"intValue": str(value)}
+    if isinstance(value, float):
+        return {"doubleValue": value}
+    return {"stringValue": str(value)}
+
+
+def _otlp_span(trace: ItemTrace, span: Span) -> Dict:
+    otlp_span = {
+        "traceId": trace.trace_id,
+        "spanId": span.span_id,
+        "name": span.name,
+        "kind": 1,
+        "startTimeUnixNano": str(span.start_ns),
+        "endTimeUnixNano": str(span.end_ns or span.start_ns),
+        "attributes": [{"key": k, "value": _otlp_value(v)} for k, v in span.attributes.items()],
+        "status": {"code": 2 if span.error else 1}
+    }
+    if span.parent_id is not None:
+        otlp_span["parentSpanId"] = span.parent_id
+    return otlp_span
+
+
+class TraceExporter:
+    """
+    keeps recently finished traces and exports them in OTLP JSON format
+    to a file and/or an OTLP/HTTP collector from a background thread.
+    """
+
+    def __init__(self, settings: TracingConfig):
+        self.settings = settings
+        self.recent: Deque[ItemTrace] = collections.deque(maxlen=settings.recent_items)
+        self.recent_by_id: Dict[str, ItemTrace] = dict()
+        self._queue: queue.Queue = queue.Queue(maxsize=10000)
+        self._thread = None
+
+        if settings.export_file or settings.otlp_endpoint:
+            self._thread = threading.Thread(target=self._run, name="trace-exporter", daemon=True)
+            self._thread.start()
+
+    def finish(self, trace: ItemTrace, error: bool = False):
+        trace.root.end(error)
+
+        if len(self.recent) == self.recent.maxlen:
+            evicted = self.recent[0]
+            if self.recent_by_id.get(evicted.item_id) is evicted:
+                del self.recent_by_id[evicted.item_id]
+        self.recent.append(trace)
+        self.recent_by_id[trace.item_id] = trace
+
+        if self._thread is not None:
+            try:
+                self._queue.put_nowait(trace)
+            except queue.Full:
+                logger.warning("trace export queue is full, dropping trace")
+
+    def slowest(self, limit: int = 20) -> List[Dict]:
+        return [x.summary() for x in sorted(self.recent, key=lambda x: x.root.duration(), reverse=True)[:limit]]
+
+    def find(self, item_id: str) -> Optional[ItemTrace]:
+        return self.recent_by_id.get(item_id)
+
+    def build_request(self, traces: List[ItemTrace]) -> Dict:
+        return {
+            "resourceSpans": [{
+                "resource": {
+                    "attributes": [{"key": "service.name", "value": {"stringValue": self.settings.service_name}}]
+                },
+                "scopeSpans": [{
+                    "scope": {"name": "formbricks2grist"},
+                    "spans": [
+                        _otlp_span(trace, span) for trace in traces for span in [trace.root] + trace.spans
+                    ]
+                }]
+            }]
+        }
+
+    def _run(self):
+        while True:
+            traces = [self._queue.get()]
+            # batch everything which piled up in the meantime
+            while not self._queue.empty() and len(traces) < 100:
+                traces.append(self._queue.get_nowait())
+
+            export_request = self.build_request(traces)
+
+            try:
+                if self.settings.export_file:
+                    with open(self.settings.export_file, "a") as f:
+                        f.write(json.dumps(export_request) + "\n")
+
+                if self.settings.otlp_endpoint:
+                    requests.post(f"{self.settings.otlp_endpoint.rstrip('/')}/v1/traces",
+                                  json=export_request, timeout=5).raise_for_status()
+            except Exception as e:
+                logger.warning(f"failed to export traces: {e}")
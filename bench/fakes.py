@@ -0,0 +1,365 @@
+"""
+local stand-ins for the Formbricks Management API, the Grist REST API and a SMTP server.
+
+They implement just enough of each API for the clients of this project and support
+latency and error injection, so pipeline changes can be measured without touching
+production services.
+"""
+import json
+import logging
+import random
+import re
+import socketserver
+import threading
+import time
+from datetime import datetime, timezone
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+from typing import Any, Callable, Dict, List, Optional, Tuple
+from urllib.parse import parse_qs, urlparse
+
+from pydantic import BaseModel
+
+logger = logging.getLogger(__name__)
+
+
+class Injection(BaseModel):
+    """latency and error injection of a fake server"""
+    latency_ms: float = 0
+    jitter_ms: float = 0
+    error_rate: float = 0
+    error_status: int = 503
+    # sent as Retry-After header with injected errors, like a throttling upstream
+    retry_after_seconds: Optional[float] = None
+
+    def apply(self) -> bool:
+        """sleep the configured latency, returns True if this request should fail"""
+        delay = self.latency_ms + random.uniform(0, self.jitter_ms)
+        if delay > 0:
+            time.sleep(delay / 1000)
+
+        return random.random() < self.error_rate
+
+
+Route = Tuple[str, re.Pattern, Callable[..., Tuple[int, Any]]]
+
+
+class FakeHTTPServer:
+    """threaded JSON HTTP server serving a list of (method, path regex, handler) routes"""
+
+    def __init__(self, injection: Injection = None):
+        self.injection = injection or Injection()
+        self.routes: List[Route] = list()
+        self.requests = 0
+        self.lock = threading.Lock()
+        self._server: Optional[ThreadingHTTPServer] = None
+
+    def route(self, method: str, pattern: str, handler: Callable[..., Tuple[int, Any]]):
+        self.routes.append((method, re.compile(f"^{pattern}$"), handler))
+
+    @property
+    def url(self) -> str:
+        host, port = self._server.server_address[:2]
+        return f"http://{host}:{port}"
+
+    def start(self, host: str = "127.0.0.1", port: int = 0) -> "FakeHTTPServer":
+        fake = self
+
+        class Handler(BaseHTTPRequestHandler):
+            protocol_version = "HTTP/1.1"
+
+            def log_message(self, *args):
+                pass
+
+            def handle_any(self, method: str):
+                length = int(self.headers.get("Content-Length") or 0)
+                body = json.loads(self.rfile.read(length) or "null") if length > 0 else None
+                status, data = fake.dispatch(method, self.path, body)
+
+                content = json.dumps(data).encode()
+                self.send_response(status)
+                self.send_header("Content-Type", "application/json")
+                self.send_header("Content-Length", str(len(content)))
+                if status == fake.injection.error_status and fake.injection.retry_after_seconds is not None:
+                    self.send_header("Retry-After", str(fake.injection.retry_after_seconds))
+                self.end_headers()
+                self.wfile.write(content)
+
+            def do_GET(self):
+                self.handle_any("GET")
+
+            def do_POST(self):
+                self.handle_any("POST")
+
+            def do_PUT(self):
+                self.handle_any("PUT")
+
+            def do_PATCH(self):
+                self.handle_any("PATCH")
+
+        self._server = ThreadingHTTPServer((host, port), Handler)
+        self._server.daemon_threads = True
+        threading.Thread(target=self._server.serve_forever, daemon=True).start()
+
+        return self
+
+    def stop(self):
+        if self._server is not None:
+            self._server.shutdown()
+            self._server.server_close()
+
+    def dispatch(self, method: str, path: str, body: Any) -> Tuple[int, Any]:
+
+        with self.lock:
+            self.requests += 1
+
+        if self.injection.apply():
+            return self.injection.error_status, {"error": "injected error"}
+
+        url = urlparse(path)
+        query = {k: v[0] for k, v in parse_qs(url.query).items()}
+
+        for route_method, pattern, handler in self.routes:
+            match = pattern.match(url.path)
+            if route_method == method and match is not None:
+                try:
+                    return handler(*match.groups(), query=query, body=body)
+                except Exception as e:
+                    logger.exception(f"fake server failed to handle {method} {path}")
+                    return 500, {"error": str(e)}
+
+        return 404, {"error": f"no route for {method} {url.path}"}
+
+
+class FakeFormbricks(FakeHTTPServer):
+    """Formbricks Management API serving a set of surveys and their responses"""
+
+    def __init__(self, injection: Injection = None):
+        super().__init__(injection)
+        self.surveys: Dict[str, Dict] = dict()
+        self.responses: Dict[str, List[Dict]] = dict()
+
+        self.route("GET", r"/health", lambda **_: (200, {"status": "ok"}))
+        self.route("GET", r"/api/v1/management/me", lambda **_: (200, {"id": "bench"}))
+        self.route("GET", r"/api/v1/management/surveys", lambda **_: (200, {"data": list(self.surveys.values())}))
+        self.route("GET", r"/api/v1/management/surveys/([^/]+)", self.get_survey)
+        self.route("GET", r"/api/v1/management/surveys/([^/]+)/responses",
+                   lambda survey_id, **_: (200, {"data": self.responses.get(survey_id, list())}))
+        self.route("GET", r"/api/v1/management/responses", self.list_responses)
+
+    def add_survey(self, survey: Dict):
+        self.surveys[survey["id"]] = survey
+
+    def add_response(self, response: Dict):
+        self.responses.setdefault(response["surveyId"], list()).append(response)
+
+    def get_survey(self, survey_id: str, **_):
+        if survey_id not in self.surveys:
+            return 404, {"message": "survey not found"}
+        return 200, {"data": self.surveys[survey_id]}
+
+    def list_responses(self, query: Dict, **_):
+        limit = int(query.get("limit", 10))
+        skip = int(query.get("skip", 0))
+        return 200, {"data": self.responses.get(query.get("surveyId"), list())[skip:skip + limit]}
+
+
+class FakeGrist(FakeHTTPServer):
+    """Grist REST API with a single team holding in-memory documents"""
+
+    def __init__(self, team_name: str, document_names: List[str], injection: Injection = None):
+        super().__init__(injection)
+        self.team_name = team_name
+        # document ID -> table ID -> {"columns": {col_id: fields}, "records": [record]}
+        self.documents: Dict[str, Dict[str, Dict]] = dict()
+        self.document_names: Dict[str, str] = dict()
+
+        for document_name in document_names:
+            self.add_document(document_name)
+
+        docs = r"/api/docs/([^/]+)"
+        self.route("GET", r"/api/orgs/([^/]+)/workspaces", self.list_workspaces)
+        self.route("GET", f"{docs}/tables", self.list_tables)
+        self.route("POST", f"{docs}/tables", self.add_tables)
+        self.route("GET", f"{docs}/tables/([^/]+)/columns", self.list_cols)
+        self.route("POST", f"{docs}/tables/([^/]+)/columns", self.add_cols)
+        self.route("GET", f"{docs}/tables/([^/]+)/records", self.list_records)
+        self.route("POST", f"{docs}/tables/([^/]+)/records", self.add_records)
+        self.route("PUT", f"{docs}/tables/([^/]+)/records", self.add_update_records)
+        self.route("GET", f"{docs}/tables/([^/]+)/data", self.list_data)
+
+    def dispatch(self, method: str, path: str, body: Any) -> Tuple[int, Any]:
+        match = re.match(r"^/api/docs/([^/?]+)", path)
+        if match is not None and match.group(1) not in self.documents:
+            return 404, {"error": "document not found"}
+        return super().dispatch(method, path, body)
+
+    def add_document(self, document_name: str) -> str:
+        document_id = f"doc{len(self.documents) + 1}"
+        self.documents[document_id] = dict()
+        self.document_names[document_id] = document_name
+        return document_id
+
+    def list_workspaces(self, _team: str, **_):
+        return 200, [{
+            "id": 1,
+            "name": "Home",
+            "docs": [{"name": name, "urlId": doc_id} for doc_id, name in self.document_names.items()]
+        }]
+
+    def _table(self, doc_id: str, table_id: str) -> Dict:
+        table = self.documents.get(doc_id, {}).get(table_id)
+        if table is None:
+            raise KeyError(f"table {table_id} not found")
+        return table
+
+    def list_tables(self, doc_id: str, **_):
+        return 200, {"tables": [{"id": x, "fields": {}} for x in self.documents[doc_id]]}
+
+    def add_tables(self, doc_id: str, body: Dict, **_):
+        table_ids = list()
+        with self.lock:
+            for table in body.get("tables"):
+                table_id = table["id"].replace(" ", "_")
+                table_id = table_id[0].upper() + table_id[1:]
+                self.documents[doc_id][table_id] = {
+                    "columns": {x["id"]: x.get("fields") or {} for x in table.get("columns", list())},
+                    "records": list()
+                }
+                table_ids.append({"id": table_id})
+        return 200, {"tables": table_ids}
+
+    def list_cols(self, doc_id: str, table_id: str, **_):
+        columns = self._table(doc_id, table_id)["columns"]
+        return 200, {"columns": [{"id": k, "fields": v} for k, v in columns.items()]}
+
+    def add_cols(self, doc_id: str, table_id: str, body: Dict, **_):
+        table = self._table(doc_id, table_id)
+        with self.lock:
+            for column in body.get("columns"):
+                table["columns"][column["id"]] = column.get("fields") or {}
+        return 200, {"columns": [{"id": x["id"]} for x in body.get("columns")]}
+
+    def _row(self, table: Dict, record: Dict) -> Dict:
+        row = dict()
+        for column_id, fields in table["columns"].items():
+            if fields.get("isFormula") is True and fields.get("formula") == "$id":
+                row[column_id] = record["id"]
+            elif fields.get("type") == "Date":
+                # Grist stores dates as epoch seconds, empty dates are null
+                row[column_id] = record["fields"].get(column_id) or None
+                try:
+                    row[column_id] = int(datetime.strptime(row[column_id], "%Y-%m-%d")
+                                         .replace(tzinfo=timezone.utc).timestamp())
+                except (TypeError, ValueError):
+                    pass
+            else:
+                row[column_id] = record["fields"].get(column_id, "No" if column_id == "paid" else "")
+        return {"id": record["id"], "fields": row}
+
+    def list_records(self, doc_id: str, table_id: str, query: Dict, **_):
+        table = self._table(doc_id, table_id)
+        records = table["records"]
+
+        rows = [self._row(table, x) for x in records]
+
+        filter_option = json.loads(query.get("filter") or "{}")
+        for column_id, values in filter_option.items():
+            rows = [x for x in rows if (x["id"] if column_id == "id" else x["fields"].get(column_id)) in values]
+
+        return 200, {"records": rows}
+
+    def add_update_records(self, doc_id: str, table_id: str, query: Dict, body: Dict, **_):
+        table = self._table(doc_id, table_id)
+        with self.lock:
+            for record in body.get("records"):
+                require = record.get("require") or {}
+                fields = record.get("fields") or {}
+
+                for existing in table["records"]:
+                    if all(existing["fields"].get(k) == v for k, v in require.items()):
+                        if query.get("noupdate") != "true":
+                            existing["fields"].update(fields)
+                        break
+                else:
+                    if query.get("noadd") != "true":
+                        table["records"].append({"id": len(table["records"]) + 1, "fields": {**require, **fields}})
+        return 200, None
+
+    def list_data(self, doc_id: str, table_id: str, **_):
+        table = self._table(doc_id, table_id)
+        rows = [self._row(table, x) for x in table["records"]]
+
+        data = {"id": [x["id"] for x in rows]}
+        for column_id in table["columns"]:
+            data[column_id] = [x["fields"].get(column_id) for x in rows]
+
+        return 200, data
+
+    def add_records(self, doc_id: str, table_id: str, body: Dict, **_):
+        table = self._table(doc_id, table_id)
+        with self.lock:
+            ids = list()
+            for record in body.get("records"):
+                record_id = len(table["records"]) + 1
+                table["records"].append({"id": record_id, "fields": record.get("fields") or {}})
+                ids.append({"id": record_id})
+        return 200, {"records": ids}
+
+
+class FakeSMTP:
+    """SMTP sink accepting all mails without TLS and authentication"""
+
+    def __init__(self, injection: Injection = None):
+        self.injection = injection or Injection()
+        self.messages = 0
+        self.lock = threading.Lock()
+        self._server: Optional[socketserver.ThreadingTCPServer] = None
+
+    @property
+    def port(self) -> int:
+        return self._server.server_address[1]
+
+    def start(self, host: str = "127.0.0.1", port: int = 0) -> "FakeSMTP":
+        fake = self
+
+        class Handler(socketserver.StreamRequestHandler):
+
+            def reply(self, line: str):
+                self.wfile.write(f"{line}\r\n".encode())
+
+            def handle(self):
+                self.reply("220 fake smtp ready")
+                while True:
+                    line = self.rfile.readline().decode(errors="replace").strip()
+                    if not line:
+                        return
+
+                    command = line.split(" ")[0].upper()
+                    if command in ["EHLO", "HELO"]:
+                        self.reply("250 fake smtp")
+                    elif command == "DATA":
+                        self.reply("354 end data with <CR><LF>.<CR><LF>")
+                        while self.rfile.readline() not in [b".\r\n", b".\n", b""]:
+                            pass
+                        if fake.injection.apply():
+                            self.reply("451 injected error")
+                            continue
+                        with fake.lock:
+                            fake.messages += 1
+                        self.reply("250 OK")
+                    elif command == "QUIT":
+                        self.reply("221 bye")
+                        return
+                    else:
+                        self.reply("250 OK")
+
+        self._server = socketserver.ThreadingTCPServer((host, port), Handler)
+        self._server.daemon_threads = True
+        threading.Thread(target=self._server.serve_forever, daemon=True).start()
+
+        return self
+
+    def stop(self):
+        if self._server is not None:
+            self._server.shutdown()
+            self._server.server_close()
@@ -0,0 +1,213 @@
+"""
+replay recorded Formbricks webhook dumps against a running instance.
+
+    python -m bench.loadgen --url http://localhost:8000 --dump-dir dump --mode open --rate 20 --count 2000
+
+modes:
+    replay  keep the original arrival pattern of the dumps, compressed by '--speedup'
+    fixed   send at '--rate' per second with at most '--concurrency' requests in flight,
+            the next request waits for a free slot (closed loop)
+    open    Poisson arrivals at '--rate' per second, requests never wait for earlier ones
+
+End-to-end completion latency is measured from the time a webhook was sent until the
+registration index (/registration/{id}) reports its final stage, so the instance needs
+the registration index enabled. The index is shared by all workers of a node. Items
+which ended as failed (dead letter or failed confirmation mail) are counted separately.
+"""
+import argparse
+import glob
+import json
+import os
+import random
+import re
+import threading
+import time
+import uuid
+from concurrent.futures import ThreadPoolExecutor
+from datetime import datetime
+from typing import Dict, List, Tuple
+
+import requests
+
+from bench.run import percentiles
+
+
+def load_dumps(dump_dir: str, events: List[str]) -> List[Tuple[float, Dict]]:
+    """returns (timestamp, payload) of all dumps sorted by time"""
+
+    dumps = list()
+    for file_name in glob.glob(os.path.join(dump_dir, "formbricks_webhook_*.json")):
+        with open(file_name) as f:
+            payload = json.load(f)
+
+        if len(events) > 0 and payload.get("event") not in events:
+            continue
+
+        match = re.search(r"_(\d{4}-\d{2}-\d{2}_\d{2}:\d{2}:\d{2})_", os.path.basename(file_name))
+        if match is not None:
+            timestamp = datetime.strptime(match.group(1), "%Y-%m-%d_%H:%M:%S").timestamp()
+        else:
+            timestamp = os.path.getmtime(file_name)
+
+        dumps.append((timestamp, payload))
+
+    return sorted(dumps, key=lambda x: x[0])
+
+
+# stage a registration reaches once the pipeline finished it, by webhook event
+final_stages = {"responseCreated": "partial", "responseUpdated": "partial"}
+default_final_stage = "notified"
+stage_order = ["partial", "stored", "notified"]
+
+
+class LoadResult:
+
+    def __init__(self):
+        self.lock = threading.Lock()
+        # item ID -> (epoch time the webhook was sent, expected final stage)
+        self.sent: Dict[str, Tuple[float, str]] = dict()
+        self.accepted = 0
+        self.request_durations: List[float] = list()
+        self.errors: Dict[str, int] = dict()
+
+    def add_error(self, error: str):
+        with self.lock:
+            self.errors[error] = self.errors.get(error, 0) + 1
+
+
+def main():
+
+    parser = argparse.ArgumentParser(description="replay webhook dumps against a running instance")
+    parser.add_argument("--url", default="http://localhost:8000", help="base url of the running instance")
+    parser.add_argument("--api-token", default=None, help="webhook api token of the instance")
+    parser.add_argument("--dump-dir", default="dump", help="directory with formbricks_webhook_*.json dumps")
+    parser.add_argument("--events", default="responseFinished", help="comma separated events to replay, empty for all")
+    parser.add_argument("--mode", choices=["replay", "fixed", "open"], default="open")
+    parser.add_argument("--count", type=int, default=0, help="number of requests, default: number of dumps")
+    parser.add_argument("--rate", type=float, default=10, help="requests per second in fixed and open mode")
+    parser.add_argument("--speedup", type=float, default=60, help="time compression factor in replay mode")
+    parser.add_argument("--concurrency", type=int, default=16, help="requests in flight in fixed mode")
+    parser.add_argument("--randomize-ids", action="store_true", help="send every request with a new response ID")
+    parser.add_argument("--completion-timeout", type=float, default=60,
+                        help="seconds to wait for the pipeline to finish all accepted items")
+    args = parser.parse_args()
+
+    dumps = load_dumps(args.dump_dir, [x for x in args.events.split(",") if len(x) > 0])
+    if len(dumps) == 0:
+        parser.error(f"no matching dumps found in '{args.dump_dir}'")
+
+    count = args.count or len(dumps)
+    webhook_url = f"{args.url.rstrip('/')}/webhook/formbricks"
+    params = {"api_token": args.api_token} if args.api_token is not None else None
+    result = LoadResult()
+    thread_data = threading.local()
+
+    def send(payload: Dict):
+        if getattr(thread_data, "session", None) is None:
+            thread_data.session = requests.Session()
+
+        payload = json.loads(json.dumps(payload))
+        if args.randomize_ids is True and payload.get("data") is not None:
+            payload["data"]["id"] = uuid.uuid4().hex
+        item_id = (payload.get("data") or {}).get("id") or payload.get("webhookId")
+
+        sent_at = time.time()
+        start_time = time.perf_counter()
+        try:
+            response = thread_data.session.post(webhook_url, params=params, json=payload, timeout=30)
+        except requests.RequestException as e:
+            result.add_error(type(e).__name__)
+            return
+
+        with result.lock:
+            result.request_durations.append(time.perf_counter() - start_time)
+            if 200 <= response.status_code <= 299:
+                result.accepted += 1
+                result.sent[item_id] = (sent_at, final_stages.get(payload.get("event"), default_final_stage))
+        if not 200 <= response.status_code <= 299:
+            result.add_error(f"HTTP {response.status_code}")
+
+    # schedule: offset in seconds from start for every request
+    if args.mode == "replay":
+        first_timestamp = dumps[0][0]
+        span = dumps[-1][0] - first_timestamp + 1
+        schedule = [((dumps[i % len(dumps)][0] - first_timestamp) + span * (i // len(dumps))) / args.speedup
+                    for i in range(count)]
+    elif args.mode == "open":
+        schedule, offset = list(), 0.0
+        for _ in range(count):
+            schedule.append(offset)
+            offset += random.expovariate(args.rate)
+    else:
+        schedule = [i / args.rate for i in range(count)]
+
+    # open loop and replay never wait for earlier requests, use enough threads to keep up
+    workers = args.concurrency if args.mode == "fixed" else max(args.concurrency, int(args.rate * 30) + 1)
+    in_flight = threading.Semaphore(args.concurrency)
+
+    def send_fixed(payload: Dict):
+        try:
+            send(payload)
+        finally:
+            in_flight.release()
+
+    start_time = time.perf_counter()
+    with ThreadPoolExecutor(max_workers=workers) as executor:
+        for i, offset in enumerate(schedule):
+            delay = start_time + offset - time.perf_counter()
+            if delay > 0:
+                time.sleep(delay)
+
+            payload = dumps[i % len(dumps)][1]
+            if args.mode == "fixed":
+                in_flight.acquire()
+                executor.submit(send_fixed, payload)
+            else:
+                executor.submit(send, payload)
+
+    send_duration = time.perf_counter() - start_time
+
+    # end-to-end latencies, from sending the webhook until the registration reached its final stage
+    completion: List[float] = list()
+    failed: List[float] = list()
+    pending = set(result.sent.keys())
+    deadline = time.perf_counter() + args.completion_timeout
+    session = requests.Session()
+    while len(pending) > 0 and time.perf_counter() < deadline:
+        for item_id in list(pending):
+            response = session.get(f"{args.url.rstrip('/')}/registration/{item_id}", timeout=10)
+            if response.status_code == 404 and "disabled" in response.text:
+                parser.error("the registration index of the instance is disabled, set REGISTRATIONS__SQLITE_PATH")
+            if response.status_code != 200:
+                continue
+
+            registration = response.json()
+            sent_at, final_stage = result.sent[item_id]
+            if registration.get("stage") == "failed" or registration.get("mail_status") == "failed":
+                failed.append(registration.get("updated_at") - sent_at)
+                pending.discard(item_id)
+            elif registration.get("stage") in stage_order and \
+                    stage_order.index(registration.get("stage")) >= stage_order.index(final_stage):
+                completion.append(registration.get("updated_at") - sent_at)
+                pending.discard(item_id)
+        if len(pending) > 0:
+            time.sleep(1)
+
+    print(json.dumps({
+        "mode": args.mode,
+        "sent": count,
+        "accepted": result.accepted,
+        "seconds": round(send_duration, 3),
+        "offered_rate": round(count / send_duration, 2),
+        "accepted_rate": round(result.accepted / send_duration, 2),
+        "errors": result.errors,
+        "request_latency": percentiles(result.request_durations),
+        "completed": len(completion),
+        "failed": len(failed),
+        "not_completed": len(pending),
+        "completion_latency": percentiles(completion)
+    }, indent=2))
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,245 @@
+"""
+replay recorded Formbricks webhook dumps through the pipeline stages against local
+fake Formbricks, Grist and SMTP servers and report throughput and latency percentiles.
+
+    python -m bench.run --dump-dir dump --rate 50 --count 1000 --grist-latency-ms 40
+
+Dumps are the files written by 'handle_formbricks_webhook' in DEBUG mode. If no survey
+definition is passed with '--survey-file', one is derived from the answers in the dumps.
+"""
+import argparse
+import copy
+import glob
+import json
+import os
+import re
+import threading
+import time
+import uuid
+from concurrent.futures import ThreadPoolExecutor
+from typing import Callable, Dict, List
+
+from bench.fakes import FakeFormbricks, FakeGrist, FakeSMTP, Injection
+from formbricks.models import FormbricksWebhook
+
+contact_info_items = ["firstName", "lastName", "email", "phone", "company"]
+
+
+def load_dumps(dump_dir: str) -> List[FormbricksWebhook]:
+    webhooks = list()
+    for file_name in sorted(glob.glob(os.path.join(dump_dir, "formbricks_webhook_*.json"))):
+        with open(file_name) as f:
+            webhook = FormbricksWebhook(**json.load(f))
+        if webhook.event == "responseFinished" and webhook.data is not None:
+            webhooks.append(webhook)
+    return webhooks
+
+
+def derive_survey(survey_id: str, webhooks: List[FormbricksWebhook]) -> Dict:
+    """build a survey definition matching the answers found in the dumps"""
+
+    questions: Dict[str, Dict] = dict()
+    for webhook in webhooks:
+        for question_id, answer in webhook.data.data.items():
+            if question_id in questions:
+                continue
+
+            question = {"id": question_id, "type": "openText", "headline": {"default": question_id}}
+            if isinstance(answer, list) and len(answer) == len(contact_info_items):
+                question["type"] = "contactInfo"
+                for part in contact_info_items:
+                    question[part] = {"placeholder": {"default": part}}
+            elif isinstance(answer, list):
+                question["type"] = "multipleChoiceMulti"
+            elif isinstance(answer, str) and re.match(r"^\d{4}-\d{2}-\d{2}$", answer):
+                question["type"] = "date"
+
+            questions[question_id] = question
+
+    return {"id": survey_id, "name": f"Bench {survey_id}", "questions": list(questions.values())}
+
+
+def percentiles(values: List[float]) -> Dict:
+    if len(values) == 0:
+        return {"count": 0}
+
+    values = sorted(values)
+
+    def pick(p: float) -> float:
+        return round(values[min(int(len(values) * p), len(values) - 1)] * 1000, 2)
+
+    return {"count": len(values), "p50_ms": pick(0.5), "p90_ms": pick(0.9), "p99_ms": pick(0.99),
+            "max_ms": round(values[-1] * 1000, 2)}
+
+
+class StageStats:
+
+    def __init__(self):
+        self.durations: Dict[str, List[float]] = dict()
+        self.errors: Dict[str, Dict[str, int]] = dict()
+        self.lock = threading.Lock()
+
+    def measure(self, stage: str, fn: Callable, *args):
+        start_time = time.perf_counter()
+        try:
+            return fn(*args)
+        except Exception as e:
+            with self.lock:
+                stage_errors = self.errors.setdefault(stage, dict())
+                stage_errors[type(e).__name__] = stage_errors.get(type(e).__name__, 0) + 1
+            raise
+        finally:
+            with self.lock:
+                self.durations.setdefault(stage, list()).append(time.perf_counter() - start_time)
+
+    def report(self) -> Dict:
+        return {stage: {**percentiles(values), "errors": self.errors.get(stage, dict())}
+                for stage, values in self.durations.items()}
+
+
+def configure(formbricks: FakeFormbricks, grist: FakeGrist, smtp: FakeSMTP, public_list_columns: List[str],
+              table_name: str):
+    """point the application settings to the fake servers"""
+
+    os.environ.update({
+        "FORMBRICKS__HOST_NAME": formbricks.url,
+        "FORMBRICKS__API_KEY": "bench",
+        "GRIST__HOST_NAME": grist.url,
+        "GRIST__API_KEY": "bench",
+        "GRIST__TEAM_NAME": grist.team_name,
+        "GRIST__DOCUMENT_NAME": "bench",
+        "GRIST__TABLE_NAME": table_name,
+        "GRIST__PUBLIC_LIST_COLUMNS": ",".join(public_list_columns),
+        "MAIL__ENABLED": "true",
+        "MAIL__HOSTNAME": "127.0.0.1",
+        "MAIL__PORT": str(smtp.port),
+        "MAIL__STARTTLS": "false",
+        "MAIL__SENDER_NAME": "Bench",
+        "MAIL__SENDER_ADDRESS": "bench@example.com",
+        "MAIL__CONFIRMATION_MAIL_RECIPIENT_TEMPLATE": "bench@example.com",
+        "MAIL__CONFIRMATION_MAIL_SUBJECT_TEMPLATE": "Registration {{Registration ID}}",
+        "MAIL__CONFIRMATION_MAIL_CONTENT_TEMPLATE": "Your registration ID is {{Registration ID}}",
+    })
+
+    from app.settings import get_settings
+    get_settings.cache_clear()
+
+    return get_settings()
+
+
+def main():
+
+    parser = argparse.ArgumentParser(description="replay webhook dumps against local fake upstream services")
+    parser.add_argument("--dump-dir", default="dump", help="directory with formbricks_webhook_*.json dumps")
+    parser.add_argument("--survey-file", help="JSON file with the Formbricks survey definition")
+    parser.add_argument("--count", type=int, default=200, help="number of webhooks to replay")
+    parser.add_argument("--rate", type=float, default=0, help="webhooks per second, 0 replays as fast as possible")
+    parser.add_argument("--concurrency", type=int, default=8, help="number of items processed in parallel")
+    parser.add_argument("--export-runs", type=int, default=10, help="number of uncached public list exports")
+    parser.add_argument("--no-mail", action="store_true", help="skip the notify stage")
+    for upstream in ["formbricks", "grist", "smtp"]:
+        parser.add_argument(f"--{upstream}-latency-ms", type=float, default=0)
+        parser.add_argument(f"--{upstream}-jitter-ms", type=float, default=0)
+        parser.add_argument(f"--{upstream}-error-rate", type=float, default=0)
+    args = parser.parse_args()
+
+    webhooks = load_dumps(args.dump_dir)
+    if len(webhooks) == 0:
+        parser.error(f"no responseFinished dumps found in '{args.dump_dir}'")
+
+    def injection(upstream: str) -> Injection:
+        return Injection(latency_ms=getattr(args, f"{upstream}_latency_ms"),
+                         jitter_ms=getattr(args, f"{upstream}_jitter_ms"),
+                         error_rate=getattr(args, f"{upstream}_error_rate"))
+
+    fake_formbricks = FakeFormbricks(injection("formbricks")).start()
+    fake_grist = FakeGrist("bench", ["bench"], injection("grist")).start()
+    fake_smtp = FakeSMTP(injection("smtp")).start()
+
+    survey_ids = sorted({x.data.surveyId for x in webhooks})
+    for survey_id in survey_ids:
+        if args.survey_file:
+            with open(args.survey_file) as f:
+                survey = json.load(f)
+            survey = survey.get("data", survey)
+            survey["id"] = survey_id
+        else:
+            survey = derive_survey(survey_id, [x for x in webhooks if x.data.surveyId == survey_id])
+        fake_formbricks.add_survey(survey)
+
+    first_survey = fake_formbricks.surveys[survey_ids[0]]
+    settings = configure(
+        fake_formbricks, fake_grist, fake_smtp,
+        public_list_columns=["Registration ID"] + [x["headline"]["default"] for x in first_survey["questions"]
+                                                   if x["type"] != "contactInfo"],
+        table_name=first_survey["name"]
+    )
+
+    # import after configuration, modules read the settings on import
+    from formbricks.client import FormbricksClient
+    from formbricks.handler import normalize_webhook_content
+    from grist.client import GristClient
+    from grist.handler import grist_export, upsert_webhook_row
+    from notification.handler import send_email_for_record
+
+    form_client = FormbricksClient(settings.formbricks)
+    grist_client = GristClient(settings.grist)
+    thread_data = threading.local()
+
+    stats = StageStats()
+
+    def process(webhook: FormbricksWebhook, scheduled: float):
+        # pygrister keeps the last request/response per instance, use one client per thread
+        if getattr(thread_data, "grist", None) is None:
+            thread_data.grist = copy.deepcopy(grist_client)
+
+        try:
+            data = stats.measure("normalize", normalize_webhook_content, webhook, form_client)
+            data, _ = stats.measure("store", upsert_webhook_row, data, thread_data.grist)
+            if args.no_mail is False:
+                stats.measure("notify", send_email_for_record, data)
+        except Exception:
+            return
+
+        with stats.lock:
+            stats.durations.setdefault("end_to_end", list()).append(time.perf_counter() - scheduled)
+
+    start_time = time.perf_counter()
+    with ThreadPoolExecutor(max_workers=args.concurrency) as executor:
+        for i in range(args.count):
+            scheduled = start_time + (i / args.rate if args.rate > 0 else 0)
+            delay = scheduled - time.perf_counter()
+            if delay > 0:
+                time.sleep(delay)
+
+            webhook = webhooks[i % len(webhooks)].model_copy(deep=True)
+            webhook.data.id = uuid.uuid4().hex
+            executor.submit(process, webhook, scheduled)
+
+    duration = time.perf_counter() - start_time
+
+    for _ in range(args.export_runs):
+        stats.measure("export", grist_export.__wrapped__, grist_client)
+
+    completed = len(stats.durations.get("end_to_end", list()))
+    result = {
+        "replayed": args.count,
+        "completed": completed,
+        "seconds": round(duration, 3),
+        "throughput_per_second": round(completed / duration, 2),
+        "upstream_requests": {
+            "formbricks": fake_formbricks.requests,
+            "grist": fake_grist.requests,
+            "smtp_messages": fake_smtp.messages
+        },
+        "stages": stats.report()
+    }
+
+    print(json.dumps(result, indent=2))
+
+    for fake in [fake_formbricks, fake_grist, fake_smtp]:
+        fake.stop()
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,138 @@
+"""
+compare the text sanitizer used for survey answers and headlines with the plain
+HTML parser it replaces and measure both on recorded webhook dumps.
+
+    python -m bench.sanitize --dump-dir dump --fuzz 20000 --runs 200
+
+Every answer, headline and placeholder of the dumps, a list of edge cases and random
+strings built from markup characters are run through both implementations. Any
+difference is reported and makes the command exit with status 1.
+"""
+import argparse
+import json
+import random
+import sys
+import time
+from typing import Callable, Dict, List
+
+from app.sanitize import strip_markup, strip_tags, strip_tags_batch, strip_tags_cached
+from bench.run import derive_survey, load_dumps, percentiles
+from formbricks.handler import convert_question, normalize_response
+
+edge_cases = [
+    "", " ", "plain text", "  padded  ", "a < b", "a > b", "a <b", "<b>bold</b>", "<b>unclosed", "text <",
+    "&", "&amp;", "&amp", "a & b", "&lt;b&gt;", "&#60;", "&#x3C;", "&nbsp;x", "&unknown;", "<!-- comment -->x",
+    "<script>alert(1)</script>", "<style>p {}</style>x", "<br/>line", "<p>one</p><p>two</p>", "<a href='x'>link</a>",
+    "x</b>", "<>", "< >", "<<b>>", "<![CDATA[x]]>", "<?php x ?>", "<!DOCTYPE html>x", "Müller &amp; Söhne",
+    "line\nbreak", "tab\tbed", " nbsp", "emoji 🎉 <i>x</i>",
+]
+
+fuzz_alphabet = ["<", ">", "&", ";", "/", "!", "-", "#", "x", "a", "b", "p", " ", "amp", "lt", "3C", "\n", "'", '"']
+
+
+def reference_values(values: List) -> List[str]:
+    """answer values as cleaned before the sanitizer module, one parser per value"""
+    return [strip_markup(x).strip() for x in values]
+
+
+def collect_strings(webhooks, surveys: Dict[str, Dict]) -> List[str]:
+    strings = list()
+    for webhook in webhooks:
+        for answer in webhook.data.data.values():
+            strings.extend(answer if isinstance(answer, list) else [answer])
+    for survey in surveys.values():
+        for question in survey["questions"]:
+            strings.append(question["headline"]["default"])
+            strings.extend(x["placeholder"]["default"] for x in question.values()
+                           if isinstance(x, dict) and "placeholder" in x)
+    return [x for x in strings if isinstance(x, str)]
+
+
+def fuzz_strings(count: int, seed: int) -> List[str]:
+    generator = random.Random(seed)
+    return ["".join(generator.choices(fuzz_alphabet, k=generator.randint(1, 12))) for _ in range(count)]
+
+
+def measure(fn: Callable, runs: int) -> Dict:
+    durations = list()
+    for _ in range(runs):
+        start_time = time.perf_counter()
+        fn()
+        durations.append(time.perf_counter() - start_time)
+    return percentiles(durations)
+
+
+def main():
+
+    parser = argparse.ArgumentParser(description="differential check and benchmark of the text sanitizer")
+    parser.add_argument("--dump-dir", default="dump", help="directory with formbricks_webhook_*.json dumps")
+    parser.add_argument("--fuzz", type=int, default=20000, help="number of random markup strings to compare")
+    parser.add_argument("--seed", type=int, default=1, help="seed of the random strings")
+    parser.add_argument("--runs", type=int, default=200, help="timed runs per implementation")
+    args = parser.parse_args()
+
+    webhooks = load_dumps(args.dump_dir)
+    if len(webhooks) == 0:
+        parser.error(f"no responseFinished dumps found in '{args.dump_dir}'")
+
+    survey_ids = sorted({x.data.surveyId for x in webhooks})
+    surveys = {x: derive_survey(x, [w for w in webhooks if w.data.surveyId == x]) for x in survey_ids}
+
+    strings = collect_strings(webhooks, surveys)
+    candidates = strings + edge_cases + fuzz_strings(args.fuzz, args.seed)
+
+    mismatches = list()
+    for text in candidates:
+        expected = strip_markup(text)
+        for name, fn in [("strip_tags", strip_tags), ("strip_tags_cached", strip_tags_cached)]:
+            if fn(text) != expected:
+                mismatches.append({"function": name, "input": text, "expected": expected, "got": fn(text)})
+
+    # batches mixing plain text and markup, as answers of a response
+    for i in range(0, len(candidates), 7):
+        batch = candidates[i:i + 7]
+        if strip_tags_batch(batch) != [strip_markup(x) for x in batch]:
+            mismatches.append({"function": "strip_tags_batch", "input": batch})
+
+    # complete responses, answers converted by the handler then cleaned both ways
+    for webhook in webhooks:
+        survey = surveys[webhook.data.surveyId]
+        fields = [x for question in survey["questions"] for x in convert_question(question, webhook.data.data)]
+        expected = reference_values([x.value for x in fields])
+        got = list(normalize_response(webhook.data, {"data": survey}).values)
+        if got != expected:
+            mismatches.append({"function": "normalize_response", "input": webhook.data.id,
+                               "expected": expected, "got": got})
+
+    def run_reference():
+        for webhook in webhooks:
+            reference_values(strings)
+            survey = surveys[webhook.data.surveyId]
+            [strip_markup(x["headline"]["default"]) for x in survey["questions"]]
+
+    def run_sanitizer():
+        for webhook in webhooks:
+            [x.strip() for x in strip_tags_batch(strings)]
+            survey = surveys[webhook.data.surveyId]
+            [strip_tags_cached(x["headline"]["default"]) for x in survey["questions"]]
+
+    result = {
+        "compared": len(candidates),
+        "dump_strings": len(strings),
+        "strings_with_markup": sum(1 for x in strings if "<" in x or "&" in x),
+        "mismatches": mismatches[:20],
+        "mismatch_count": len(mismatches),
+        "reference": measure(run_reference, args.runs),
+        "sanitizer": measure(run_sanitizer, args.runs),
+        "normalize_response": measure(
+            lambda: [normalize_response(x.data, {"data": surveys[x.data.surveyId]}) for x in webhooks], args.runs)
+    }
+
+    print(json.dumps(result, indent=2, ensure_ascii=False))
+
+    if len(mismatches) > 0:
+        sys.exit(1)
+
+
+if __name__ == "__main__":
+    main()
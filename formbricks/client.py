@@ -1,5 +1,10 @@
+from concurrent.futures import ThreadPoolExecutor
+from typing import Dict, Iterator
+
 import requests
 
+from app.lib import build_base_url
+from app.metrics import upstream_call
 from app.settings import FormbricksConfig
 
 
@@ -11,13 +16,17 @@ class FormbricksClient:
 
     def __init__(self, settings: FormbricksConfig):
         self.api_key = settings.api_key.get_secret_value()
-        self.base_url = f"https://{settings.host_name}"
+        self.base_url = build_base_url(settings.host_name)
         self.timeout = settings.timeout_seconds
+        self.page_size = settings.page_size
         self.headers = {
             "x-api-key": self.api_key,
             "Content-Type": "application/json",
         }
 
+    def validate(self):
+        """make sure Formbricks is healthy and accepts the API key"""
+
         if self.get_health().get("status") != "ok":
             raise ValueError("Formbricks is unhealthy")
 
@@ -26,24 +35,28 @@ class FormbricksClient:
     # ---------------------------
     # Internal helpers
     # ---------------------------
-    def _get(self, path: str):
+    def _get(self, path: str, params: Dict = None):
         url = f"{self.base_url}{path}"
-        res = requests.get(url, headers=self.headers, timeout=self.timeout)
+        res = requests.get(url, headers=self.headers, params=params, timeout=self.timeout)
         res.raise_for_status()
         return res.json()
 
     # ---------------------------
     # Surveys
     # ---------------------------
+    @upstream_call("formbricks")
     def list_surveys(self):
         return self._get("/api/v1/management/surveys")
 
+    @upstream_call("formbricks")
     def get_survey(self, survey_id: str):
         return self._get(f"/api/v1/management/surveys/{survey_id}")
 
+    @upstream_call("formbricks")
     def get_health(self):
         return self._get("/health")
 
+    @upstream_call("formbricks")
     def check_me(self):
         url = f"{self.base_url}/api/v1/management/me"
         res = requests.get(url, headers=self.headers, timeout=self.timeout)
@@ -55,5 +68,34 @@ class FormbricksClient:
     # ---------------------------
     # Responses
     # ---------------------------
+    @upstream_call("formbricks")
     def list_responses(self, survey_id: str):
         return self._get(f"/api/v1/management/surveys/{survey_id}/responses")
+
+    @upstream_call("formbricks")
+    def list_responses_page(self, survey_id: str, limit: int, skip: int):
+        return self._get("/api/v1/management/responses", params={"surveyId": survey_id, "limit": limit, "skip": skip})
+
+    def iter_responses(self, survey_id: str, page_size: int = None) -> Iterator[Dict]:
+        """
+        iterate over all responses of a survey page by page using limit/skip paging.
+        The next page is requested in the background while the current one is consumed,
+        so at most two pages are held in memory.
+        """
+
+        page_size = page_size or self.page_size
+
+        with ThreadPoolExecutor(max_workers=1) as executor:
+            skip = 0
+            next_page = executor.submit(self.list_responses_page, survey_id, page_size, skip)
+
+            while next_page is not None:
+                page = next_page.result().get("data") or list()
+                skip += page_size
+
+                # a short page is the last one
+                next_page = None
+                if len(page) >= page_size:
+                    next_page = executor.submit(self.list_responses_page, survey_id, page_size, skip)
+
+                yield from page
@@ -1,18 +1,21 @@
-from typing import List
+import time
+from typing import Dict, List, Tuple
 
-from app.lib import strip_tags, grab
+from app.lib import grab
 from app.models import InternalWebhookContent, InternalWebhookField
+from app.sanitize import strip_tags_batch, strip_tags_cached
 from formbricks.client import FormbricksClient
-from formbricks.models import FormbricksWebhook
+from formbricks.models import FormbricksWebhook, FormbricksWebhookData
 
 
 def convert_question(survey_question: dict, answers: dict) -> List[InternalWebhookField]:
+    """answer fields of a question, values still contain markup, see 'sanitize_fields'"""
 
     # need to stay in this order to parse answer correctly
     contact_info_items = ["firstName", "lastName", "email", "phone", "company"]
 
     question_id = survey_question.get("id")
-    question_title = strip_tags(grab(survey_question, "headline.default", fallback=""))
+    question_title = strip_tags_cached(grab(survey_question, "headline.default", fallback=""))
     question_type = survey_question.get("type")
     question_column_type = "Text"
 
@@ -30,7 +33,7 @@ def convert_question(survey_question: dict, answers: dict) -> List[InternalWebho
                     id=f"{question_id}_{part}",
                     label=f'{question_title} - {grab(survey_question, f"{part}.placeholder.default")}',
                     type=question_column_type,
-                    value=strip_tags(question_answer[key]).strip()
+                    value=question_answer[key]
                 )
             )
 
@@ -46,35 +49,73 @@ def convert_question(survey_question: dict, answers: dict) -> List[InternalWebho
                 id=question_id,
                 label=question_title,
                 type=question_column_type,
-                value=strip_tags(question_answer).strip()
+                value=question_answer
             )
         )
 
     return return_data
 
 
-def normalize_webhook_content(content: FormbricksWebhook, client: FormbricksClient) -> InternalWebhookContent:
+def sanitize_fields(fields: List[InternalWebhookField]) -> List[InternalWebhookField]:
+    """strip markup and surrounding whitespace from all answers of a response at once"""
 
-    return_item = InternalWebhookContent(
-        survey_id=content.data.surveyId,
-        webhook_id=content.data.id)
+    values = strip_tags_batch([x.value for x in fields])
 
-    # look up survey
-    survey_data = client.get_survey(content.data.surveyId)
+    return [x._replace(value=value.strip()) for x, value in zip(fields, values)]
 
-    if survey_data is None or survey_data.get("data") is None:
-        raise RuntimeError(f"unable to get survey with ID: {content.data.surveyId}")
 
-    return_item.survey_name = grab(survey_data, "data.name", fallback="Registrations")
+def normalize_response(response: FormbricksWebhookData, survey_data: dict) -> InternalWebhookContent:
+
+    fields: List[InternalWebhookField] = list()
 
     # iterate over questions
     for survey_question in grab(survey_data, "data.questions") or list():
 
-        return_item.data.extend(convert_question(survey_question, content.data.data))
+        fields.extend(convert_question(survey_question, response.data))
 
     for survey_blocks in grab(survey_data, "data.blocks") or list():
 
         for block_question in survey_blocks.get("elements") or list():
-            return_item.data.extend(convert_question(block_question, content.data.data))
+            fields.extend(convert_question(block_question, response.data))
+
+    return InternalWebhookContent.from_fields(
+        sanitize_fields(fields),
+        survey_id=response.surveyId,
+        webhook_id=response.id,
+        survey_name=grab(survey_data, "data.name", fallback="Registrations")
+    )
+
+
+# survey ID -> (fetch time, survey data) of surveys requested by this process
+_surveys: Dict[str, Tuple[float, dict]] = dict()
+
+
+def get_survey(client: FormbricksClient, survey_id: str, max_age: float = 0) -> dict:
+    """survey definition, reused if this process requested it less than 'max_age' seconds ago"""
+
+    cached = _surveys.get(survey_id)
+    if cached is not None and time.monotonic() - cached[0] < max_age:
+        return cached[1]
+
+    survey_data = client.get_survey(survey_id)
+
+    if survey_data is None or survey_data.get("data") is None:
+        raise RuntimeError(f"unable to get survey with ID: {survey_id}")
+
+    if len(_surveys) >= 1000:
+        _surveys.clear()
+    _surveys[survey_id] = (time.monotonic(), survey_data)
+
+    return survey_data
+
+
+def normalize_webhook_content(content: FormbricksWebhook, client: FormbricksClient,
+                              survey_max_age: float = 0) -> InternalWebhookContent:
+    """
+    normalize a webhook response, the survey is requested again unless it was requested
+    less than 'survey_max_age' seconds ago
+    """
+
+    survey_data = get_survey(client, content.data.surveyId, survey_max_age)
 
-    return return_item
+    return normalize_response(content.data, survey_data)
@@ -1,5 +1,7 @@
 from pydantic import BaseModel, Field, SecretStr
 
+from app.limits import LimitConfig
+
 
 class FormbricksConfig(BaseModel):
 
@@ -22,3 +24,19 @@ class FormbricksConfig(BaseModel):
         ge=1,
         le=300
     )
+    page_size: int = Field(
+        default=100,
+        description="number of responses requested per page when listing survey responses",
+        ge=1,
+        le=5000
+    )
+    survey_cache_seconds: float = Field(
+        default=60,
+        description="time a survey definition is reused to normalize responses in progress, "
+                    "finished responses always use the current definition",
+        ge=0
+    )
+    limits: LimitConfig = Field(
+        default=LimitConfig(),
+        description="adaptive concurrency and circuit breaker settings for Formbricks requests"
+    )
@@ -0,0 +1,194 @@
+import contextlib
+import contextvars
+import email.utils
+import fcntl
+import json
+import logging
+import os
+import time
+from functools import lru_cache
+from typing import Callable, Dict, Iterator, NamedTuple, Optional
+
+from requests import HTTPError
+
+from app import coordination
+from app.limits import TokenBucket
+from app.settings import get_settings
+from grist.settings import GristBudgetConfig
+
+logger = logging.getLogger(__name__)
+
+# requests answered with 429 are sent again this often if the class can wait that long
+max_throttled_retries = 3
+
+
+class TrafficClass(NamedTuple):
+    # share of the burst kept for classes of higher priority
+    reserve: float
+    # longest time a request waits for the budget before GristBudgetExceeded is raised
+    max_wait_seconds: float
+
+
+# in priority order, exports degrade before registration writes and health checks give up first
+traffic_classes: Dict[str, TrafficClass] = {
+    "write": TrafficClass(reserve=0.0, max_wait_seconds=120),
+    "export": TrafficClass(reserve=0.3, max_wait_seconds=10),
+    "health": TrafficClass(reserve=0.6, max_wait_seconds=0)
+}
+
+_traffic_class = contextvars.ContextVar("grist_traffic_class", default="write")
+
+
+class GristBudgetExceeded(Exception):
+    """the request didn't get a share of the document's request budget in time"""
+
+
+@contextlib.contextmanager
+def traffic_class(name: str) -> Iterator[None]:
+    """Grist requests made in this context are scheduled as 'name', requests are 'write' otherwise"""
+
+    token = _traffic_class.set(name)
+    try:
+        yield
+    finally:
+        _traffic_class.reset(token)
+
+
+class FileBucketStore:
+    """token buckets in a JSON file guarded by a file lock, shared by all workers of a node"""
+
+    def __init__(self, file_name: str):
+        self.file_name = file_name
+        os.makedirs(os.path.dirname(file_name) or ".", exist_ok=True)
+
+    @contextlib.contextmanager
+    def _bucket(self, name: str, burst: float) -> Iterator[TokenBucket]:
+
+        with open(f"{self.file_name}.lock", "w") as lock_file:
+            fcntl.flock(lock_file, fcntl.LOCK_EX)
+
+            try:
+                with open(self.file_name) as f:
+                    buckets = json.load(f)
+            except (FileNotFoundError, ValueError):
+                buckets = dict()
+
+            bucket = TokenBucket(*buckets[name]) if name in buckets else TokenBucket(float(burst), time.time())
+
+            yield bucket
+
+            buckets[name] = [bucket.tokens, bucket.updated_at, bucket.blocked_until]
+
+            temp_file_name = f"{self.file_name}.{os.getpid()}.tmp"
+            with open(temp_file_name, "w") as f:
+                json.dump(buckets, f)
+            os.replace(temp_file_name, self.file_name)
+
+    def take_token(self, name: str, rate: float, burst: float, reserve: float = 0.0) -> float:
+        with self._bucket(name, burst) as bucket:
+            return bucket.take(time.time(), rate, burst, reserve)
+
+    def block_tokens(self, name: str, until: float):
+        with self._bucket(name, 0) as bucket:
+            bucket.block(until)
+
+
+def retry_after_seconds(error: HTTPError, default: float = 1.0) -> float:
+    """parse the Retry-After header of a response, given in seconds or as HTTP date"""
+
+    value = error.response.headers.get("Retry-After") if error.response is not None else None
+    if value is None:
+        return default
+
+    try:
+        return max(float(value), 0.0)
+    except ValueError:
+        pass
+
+    try:
+        return max(email.utils.parsedate_to_datetime(value).timestamp() - time.time(), 0.0)
+    except (TypeError, ValueError):
+        return default
+
+
+class RequestScheduler:
+    """
+    schedules Grist requests within a requests per second budget per document.
+
+    The budget is a token bucket shared by all workers, through the coordinator if one is
+    configured or a local state file otherwise. Lower priority traffic classes only get a
+    token while a reserve is left for higher classes, so registration writes are served
+    first once the budget gets tight. Answers with status 429 block the bucket of the
+    document for the time given in Retry-After.
+    """
+
+    def __init__(self, settings: GristBudgetConfig):
+        self.settings = settings
+        self._file_store: Optional[FileBucketStore] = None
+        # without a budget nothing is shared, only Retry-After answers pause the requests of this process
+        self.blocked_until: Dict[str, float] = dict()
+
+    def store(self):
+        coordinator = coordination.get_coordinator()
+        if coordinator is not None:
+            return coordinator
+
+        if self._file_store is None:
+            self._file_store = FileBucketStore(self.settings.state_file)
+        return self._file_store
+
+    def enabled(self) -> bool:
+        return self.settings.requests_per_second > 0
+
+    def wait_time(self, key: str, traffic: TrafficClass) -> float:
+        if not self.enabled():
+            return self.blocked_until.get(key, 0.0) - time.time()
+
+        return self.store().take_token(f"grist:{key}", self.settings.requests_per_second, self.settings.burst,
+                                       reserve=traffic.reserve * self.settings.burst)
+
+    def acquire(self, key: str, class_name: str):
+        """block until the request may be sent, raises GristBudgetExceeded after the class' max wait time"""
+
+        traffic = traffic_classes[class_name]
+        deadline = time.monotonic() + traffic.max_wait_seconds
+
+        while True:
+            wait = self.wait_time(key, traffic)
+            if wait <= 0:
+                return
+
+            if time.monotonic() + wait > deadline:
+                raise GristBudgetExceeded(f"no Grist request budget left for {class_name} requests to {key}")
+
+            logger.debug(f"waiting {wait:.3f}s for Grist request budget of {key} ({class_name})")
+            # others might be faster, check again before the full wait time passed
+            time.sleep(min(wait, 0.25))
+
+    def call(self, key: str, fn: Callable, *args, **kwargs):
+
+        class_name = _traffic_class.get()
+
+        for attempt in range(max_throttled_retries + 1):
+            self.acquire(key, class_name)
+            try:
+                return fn(*args, **kwargs)
+            except HTTPError as e:
+                if e.response is None or e.response.status_code != 429 or attempt == max_throttled_retries:
+                    raise
+
+                retry_after = retry_after_seconds(e)
+                logger.warning(f"Grist throttled requests to {key}, pausing for {retry_after}s")
+                self.block(key, time.time() + retry_after)
+
+    def block(self, key: str, until: float):
+        if not self.enabled():
+            self.blocked_until[key] = max(self.blocked_until.get(key, 0.0), until)
+            return
+
+        self.store().block_tokens(f"grist:{key}", until)
+
+
+@lru_cache()
+def get_request_scheduler() -> RequestScheduler:
+    return RequestScheduler(get_settings().grist.budget)
@@ -1,27 +1,135 @@
+import functools
+import logging
+import time
 from typing import Dict, List
 
 from pygrister.api import GristApi
+from requests import HTTPError
 
+from app.bootstrap import get_bootstrap_state
+from app.lib import build_base_url
+from app.metrics import upstream_call
 from app.settings import GristConfig
+from grist.budget import get_request_scheduler
+
+logger = logging.getLogger(__name__)
+
+# a 404 answer for a missing table doesn't mean the document moved, look it up again at most this often
+document_lookup_interval_seconds = 30
+
+# document key -> time the document ID was looked up again by this process
+_document_lookups: Dict[str, float] = dict()
+
+
+def grist_call(fn=None, document: bool = True):
+    """
+    measured request which is scheduled within the request budget of the client's document.
+    Document requests answered with 404 are sent once more if the document resolves to another ID.
+    """
+
+    if fn is None:
+        return functools.partial(grist_call, document=document)
+
+    measured = upstream_call("grist")(fn)
+
+    @functools.wraps(fn)
+    def _wrapped(self, *args, **kwargs):
+        try:
+            return get_request_scheduler().call(self.document_key(), measured, self, *args, **kwargs)
+        except HTTPError as e:
+            if document is False or e.response is None or e.response.status_code != 404:
+                raise
+            if not self.resolve_document_id():
+                raise
+
+        return get_request_scheduler().call(self.document_key(), measured, self, *args, **kwargs)
+
+    return _wrapped
 
 
 class GristClient:
+    """
+    Grist client for a single document. The document ID is resolved on first use, from
+    the bootstrap state file if it was resolved before or by listing the team workspaces.
+    """
 
     def __init__(self, settings: GristConfig):
         self.settings = settings
-        self.document_id = None
+        self._document_id = None
         self._client = GristApi(self.build_config())
 
+    @property
+    def document_id(self) -> str:
+
+        state = get_bootstrap_state()
+        state_key = self.document_key()
+
+        if self._document_id is not None:
+            # another process might have resolved the document again, see 'resolve_document_id'
+            state.refresh()
+            self._document_id = state.get_document_id(state_key) or self._document_id
+
+        if self._document_id is None:
+            self._document_id = state.get_document_id(state_key)
+            if self._document_id is None:
+                self.set_document_id()
+                if self._document_id is None:
+                    raise ValueError(f"document '{self.settings.document_name}' not found "
+                                     f"for team '{self.settings.team_name}'")
+                state.set_document_id(state_key, self._document_id)
+
+        return self._document_id
+
+    def resolve_document_id(self) -> bool:
+        """
+        look up the document ID again after a request for the cached ID was answered with 404,
+        e.g. because the document was recreated
+
+        Returns
+        -------
+        bool
+            True if the document has another ID now
+        """
+
+        state = get_bootstrap_state()
+        state_key = self.document_key()
+        stale_document_id = self._document_id
+
+        state.refresh()
+        stored_document_id = state.get_document_id(state_key)
+        if stored_document_id is not None and stored_document_id != stale_document_id:
+            self._document_id = stored_document_id
+            return True
+
+        if time.monotonic() - _document_lookups.get(state_key, -document_lookup_interval_seconds) \
+                < document_lookup_interval_seconds:
+            return False
+        _document_lookups[state_key] = time.monotonic()
+
+        logger.warning(f"Grist document '{self.settings.document_name}' not found with ID {stale_document_id}, "
+                       f"looking it up again")
+
+        self._document_id = None
+        state.forget_document_id(state_key)
+
         self.set_document_id()
-        if self.document_id is None:
-            raise ValueError(f"document '{self.settings.document_name}' not found for team '{self.settings.team_name}'")
+        if self._document_id is None:
+            raise ValueError(f"document '{self.settings.document_name}' not found "
+                             f"for team '{self.settings.team_name}'")
+        state.set_document_id(state_key, self._document_id)
+
+        return self._document_id != stale_document_id
+
+    def document_key(self) -> str:
+        return get_bootstrap_state().document_key(self.settings.host_name, self.settings.team_name,
+                                                  self.settings.document_name)
 
     def build_config(self):
 
         return {
             "GRIST_API_KEY": self.settings.api_key.get_secret_value(),
             "GRIST_SELF_MANAGED": "Y",
-            "GRIST_SELF_MANAGED_HOME": f"https://{self.settings.host_name}",
+            "GRIST_SELF_MANAGED_HOME": build_base_url(self.settings.host_name),
             "GRIST_SELF_MANAGED_SINGLE_ORG": "Y",
             "GRIST_TEAM_SITE": self.settings.team_name
         }
@@ -33,26 +141,52 @@ class GristClient:
         for workspace in workspace_data or list():
             for doc in workspace.get("docs", {}):
                 if doc.get("name") == self.settings.document_name:
-                    self.document_id = doc.get("urlId")
+                    self._document_id = doc.get("urlId")
                     return
 
+    @grist_call(document=False)
     def list_workspaces(self):
         return self._client.list_workspaces(self.settings.team_name)
 
+    @grist_call
     def list_tables(self):
         return self._client.list_tables(self.document_id)
 
+    @grist_call
     def list_cols(self, table_id: str):
         return self._client.list_cols(table_id, doc_id=self.document_id)
 
+    @grist_call
     def list_records(self, table_id: str, filter_option: Dict):
         return self._client.list_records(table_id=table_id, filter=filter_option, doc_id=self.document_id)
 
+    @grist_call
+    def list_table_data(self, table_id: str):
+        """column oriented table data: column ID -> list of values, including the row 'id' column"""
+        _, server = self._client.configurator.select_params(self.document_id, "")
+        return self._client.apicaller.apicall(f"{server}/docs/{self.document_id}/tables/{table_id}/data")
+
+    @grist_call
     def add_table(self, data: Dict):
         return self._client.add_tables(tables=[data], doc_id=self.document_id)
 
+    @grist_call
+    def add_tables(self, data: List[Dict]):
+        return self._client.add_tables(tables=data, doc_id=self.document_id)
+
+    @grist_call
     def add_cols(self, table_id: str, data: List[Dict]):
         return self._client.add_cols(table_id=table_id, cols=data, doc_id=self.document_id)
 
+    @grist_call
     def add_record(self, table_id: str, record: Dict):
         return self._client.add_records(table_id=table_id, records=[record], doc_id=self.document_id)
+
+    @grist_call
+    def add_update_records(self, table_id: str, records: List[Dict], noadd: bool = False, noupdate: bool = False):
+        """
+        add or update records, each record is a dict with 'require' and 'fields'.
+        'noadd' only updates existing records, 'noupdate' only adds missing records.
+        """
+        return self._client.add_update_records(table_id=table_id, records=records, noadd=noadd, noupdate=noupdate,
+                                               doc_id=self.document_id)
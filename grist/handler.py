@@ -1,37 +1,34 @@
+import functools
 import json
 import logging
-from typing import List
+from datetime import datetime
+from typing import Any, Callable, Dict, List, Optional, Sequence, Tuple
 
-from app.lib import grab
 from app.lib import time_cache
-from app.models import InternalWebhookContent, InternalWebhookField
+from app.models import InternalWebhookContent, InternalWebhookField, InternalWebhookSchema
 from app.settings import get_settings
 from grist.client import GristClient
-from grist.models import GristColumn, GristTable
+from grist.models import GristColumn, GristExport, GristTable
+from grist.schema import get_schema, invalidate_schema
 
 logger = logging.getLogger(__name__)
 
 registration_id_column_name = "Registration ID"
+registration_id_column_id = "regID"
+paid_column_id = "paid"
 
+# rows are written while a response is still in progress, they are identified by the
+# Formbricks response ID and marked as partial until the response is finished
+response_id_column_id = "responseID"
+response_status_column_id = "responseStatus"
+response_status_partial = "partial"
+response_status_finished = "finished"
 
-def add_webhook_row(data: InternalWebhookContent, grist: GristClient) -> InternalWebhookContent:
 
-    logger.info("requesting grist")
-
-    grist_status, grist_tables = grist.list_tables()
-    if grist_status != 200:
-        raise ValueError(f"Unable to request Grist table list (status: {grist_status}): {grist_tables}")
-
-    existing_table_name = None
-
-    # find an existing table
-    for table in grist_tables or list():
-        if table.get("id") == data.survey_name.replace(" ", "_"):
-            existing_table_name = table.get("id")
-            break
+def build_table(table_name: str, fields: Sequence[InternalWebhookField]) -> GristTable:
 
     table_column_registration_id = GristColumn(
-        id='regID',
+        id=registration_id_column_id,
         fields={
             'label': registration_id_column_name,
             'type': 'Int',
@@ -41,7 +38,7 @@ def add_webhook_row(data: InternalWebhookContent, grist: GristClient) -> Interna
     )
 
     table_column_paid = GristColumn(
-        id='paid',
+        id=paid_column_id,
         fields={
             'label': 'Paid',
             'type': 'Choice',
@@ -62,11 +59,11 @@ def add_webhook_row(data: InternalWebhookContent, grist: GristClient) -> Interna
     )
 
     table_data = GristTable(
-        id=data.survey_name
+        id=table_name
     )
 
     table_data.columns.append(table_column_registration_id)
-    for question in data.data or list():
+    for question in fields or list():
         table_data.columns.append(GristColumn(
                 id=question.id,
                 fields={
@@ -77,103 +74,248 @@ def add_webhook_row(data: InternalWebhookContent, grist: GristClient) -> Interna
         )
 
     table_data.columns.append(table_column_paid)
+    table_data.columns.append(GristColumn(
+        id=response_id_column_id,
+        fields={"label": "Response ID", "type": "Text"}
+    ))
+    table_data.columns.append(GristColumn(
+        id=response_status_column_id,
+        fields={"label": "Response Status", "type": "Text"}
+    ))
+
+    return table_data
+
+
+def response_record(data: InternalWebhookContent) -> Dict:
+    """Grist record of a finished response, including the response ID and status columns"""
+
+    record_data = data.as_record()
+    record_data[response_id_column_id] = data.webhook_id
+    record_data[response_status_column_id] = response_status_finished
+
+    return record_data
+
+
+def ensure_table(grist: GristClient, table_data: GristTable) -> str:
+    """
+    create the table if it doesn't exist yet or add all missing columns to the existing table
+
+    Returns
+    -------
+    str
+        the Grist table ID
+    """
+
+    return get_schema(grist).ensure(grist, [table_data])[table_data.id]
 
-    # create new table
-    if existing_table_name is None:
-        grist.add_table(table_data.model_dump())
-    else:
-        grist_status, existing_table_data = grist.list_cols(existing_table_name)
 
-        if grist_status != 200:
-            raise ValueError(f"Unable to request Grist columns (status: {grist_status}): {existing_table_data}")
+def write_response_row(grist: GristClient, table_id: str, require: Dict, fields: Dict, **options):
+    """add or update the row of a response, see GristClient.add_update_records for the options"""
 
-        columns_to_add = list()
+    try:
+        grist_status, response = grist.add_update_records(table_id, [{"require": require, "fields": fields}],
+                                                          **options)
+    except Exception:
+        # the cached schema might be outdated, request it again on next try
+        invalidate_schema(grist)
+        raise
 
-        existing_table_data_ids = [x.get("id") for x in existing_table_data]
-        for column in table_data.columns:
-            if column.id not in existing_table_data_ids:
-                columns_to_add.append(column.model_dump())
+    if not 200 <= grist_status <= 299:
+        raise ValueError(f"Unable to write Grist record (status: {grist_status}): {response}")
 
-        # add missing columns to existing table
-        if len(columns_to_add) > 0:
-            grist.add_cols(existing_table_name, columns_to_add)
 
-    # add record data to table
-    record_data = {x.id: x.value for x in data.data}
+def upsert_webhook_row(data: InternalWebhookContent, grist: GristClient, table_name: str = None, finished: bool = True,
+                       row_exists: bool = False) -> Tuple[InternalWebhookContent, Optional[int]]:
+    """
+    write the fields of a response to its row, identified by the response ID. The row is
+    created if it doesn't exist yet, fields which are not part of 'data' are left untouched.
+    Finished responses are read back with all columns, including the registration ID.
 
-    grist_status, record_ids = grist.add_record(existing_table_name, record_data)
+    Partial writes never set a finished row back to partial: the partial status is only
+    set when the row is created, 'row_exists' skips that request. Rows which were finished
+    in the meantime, e.g. by another worker, are left untouched.
 
-    if not 200 >= grist_status <= 299:
-        raise ValueError(f"Unable to add Grist record to table (status: {grist_status}): {record_ids}")
+    Returns
+    -------
+    tuple
+        the written response, as read back for finished responses, and the Grist row ID,
+        None for partial writes which are not read back
+    """
 
-    grist_status, records = grist.list_records(existing_table_name, {"id": record_ids})
+    table_data = build_table(table_name or data.survey_name, data.schema.fields)
+
+    table_id = ensure_table(grist, table_data)
+
+    require = {response_id_column_id: data.webhook_id}
+
+    if finished is False:
+        if row_exists is False:
+            write_response_row(grist, table_id, require, {response_status_column_id: response_status_partial},
+                               noupdate=True)
+
+        write_response_row(grist, table_id, {**require, response_status_column_id: response_status_partial},
+                           data.as_record(), noadd=True)
+
+        logger.info(f"partial response written - ID: {data.webhook_id}")
+        return data, None
+
+    write_response_row(grist, table_id, require, response_record(data))
+
+    grist_status, records = grist.list_records(table_id, {response_id_column_id: [data.webhook_id]})
 
     if grist_status != 200:
-        raise ValueError(f"Unable to request newly added Grist record (status: {grist_status}): {records}")
+        raise ValueError(f"Unable to request Grist record (status: {grist_status}): {records}")
 
     if len(records) != 1:
-        raise ValueError(f"record returned for latest added id has len of {len(records)}")
+        raise ValueError(f"records returned for response ID {data.webhook_id} has len of {len(records)}")
+
+    # the row might contain fields written by earlier partial updates, use all table columns
+    table_columns = get_schema(grist).columns(grist, table_id)
+    table_schema = InternalWebhookSchema.get(
+        tuple((k, v.get("label"), v.get("type")) for k, v in table_columns.items()))
+
+    logger.info(f"response finished - ID: {data.webhook_id}")
+
+    return InternalWebhookContent(
+        webhook_id=data.webhook_id,
+        survey_id=data.survey_id,
+        survey_name=data.survey_name,
+        schema=table_schema,
+        values=tuple(records[0].get(x) or "" for x in table_schema.ids)
+    ), records[0].get("id")
+
+
+def upsert_webhook_rows(data: List[InternalWebhookContent], grist: GristClient, table_id: str):
+    """
+    write a batch of finished responses to an existing table with a single request, rows
+    are identified by the response ID like in 'upsert_webhook_row', so responses already
+    stored by the pipeline are updated instead of added twice. The table schema needs to
+    be prepared with 'ensure_table' beforehand. Records are not read back.
+    """
+
+    if len(data) == 0:
+        return
 
-    data.data = list()
-    for column in table_data.columns:
-        data.data.append(InternalWebhookField(
-            id=column.id,
-            value=records[0].get(column.id) or "",
-            label=column.fields.get("label"),
-            type=column.fields.get("type")
-        ))
+    grist_status, response = grist.add_update_records(table_id, [{
+        "require": {response_id_column_id: item.webhook_id},
+        "fields": response_record(item)
+    } for item in data])
 
-    logger.info(f"request finished - ID: {data.webhook_id}")
+    if not 200 <= grist_status <= 299:
+        raise ValueError(f"Unable to write Grist records to table (status: {grist_status}): {response}")
 
-    return data
+
+@functools.lru_cache(maxsize=8192)
+def format_date(value: Any) -> str:
+    return datetime.fromtimestamp(value).strftime("%Y-%m-%d")
+
+
+def column_converter(column_type: str) -> Callable[[List], List[str]]:
+    """returns a function converting all values of a column to strings, like InternalWebhookField.value_as_str"""
+
+    if column_type == "Date":
+        return lambda values: [format_date(x) if isinstance(x, (int, float)) else str(x) for x in values]
+
+    return lambda values: [x if type(x) is str else str(x) for x in values]
+
+
+def build_export(labels: List[str], table_columns: Dict[str, Dict], column_values: Dict[str, List]) -> GristExport:
+    """
+    build the public list from column oriented table data
+
+    Parameters
+    ----------
+    labels: list
+        column labels to list
+    table_columns: dict
+        column ID -> column fields
+    column_values: dict
+        column ID -> values, including the row IDs as 'id'
+    """
+
+    row_ids = column_values.get("id") or list()
+    row_count = len(row_ids)
+
+    # columns defined in public list setting, a later column with the same label wins
+    column_by_label = dict()
+    for column_id, column_fields in table_columns.items():
+        column_label = column_fields.get("label")
+        if column_label in labels:
+            column_by_label[column_label] = (column_id, column_fields)
+
+    columns = list()
+    for label in labels:
+        if label not in column_by_label:
+            columns.append([None] * row_count)
+            continue
+
+        column_id, column_fields = column_by_label[label]
+        convert = column_converter(column_fields.get("type"))
+        columns.append(convert(column_values.get(column_id) or [None] * row_count))
+
+    # skip empty entries, the registration ID is always set
+    content_columns = [x for label, x in zip(labels, columns)
+                       if label != registration_id_column_name and label in column_by_label]
+    if len(content_columns) == 0:
+        return GristExport(labels, [list() for _ in labels], list())
+
+    keep = [any(row) for row in zip(*content_columns)]
+
+    # responses still in progress are not listed
+    status_values = column_values.get(response_status_column_id)
+    if status_values is not None:
+        keep = [k and x != response_status_partial for k, x in zip(keep, status_values)]
+
+    if not all(keep):
+        columns = [[x for x, k in zip(column, keep) if k] for column in columns]
+        row_ids = [x for x, k in zip(row_ids, keep) if k]
+
+    return GristExport(labels, columns, list(row_ids))
 
 
 @time_cache(20)
-def grist_export(grist_client: GristClient) -> List:
+def grist_export(grist_client: GristClient) -> GristExport:
 
     settings = get_settings().grist
 
-    return_data = []
-    column_data = list()
+    labels = settings.public_list_columns
+    empty_export = GristExport(labels, [list() for _ in labels])
+
+    if len(labels) == 0:
+        return empty_export
 
-    if len(settings.public_list_columns) == 0:
-        return return_data
+    table_id = settings.table_name.replace(" ", "_")
 
-    status_code, table_data = grist_client.list_cols(settings.table_name.replace(" ", "_"))
+    status_code, table_data = grist_client.list_cols(table_id)
 
     if status_code >= 300:
-        return return_data
+        return empty_export
 
-    status_code, records = grist_client.list_records(settings.table_name.replace(" ", "_"), filter_option={})
+    status_code, column_values = grist_client.list_table_data(table_id)
 
     if status_code >= 300:
-        return return_data
+        return empty_export
 
-    # iterate over columns and keep only the ones defined in public list setting
-    for column in table_data:
-        column_label = grab(column, "fields.label")
-        if column_label not in settings.public_list_columns:
-            continue
-        column_data.append(InternalWebhookField(
-            id=column.get("id"),
-            label=column_label,
-            type=grab(column, "fields.type")
-        ))
-
-    ignored_not_empty_keys = [
-        registration_id_column_name
-    ]
-
-    for record in records:
-        item = {}
-        for column in column_data:
-            column.value = record.get(column.id)
-            item[column.label] = column.value_as_str()
-
-        # skip empty entries
-        if len("".join([item.get(x) for x in item.keys() if x not in ignored_not_empty_keys])) == 0:
-            continue
+    return build_export(labels, {x.get("id"): x.get("fields") or dict() for x in table_data}, column_values)
+
+
+def patch_export(export: GristExport, table_columns: Dict[str, Dict], records: List[Dict]) -> GristExport:
+    """
+    apply changed records as sent by a Grist webhook to an export, records which are
+    not listed anymore (partial or emptied) are removed
+
+    Parameters
+    ----------
+    export: GristExport
+        export to patch
+    table_columns: dict
+        column ID -> column fields
+    records: list
+        changed records, column ID -> value including the row ID as 'id'
+    """
+
+    column_values = {x: [record.get(x) for record in records] for x in ["id", *table_columns.keys()]}
 
-        return_data.append({x: item.get(x) for x in settings.public_list_columns})
+    changed = build_export(export.labels, table_columns, column_values)
 
-    return return_data
+    return export.patch(changed, removed_row_ids=column_values["id"])
@@ -1,4 +1,5 @@
-from typing import Dict, List
+import json
+from typing import Dict, Iterable, List, Optional, Tuple
 
 from pydantic import BaseModel
 
@@ -11,3 +12,76 @@ class GristColumn(BaseModel):
 class GristTable(BaseModel):
     id: str = ""
     columns: List[GristColumn] = list()
+
+
+class GristSchemaPlan(BaseModel):
+    """minimal set of schema changes to apply to a Grist document"""
+    add_tables: List[GristTable] = list()
+    add_cols: Dict[str, List[GristColumn]] = dict()
+
+    def is_empty(self) -> bool:
+        return len(self.add_tables) == 0 and len(self.add_cols) == 0
+
+
+class GristTarget(BaseModel):
+    """Grist team, document and table registrations of a survey are written to"""
+    team_name: str = ""
+    document_name: str = ""
+    table_name: Optional[str] = None
+
+    def key(self) -> Tuple[str, str]:
+        return self.team_name, self.document_name
+
+
+class GristExport:
+    """
+    column oriented public list export: one list of string values per label, all of the
+    same length. Rows are only assembled when the export is serialized. The Grist row ID
+    of every row is kept, so single rows can be patched.
+    """
+
+    __slots__ = ("labels", "columns", "row_ids")
+
+    def __init__(self, labels: List[str], columns: List[List[Optional[str]]], row_ids: List[int] = None):
+        self.labels = labels
+        self.columns = columns
+        self.row_ids = row_ids if row_ids is not None else list(range(1, len(self) + 1))
+
+    def __len__(self) -> int:
+        return len(self.columns[0]) if len(self.columns) > 0 else 0
+
+    def rows(self) -> List[Dict[str, Optional[str]]]:
+        return [dict(zip(self.labels, row)) for row in zip(*self.columns)]
+
+    def to_json(self) -> str:
+        return json.dumps(self.rows(), ensure_ascii=False, separators=(",", ":"))
+
+    def to_csv(self) -> str:
+
+        def csv_line(values) -> str:
+            return '"' + '","'.join([(x or "").replace('"', '\\"') for x in values]) + '"'
+
+        return "\n".join([csv_line(self.labels)] + [csv_line(row) for row in zip(*self.columns)])
+
+    def patch(self, export: "GristExport", removed_row_ids: Iterable[int] = ()) -> "GristExport":
+        """
+        returns a new export with the rows of 'export' replacing the rows with the same
+        row ID, rows with a new row ID are added in row ID order and 'removed_row_ids' are removed
+        """
+
+        rows = dict(zip(self.row_ids, zip(*self.columns)))
+        for row_id in removed_row_ids:
+            rows.pop(row_id, None)
+        rows.update(zip(export.row_ids, zip(*export.columns)))
+
+        row_ids = sorted(rows)
+        columns = [list(x) for x in zip(*[rows[x] for x in row_ids])] or [list() for _ in self.labels]
+
+        return GristExport(self.labels, columns, row_ids)
+
+    def dump(self) -> str:
+        return json.dumps([self.labels, self.columns, self.row_ids])
+
+    @classmethod
+    def load(cls, data: str) -> "GristExport":
+        return cls(*json.loads(data))
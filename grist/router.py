@@ -0,0 +1,58 @@
+import logging
+import threading
+from typing import Dict, Tuple
+
+from grist.client import GristClient
+from grist.models import GristTarget
+from grist.settings import GristConfig
+
+logger = logging.getLogger(__name__)
+
+
+class GristRouter:
+    """
+    maps Formbricks surveys to Grist targets and keeps one client per team and document.
+    Clients, and with them the resolved document IDs, are created on first use, which
+    might block while the document ID is looked up.
+    """
+
+    def __init__(self, settings: GristConfig, default_client: GristClient = None):
+        self.settings = settings
+        self._clients: Dict[Tuple[str, str], GristClient] = dict()
+        self._lock = threading.Lock()
+
+        if default_client is not None:
+            self._clients[self.default_target().key()] = default_client
+
+    def default_target(self) -> GristTarget:
+        return GristTarget(team_name=self.settings.team_name, document_name=self.settings.document_name)
+
+    def target(self, survey_id: str) -> GristTarget:
+
+        route = self.settings.routes.get(survey_id)
+        if route is None:
+            return self.default_target()
+
+        return GristTarget(
+            team_name=route.team_name or self.settings.team_name,
+            document_name=route.document_name or self.settings.document_name,
+            table_name=route.table_name
+        )
+
+    def client(self, target: GristTarget) -> GristClient:
+
+        with self._lock:
+            client = self._clients.get(target.key())
+
+            if client is None:
+                logger.info(f"connecting to Grist document '{target.document_name}' of team '{target.team_name}'")
+
+                client = GristClient(self.settings.model_copy(update={
+                    "team_name": target.team_name,
+                    "document_name": target.document_name
+                }))
+                # resolve the document ID before the client is handed to pool workers
+                _ = client.document_id
+                self._clients[target.key()] = client
+
+            return client
@@ -0,0 +1,245 @@
+import contextlib
+import fcntl
+import logging
+import os
+import threading
+import time
+from typing import Dict, Iterator, List, Optional
+
+from app import coordination
+from app.bootstrap import get_bootstrap_state
+from grist.client import GristClient
+from grist.models import GristColumn, GristSchemaPlan, GristTable
+
+logger = logging.getLogger(__name__)
+
+
+def get_table_id(table_name: str) -> str:
+    return table_name.replace(" ", "_")
+
+
+class GristSchema:
+    """
+    indexed view of all tables and their columns of a Grist document.
+
+    Tables are loaded with a single request, columns are loaded lazily per table
+    the first time they are needed. All lookups are dict based. Changes are written
+    to the bootstrap state, so new workers can start with the known schema.
+    """
+
+    def __init__(self, document_id: str):
+        self.document_id = document_id
+        self.loaded_at = time.monotonic()
+        self.tables: Dict[str, Optional[Dict[str, Dict]]] = dict()
+        self.aliases: Dict[str, str] = dict()
+        self.lock = threading.RLock()
+        self.changed = False
+        # version of the schema in the bootstrap state this schema is based on
+        self.saved_at = 0.0
+
+    def restore(self, max_age: float) -> bool:
+        """use the schema from the bootstrap state if it isn't older than 'max_age' seconds"""
+
+        stored_schema = get_bootstrap_state().get_schema(self.document_id, max_age)
+        if stored_schema is None:
+            return False
+
+        self.tables = stored_schema.get("tables") or dict()
+        self.aliases = stored_schema.get("aliases") or dict()
+        self.loaded_at = time.monotonic() - (time.time() - stored_schema.get("loaded_at"))
+        self.saved_at = stored_schema.get("saved_at", 0)
+
+        return True
+
+    def save(self):
+        if self.changed is False:
+            return
+
+        try:
+            self.saved_at = get_bootstrap_state().set_schema(
+                self.document_id, self.tables, self.aliases, loaded_at=time.time() - (time.monotonic() - self.loaded_at))
+        except Exception as e:
+            logger.warning(f"unable to save Grist schema to bootstrap state: {e}")
+
+        self.changed = False
+
+    def load(self, grist: GristClient):
+
+        grist_status, grist_tables = grist.list_tables()
+        if grist_status != 200:
+            raise ValueError(f"Unable to request Grist table list (status: {grist_status}): {grist_tables}")
+
+        self.tables = {x.get("id"): None for x in grist_tables or list()}
+        self.loaded_at = time.monotonic()
+        self.changed = True
+
+    def resolve(self, table_id: str) -> str:
+        """returns the table ID Grist assigned to a table which was requested as 'table_id'"""
+        table_id = get_table_id(table_id)
+        return self.aliases.get(table_id, table_id)
+
+    def has_table(self, table_id: str) -> bool:
+        return self.resolve(table_id) in self.tables
+
+    def columns(self, grist: GristClient, table_id: str) -> Dict[str, Dict]:
+
+        table_id = self.resolve(table_id)
+
+        if self.tables.get(table_id) is None:
+            grist_status, table_columns = grist.list_cols(table_id)
+
+            if grist_status != 200:
+                raise ValueError(f"Unable to request Grist columns (status: {grist_status}): {table_columns}")
+
+            self.tables[table_id] = {x.get("id"): x.get("fields") or dict() for x in table_columns}
+            self.changed = True
+
+        return self.tables[table_id]
+
+    def observe_records(self, table_id: str, records: List[Dict]):
+        """update the layout with the columns of records sent by a Grist webhook"""
+
+        table_id = self.resolve(table_id)
+        column_ids = {x for record in records for x in record.keys()} - {"id", "manualSort"}
+
+        with self.lock:
+            if table_id not in self.tables:
+                self.tables[table_id] = None
+                self.changed = True
+            elif self.tables[table_id] is not None and not column_ids.issubset(self.tables[table_id].keys()):
+                # columns were added in Grist, they are loaded again on next use
+                logger.info(f"columns of Grist table {table_id} changed")
+                self.tables[table_id] = None
+                self.changed = True
+
+            self.save()
+
+    def plan(self, grist: GristClient, tables: List[GristTable]) -> GristSchemaPlan:
+        """
+        compute the minimal set of tables and columns to add, so all requested tables
+        and columns exist. Requested tables with the same ID are merged.
+        """
+
+        requested: Dict[str, Dict[str, GristColumn]] = dict()
+        for table in tables:
+            table_columns = requested.setdefault(get_table_id(table.id), dict())
+            for column in table.columns:
+                table_columns.setdefault(column.id, column)
+
+        plan = GristSchemaPlan()
+        for table_id, table_columns in requested.items():
+
+            if not self.has_table(table_id):
+                plan.add_tables.append(GristTable(id=table_id, columns=list(table_columns.values())))
+                continue
+
+            existing_columns = self.columns(grist, table_id)
+            columns_to_add = [x for x in table_columns.values() if x.id not in existing_columns]
+
+            if len(columns_to_add) > 0:
+                plan.add_cols[self.resolve(table_id)] = columns_to_add
+
+        return plan
+
+    def apply(self, grist: GristClient, plan: GristSchemaPlan):
+        """apply a schema plan with one request for all new tables and one request per changed table"""
+
+        self.changed = True
+
+        if len(plan.add_tables) > 0:
+            logger.info(f"adding Grist tables: {', '.join([x.id for x in plan.add_tables])}")
+
+            grist_status, table_ids = grist.add_tables([x.model_dump() for x in plan.add_tables])
+
+            if grist_status != 200:
+                raise ValueError(f"Unable to add Grist tables (status: {grist_status}): {table_ids}")
+
+            for table, table_id in zip(plan.add_tables, table_ids):
+                if table_id != table.id:
+                    self.aliases[table.id] = table_id
+                self.tables[table_id] = {x.id: x.fields for x in table.columns}
+
+        for table_id, columns in plan.add_cols.items():
+            logger.info(f"adding columns to Grist table {table_id}: {', '.join([x.id for x in columns])}")
+
+            grist_status, column_ids = grist.add_cols(table_id, [x.model_dump() for x in columns])
+
+            if grist_status != 200:
+                raise ValueError(f"Unable to add Grist columns to table {table_id} (status: {grist_status}): "
+                                 f"{column_ids}")
+
+            self.tables[table_id].update({x.id: x.fields for x in columns})
+
+    @contextlib.contextmanager
+    def change_lock(self) -> Iterator[None]:
+        """lock per document shared by all workers, a coordination lease if enabled, a file lock otherwise"""
+
+        if coordination.get_coordinator() is not None:
+            with coordination.lease(f"grist-schema:{self.document_id}"):
+                yield
+            return
+
+        lock_dir = os.path.dirname(get_bootstrap_state().file_name) or "."
+        os.makedirs(lock_dir, exist_ok=True)
+
+        # closing the file releases the lock
+        with open(os.path.join(lock_dir, f"grist-schema-{self.document_id}.lock"), "w") as lock_file:
+            fcntl.flock(lock_file, fcntl.LOCK_EX)
+            yield
+
+    def ensure(self, grist: GristClient, tables: List[GristTable]) -> Dict[str, str]:
+        """
+        make sure all tables and columns exist
+
+        Returns
+        -------
+        dict
+            requested table ID -> Grist table ID
+        """
+
+        with self.lock:
+            plan = self.plan(grist, tables)
+
+            if not plan.is_empty():
+                # other workers might change the schema at the same time, plan again once it's locked
+                with self.change_lock():
+                    self.load(grist)
+                    plan = self.plan(grist, tables)
+                    self.apply(grist, plan)
+
+            self.save()
+
+            return {x.id: self.resolve(x.id) for x in tables}
+
+
+_schemas: Dict[str, GristSchema] = dict()
+_schemas_lock = threading.Lock()
+
+
+def get_schema(grist: GristClient) -> GristSchema:
+    """
+    returns the cached schema of the client's document, reloads it once it is older than 'schema_cache_seconds'
+    or another process saved a newer version, e.g. the API process after a Grist webhook changed the layout
+    """
+
+    state = get_bootstrap_state()
+
+    with _schemas_lock:
+        schema = _schemas.get(grist.document_id)
+
+        if schema is not None and state.refresh() and state.schema_saved_at(grist.document_id) > schema.saved_at:
+            logger.debug(f"Grist schema of document {grist.document_id} was changed by another process")
+            schema = None
+
+        if schema is None or time.monotonic() - schema.loaded_at > grist.settings.schema_cache_seconds:
+            schema = GristSchema(grist.document_id)
+            if not schema.restore(grist.settings.schema_cache_seconds):
+                schema.load(grist)
+            _schemas[grist.document_id] = schema
+
+        return schema
+
+
+def invalidate_schema(grist: GristClient):
+    with _schemas_lock:
+        _schemas.pop(grist.document_id, None)
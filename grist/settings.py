@@ -1,7 +1,9 @@
-from typing import Optional, List, Annotated
+from typing import Optional, List, Annotated, Dict
 
 from pydantic import BaseModel, Field, SecretStr, BeforeValidator
 
+from app.limits import LimitConfig
+
 
 def string_to_list(value: str) -> List[str]:
     if not isinstance(value, str):
@@ -10,6 +12,42 @@ def string_to_list(value: str) -> List[str]:
     return [item.strip() for item in value.split(",") if len(item) > 0]
 
 
+class GristRouteConfig(BaseModel):
+
+    team_name: Optional[str] = Field(
+        default=None,
+        description="Grist team name, defaults to the global team name"
+    )
+    document_name: Optional[str] = Field(
+        default=None,
+        description="Grist document to add registrations, defaults to the global document name"
+    )
+    table_name: Optional[str] = Field(
+        default=None,
+        description="Grist table to add registrations, defaults to the survey name"
+    )
+
+
+class GristBudgetConfig(BaseModel):
+    """request budget per Grist document, shared by all workers"""
+
+    requests_per_second: float = Field(
+        default=0,
+        description="requests per second sent to a single document, 0 disables the budget. "
+                    "Answers with status 429 are honoured in any case",
+        ge=0
+    )
+    burst: int = Field(
+        default=20,
+        description="requests which can be sent at once after the budget wasn't used for a while",
+        ge=1
+    )
+    state_file: str = Field(
+        default="state/grist-budget.json",
+        description="file the budget is shared in between workers if coordination is disabled"
+    )
+
+
 class GristConfig(BaseModel):
 
     host_name: str = Field(
@@ -36,3 +74,36 @@ class GristConfig(BaseModel):
         default=[],
         description="comma separated list of colum to list public",
     )
+    public_list_refresh_seconds: int = Field(
+        default=20,
+        description="age in seconds after which the public list snapshot is rendered again",
+        ge=1
+    )
+    webhook_api_token: SecretStr = Field(
+        default="",
+        description="defines a key which Grist webhooks need to pass as 'api_token' url param, "
+                    "Grist webhooks are rejected while it is empty"
+    )
+    public_list_snapshot_dir: str = Field(
+        default="state/public-list",
+        description="directory for the pre-rendered public list snapshots, shared by all workers"
+    )
+    schema_cache_seconds: int = Field(
+        default=300,
+        description="time in seconds the table and column layout of the Grist document is cached",
+        ge=0
+    )
+    routes: Dict[str, GristRouteConfig] = Field(
+        default={},
+        description="JSON object mapping a Formbricks survey ID to a Grist target "
+                    "(team_name, document_name, table_name). Unlisted surveys use the global document"
+    )
+    limits: LimitConfig = Field(
+        default=LimitConfig(),
+        description="adaptive concurrency and circuit breaker settings for Grist requests"
+    )
+    budget: GristBudgetConfig = Field(
+        default=GristBudgetConfig(),
+        description="request budget per Grist document, registration writes are served before exports and "
+                    "health checks"
+    )
@@ -0,0 +1,254 @@
+import contextlib
+import fcntl
+import gzip
+import hashlib
+import json
+import logging
+import os
+import time
+from typing import Dict, Iterator, List, Optional
+
+from app import coordination
+from grist.budget import GristBudgetExceeded, traffic_class
+from grist.client import GristClient
+from grist.handler import grist_export, patch_export
+from grist.models import GristExport
+from grist.schema import get_schema
+from grist.settings import GristConfig
+
+logger = logging.getLogger(__name__)
+
+# file suffix -> media type of the pre-rendered variants
+snapshot_formats = {
+    "json": "application/json",
+    "csv": "text/csv"
+}
+# the export a snapshot was rendered from, kept next to it so it can be patched
+export_suffix = "export"
+
+
+class Snapshot:
+    """a published public list version, all variants are stored next to each other"""
+
+    def __init__(self, directory: str, version: str, created_at: float):
+        self.directory = directory
+        self.version = version
+        self.created_at = created_at
+
+    def path(self, output: str, compressed: bool = False) -> str:
+        return os.path.join(self.directory, f"{self.version}.{output}{'.gz' if compressed else ''}")
+
+    def etag(self, output: str, compressed: bool = False) -> str:
+        return f'"{self.version}-{output}{"-gz" if compressed else ""}"'
+
+
+class SnapshotPublisher:
+    """
+    renders the public list to versioned JSON and CSV files (plain and gzip compressed)
+    and publishes a version by atomically replacing the 'current' pointer file.
+
+    Workers serve the files directly. Once the current snapshot is older than
+    'public_list_refresh_seconds' one worker refreshes it while holding a lock,
+    others keep serving the previous version meanwhile.
+
+    Rows changed in Grist are applied to the current snapshot right away if Grist
+    webhooks are set up, a patched snapshot keeps the age of the full refresh it is based on.
+    """
+
+    def __init__(self, settings: GristConfig):
+        self.settings = settings
+        self.directory = settings.public_list_snapshot_dir
+        self.pointer_file = os.path.join(self.directory, "current")
+        self.snapshot: Optional[Snapshot] = None
+        self.pointer_mtime = None
+        self.served = 0
+        self.refreshes = 0
+        self.patches = 0
+
+        os.makedirs(self.directory, exist_ok=True)
+
+    def read_pointer(self) -> Optional[Snapshot]:
+        """returns the published snapshot, the pointer file is only parsed when it changed"""
+
+        try:
+            mtime = os.stat(self.pointer_file).st_mtime_ns
+        except FileNotFoundError:
+            return None
+
+        if mtime != self.pointer_mtime:
+            with open(self.pointer_file) as f:
+                pointer = json.load(f)
+            self.snapshot = Snapshot(self.directory, pointer["version"], pointer["created_at"])
+            self.pointer_mtime = mtime
+
+        return self.snapshot
+
+    def is_fresh(self, snapshot: Optional[Snapshot]) -> bool:
+        return snapshot is not None and time.time() - snapshot.created_at < self.settings.public_list_refresh_seconds
+
+    def current(self, grist: GristClient) -> Snapshot:
+        """returns the current snapshot, refreshes it first if it's outdated and no other worker does"""
+
+        snapshot = self.read_pointer()
+        if self.is_fresh(snapshot):
+            self.served += 1
+            return snapshot
+
+        # only wait for the refresh of another worker if there is nothing to serve yet
+        with self.refresh_lock(blocking=snapshot is None) as acquired:
+            if acquired is False:
+                self.served += 1
+                return snapshot
+
+            # another worker might have refreshed it while we waited for the lock
+            snapshot = self.read_pointer()
+            if self.is_fresh(snapshot):
+                self.served += 1
+                return snapshot
+
+            try:
+                return self.publish(grist)
+            except GristBudgetExceeded as e:
+                # registration writes use up the Grist request budget, keep serving the outdated list
+                if snapshot is None:
+                    raise
+                logger.warning(f"serving outdated public list snapshot {snapshot.version}: {e}")
+                self.served += 1
+                return snapshot
+
+    @contextlib.contextmanager
+    def refresh_lock(self, blocking: bool) -> Iterator[bool]:
+        """lock shared by all workers, a coordination lease if enabled, a file lock otherwise"""
+
+        coordinator = coordination.get_coordinator()
+
+        if coordinator is not None:
+            lease_name = f"public-list:{self.directory}"
+
+            if blocking is True:
+                with coordinator.lease(lease_name):
+                    yield True
+                return
+
+            owner = coordination.get_owner_id()
+            if not coordinator.acquire_lease(lease_name, owner, coordinator.settings.lease_seconds):
+                yield False
+                return
+
+            try:
+                yield True
+            finally:
+                coordinator.release_lease(lease_name, owner)
+            return
+
+        # closing the file releases the lock
+        with open(os.path.join(self.directory, ".lock"), "w") as lock_file:
+            try:
+                fcntl.flock(lock_file, fcntl.LOCK_EX if blocking else fcntl.LOCK_EX | fcntl.LOCK_NB)
+            except BlockingIOError:
+                yield False
+                return
+
+            yield True
+
+    def publish(self, grist: GristClient) -> Snapshot:
+
+        start_time = time.perf_counter()
+
+        with traffic_class("export"):
+            export = grist_export.__wrapped__(grist)
+        snapshot = self.render(export, time.time())
+        self.refreshes += 1
+
+        logger.info(f"published public list snapshot {snapshot.version} with {len(export)} rows "
+                    f"in {time.perf_counter() - start_time:.3f}s")
+
+        return snapshot
+
+    def patch(self, grist: GristClient, records: List[Dict]) -> Snapshot:
+        """apply records of the public list table changed in Grist to the current snapshot"""
+
+        start_time = time.perf_counter()
+
+        with self.refresh_lock(blocking=True):
+            snapshot = self.read_pointer()
+            export = self.read_export(snapshot)
+
+            # nothing to patch, render the complete list instead
+            if export is None or export.labels != self.settings.public_list_columns:
+                return self.publish(grist)
+
+            schema = get_schema(grist)
+            with traffic_class("export"):
+                table_columns = schema.columns(grist, schema.resolve(self.settings.table_name))
+
+            export = patch_export(export, table_columns, records)
+            snapshot = self.render(export, snapshot.created_at)
+            self.patches += 1
+
+        logger.info(f"patched public list snapshot {snapshot.version} with {len(records)} changed records "
+                    f"in {time.perf_counter() - start_time:.3f}s")
+
+        return snapshot
+
+    def read_export(self, snapshot: Optional[Snapshot]) -> Optional[GristExport]:
+        if snapshot is None:
+            return None
+
+        try:
+            with open(snapshot.path(export_suffix)) as f:
+                return GristExport.load(f.read())
+        except FileNotFoundError:
+            return None
+
+    def render(self, export: GristExport, created_at: float) -> Snapshot:
+        """write all variants of an export and publish them as the current snapshot"""
+
+        rendered: Dict[str, bytes] = {
+            "json": export.to_json().encode("utf-8"),
+            "csv": export.to_csv().encode("utf-8")
+        }
+
+        version = hashlib.sha256(rendered["json"]).hexdigest()[:16]
+        snapshot = Snapshot(self.directory, version, created_at)
+
+        # identical content keeps the files, only the pointer is renewed
+        if not os.path.exists(snapshot.path(export_suffix)):
+            for output, content in rendered.items():
+                self.write(snapshot.path(output), content)
+                self.write(snapshot.path(output, compressed=True), gzip.compress(content, compresslevel=6, mtime=0))
+            # written last, its presence marks a complete snapshot
+            self.write(snapshot.path(export_suffix), export.dump().encode("utf-8"))
+
+        self.write(self.pointer_file, json.dumps({"version": version, "created_at": snapshot.created_at}).encode())
+
+        self.cleanup(keep=version)
+
+        return self.read_pointer()
+
+    @staticmethod
+    def write(file_name: str, content: bytes):
+        temp_file_name = f"{file_name}.{os.getpid()}.tmp"
+        with open(temp_file_name, "wb") as f:
+            f.write(content)
+        os.replace(temp_file_name, file_name)
+
+    def cleanup(self, keep: str):
+        """remove old versions, the previous one is kept for requests still serving it"""
+
+        versions = dict()
+        for file_name in os.listdir(self.directory):
+            if file_name.startswith(".") or file_name.endswith(".tmp") or "." not in file_name:
+                continue
+            version = file_name.split(".", 1)[0]
+            versions[version] = max(versions.get(version, 0), os.stat(os.path.join(self.directory, file_name)).st_mtime)
+
+        outdated = sorted((x for x in versions if x != keep), key=lambda x: versions[x], reverse=True)[1:]
+        for version in outdated:
+            snapshot = Snapshot(self.directory, version, 0)
+            file_names = [snapshot.path(x, compressed) for x in snapshot_formats for compressed in (False, True)]
+            for file_name in file_names + [snapshot.path(export_suffix)]:
+                try:
+                    os.remove(file_name)
+                except FileNotFoundError:
+                    pass
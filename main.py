@@ -1,69 +1,44 @@
 import asyncio
 import json
 import logging
-import time
 import os
 from concurrent.futures import ProcessPoolExecutor
 from contextlib import asynccontextmanager
-from typing import Annotated, Callable, Any
+from typing import Annotated, Dict, List
 from datetime import datetime
 
 from fastapi import FastAPI, Request, HTTPException, Query
-from fastapi.responses import JSONResponse, PlainTextResponse
-
-from app.models import QueueItem, QueueItemWebhookIncoming, QueueItemWebhookStored, QueueItemWebhookNormalized
+from fastapi.responses import FileResponse, JSONResponse, PlainTextResponse, Response
+
+from app import metrics, profiling
+from app.backfill import run_backfill
+from app.bootstrap import validate_upstreams
+from app.coordination import get_coordinator
+from app.models import QueueItemWebhookIncoming
+from app.pipeline import Pipeline
+from app.registrations import get_registration_index
 from app.settings import get_settings
+from app.tracing import TraceExporter
 from formbricks.client import FormbricksClient
-from formbricks.handler import normalize_webhook_content
 from formbricks.models import FormbricksWebhook
 from grist import handler as grist_handler
+from grist.budget import GristBudgetExceeded, traffic_class, traffic_classes
 from grist.client import GristClient
-from grist.handler import add_webhook_row
-from notification.handler import send_email_for_record
-
-
-async def process_requests(q: asyncio.Queue, pool: ProcessPoolExecutor):
-
-    while True:
-        item: QueueItem = await q.get()  # Get a request from the queue
-        loop = asyncio.get_running_loop()
-        try:
-            if isinstance(item, QueueItemWebhookIncoming):
-                q.put_nowait(
-                    QueueItemWebhookNormalized(
-                        data=await loop.run_in_executor(pool, normalize_webhook_content, item.data, form_client)
-                    )
-                )
-            elif isinstance(item, QueueItemWebhookNormalized):
-                q.put_nowait(
-                    QueueItemWebhookStored(
-                        data=await loop.run_in_executor(pool, add_webhook_row, item.data, grist)
-                    )
-                )
-            elif isinstance(item, QueueItemWebhookStored):
-                await loop.run_in_executor(pool, send_email_for_record, item.data)
-
-            # await loop.run_in_executor(pool, send_email_for_record, record_id)
-            q.task_done()  # tell the queue that the processing on the task is completed
-        except Exception as e:
-            if isinstance(item.data, FormbricksWebhook):
-                logger.error(f"processing of {item.data.webhookId} failed: {e}")
-            else:
-                logger.error(f"processing of {item.data.webhook_id} failed: {e}")
-            time.sleep(1)
-            item.retries += 1
-            if item.retries <= 3:
-                q.put_nowait(item)
-        logger.debug(f"queue size: {q.qsize()}")
+from grist.router import GristRouter
+from grist.schema import get_schema
+from grist.snapshot import SnapshotPublisher, snapshot_formats
 
 
 @asynccontextmanager
 async def lifespan(_: FastAPI):
-    q = asyncio.Queue()  # note that asyncio.Queue() is not thread safe
-    pool = ProcessPoolExecutor()
-    # noinspection PyAsyncCall
-    asyncio.create_task(process_requests(q, pool))  # Start the requests processing task
-    yield {'q': q, 'pool': pool}
+    # pool workers start an idle sampler thread which only runs while a profile is requested
+    pool = ProcessPoolExecutor(initializer=profiling.init_worker, initargs=(profiler.control,))
+    pipeline = Pipeline(form_client, grist_router, pool, trace_exporter, get_coordinator(), get_registration_index())
+    pipeline.start()  # Start the requests processing tasks
+    validation = asyncio.create_task(validate_upstreams(form_client, grist_router))
+    yield {'pipeline': pipeline, 'pool': pool}
+    validation.cancel()
+    await pipeline.stop()
     pool.shutdown()  # free any resources that the pool is using when the currently pending futures are done executing
 
 
@@ -93,17 +68,34 @@ app = FastAPI(
     lifespan=lifespan
 )
 
-try:
-    form_client = FormbricksClient(settings.formbricks)
-except Exception as error:
-    logger.error(f"failed to connect to Formbricks: {error}")
-    exit(1)
+backfill_tasks: Dict[str, asyncio.Future] = dict()
+trace_exporter = TraceExporter(settings.tracing)
+
+# upstream connections are established lazily and validated in the background after startup
+form_client = FormbricksClient(settings.formbricks)
+grist_router = GristRouter(settings.grist)
+
+
+def default_grist_client() -> GristClient:
+    return grist_router.client(grist_router.default_target())
+
+
+snapshot_publisher = SnapshotPublisher(settings.grist)
+profiler = profiling.Profiler()
+
 
-try:
-    grist = GristClient(settings.grist)
-except Exception as error:
-    logger.error(f"failed to connect to grist: {error}")
-    exit(1)
+def public_list_cache_stats():
+    return {("hit",): snapshot_publisher.served, ("miss",): snapshot_publisher.refreshes,
+            ("patch",): snapshot_publisher.patches}
+
+
+def public_list_cache_ratio():
+    requests_total = snapshot_publisher.served + snapshot_publisher.refreshes
+    return {(): round(snapshot_publisher.served / max(requests_total, 1), 4)}
+
+
+metrics.public_list_cache.callback = public_list_cache_stats
+metrics.public_list_cache_ratio.callback = public_list_cache_ratio
 
 
 # ========================
@@ -133,6 +125,48 @@ async def get_config(request: Request):
         **json.loads(settings.model_dump_json())}
 
 
+@app.post("/backfill/{survey_id}")
+async def start_backfill(request: Request, survey_id: str, restart: Annotated[bool, Query()] = False):
+    """
+    replay all responses of a survey into Grist in the background
+    """
+    if "localhost" not in request.headers.get("host", ""):
+        raise HTTPException(status_code=403, detail="403 - forbidden")
+
+    if survey_id in backfill_tasks and not backfill_tasks[survey_id].done():
+        raise HTTPException(status_code=409, detail=f"backfill for survey {survey_id} is already running")
+
+    def backfill():
+        target = grist_router.target(survey_id)
+        return run_backfill(survey_id, form_client, grist_router.client(target), settings.backfill,
+                            restart=restart, table_name=target.table_name)
+
+    backfill_tasks[survey_id] = asyncio.get_running_loop().run_in_executor(None, backfill)
+
+    return JSONResponse(
+        status_code=202,
+        content={"status": "success", "message": f"backfill for survey {survey_id} started"}
+    )
+
+
+@app.get("/backfill/{survey_id}")
+async def get_backfill(request: Request, survey_id: str):
+    if "localhost" not in request.headers.get("host", ""):
+        raise HTTPException(status_code=403, detail="403 - forbidden")
+
+    task = backfill_tasks.get(survey_id)
+    if task is None:
+        raise HTTPException(status_code=404, detail=f"no backfill for survey {survey_id} found")
+
+    if not task.done():
+        return {"status": "running"}
+
+    if task.exception() is not None:
+        return {"status": "failed", "message": str(task.exception())}
+
+    return {"status": "finished", **task.result()}
+
+
 @app.post("/webhook/formbricks")
 async def handle_formbricks_webhook(request: Request, api_token: Annotated[str | None, Query()] = None):
     """
@@ -162,8 +196,14 @@ async def handle_formbricks_webhook(request: Request, api_token: Annotated[str |
 
         logger.info(f"Webhook event received: {webhook_data.event}")
 
-        if webhook_data.event == "responseFinished":
-            request.state.q.put_nowait(QueueItemWebhookIncoming(data=webhook_data))
+        if webhook_data.event in ("responseCreated", "responseUpdated", "responseFinished"):
+            if not await request.state.pipeline.submit(QueueItemWebhookIncoming(data=webhook_data)):
+                logger.warning(f"intake saturated, rejecting webhook {webhook_data.webhookId}")
+                return JSONResponse(
+                    status_code=503,
+                    content={"status": "error", "message": "503 - too many queued webhooks, retry later"},
+                    headers={"Retry-After": str(settings.queue.retry_after_seconds)}
+                )
         else:
             logger.warning(f"unhandled event type: {webhook_data.event}")
 
@@ -177,49 +217,206 @@ async def handle_formbricks_webhook(request: Request, api_token: Annotated[str |
         raise HTTPException(status_code=500, detail=str(e))
 
 
-@app.get("/public-list")
-async def grist_export(output: Annotated[str | None, Query()] = "json"):
-    return_data = grist_handler.grist_export(grist_client=grist)
+def apply_grist_changes(table_id: str, records: List[Dict]):
+    """update the cached schema, the registration index and the public list with records changed in Grist"""
 
-    csv_line: Callable[[Any], str] = \
-        lambda input_list: str('"' + '","'.join([x.replace('"', '\\"') for x in input_list]) + '"')
+    if len(records) == 0:
+        return
 
-    if output == "csv":
-        csv_data = list()
+    index = get_registration_index()
+    if index is not None:
+        index.update_from_records(records, grist_handler.response_id_column_id,
+                                  grist_handler.registration_id_column_id, grist_handler.paid_column_id,
+                                  grist_handler.response_status_column_id, grist_handler.response_status_finished)
 
-        csv_data.append(csv_line(settings.grist.public_list_columns))
+    grist_client = default_grist_client()
 
-        for item in return_data:
-            csv_data.append(csv_line([item.get(x) for x in settings.grist.public_list_columns]))
+    schema = get_schema(grist_client)
+    schema.observe_records(table_id, records)
 
-        response = PlainTextResponse('\n'.join(csv_data), media_type="text/csv")
-        response.headers["Content-Disposition"] = "attachment; filename=export.csv"
+    if schema.resolve(table_id) == schema.resolve(settings.grist.table_name):
+        snapshot_publisher.patch(grist_client, records)
 
-        return response
 
-    return JSONResponse(return_data)
+@app.post("/webhook/grist")
+async def handle_grist_webhook(request: Request, api_token: Annotated[str | None, Query()] = None,
+                               table_id: Annotated[str | None, Query()] = None):
+    """
+    handle Grist document webhooks of the default document, 'table_id' defaults to the
+    public list table. Grist sends a list of added or updated records.
+    """
+
+    # records are applied to the public list and the registration index, never accept them without a token
+    webhook_api_token = settings.grist.webhook_api_token.get_secret_value()
+    if len(webhook_api_token) == 0 or api_token != webhook_api_token:
+        return JSONResponse(
+            status_code=401,
+            content={"status": "error", "message": "401 - unauthorized"}
+        )
+
+    records = await request.json()
+
+    if not isinstance(records, list) or not all(isinstance(x, dict) and "id" in x for x in records):
+        return JSONResponse(
+            status_code=400,
+            content={"status": "error", "message": "400 - expected a list of records"}
+        )
+
+    table_id = table_id or settings.grist.table_name
+
+    logger.info(f"Grist webhook received for table {table_id} with {len(records)} records")
+
+    try:
+        loop = asyncio.get_running_loop()
+        await loop.run_in_executor(None, apply_grist_changes, table_id, records)
+    except Exception as e:
+        logger.error(f"issue while handling Grist webhook: {e}")
+        raise HTTPException(status_code=500, detail=str(e))
+
+    return JSONResponse(
+        status_code=200,
+        content={"status": "success", "message": "received webhook"}
+    )
+
+
+@app.get("/registration/{response_id}")
+async def get_registration(response_id: str):
+    """
+    registration ID, payment and processing status of a Formbricks response from the
+    local registration index, Grist is not requested
+    """
+
+    index = get_registration_index()
+    if index is None:
+        raise HTTPException(status_code=404, detail="registration index is disabled")
+
+    # a primary key lookup in a local database, faster than handing it to a thread
+    registration = index.get(response_id)
+    if registration is None:
+        raise HTTPException(status_code=404, detail=f"no registration for response {response_id} found")
+
+    return registration
+
+
+@app.get("/public-list")
+async def grist_export(request: Request, output: Annotated[str | None, Query()] = "json"):
+
+    output = "csv" if output == "csv" else "json"
+    compressed = "gzip" in request.headers.get("accept-encoding", "")
+
+    loop = asyncio.get_running_loop()
+    try:
+        snapshot = await loop.run_in_executor(None, lambda: snapshot_publisher.current(default_grist_client()))
+    except GristBudgetExceeded as e:
+        logger.warning(f"unable to render public list: {e}")
+        return JSONResponse(
+            status_code=503,
+            content={"status": "error", "message": "503 - public list not available yet, retry later"},
+            headers={"Retry-After": str(int(traffic_classes["export"].max_wait_seconds))}
+        )
+
+    headers = {
+        "ETag": snapshot.etag(output, compressed),
+        "Vary": "Accept-Encoding"
+    }
+    if compressed is True:
+        headers["Content-Encoding"] = "gzip"
+    if output == "csv":
+        headers["Content-Disposition"] = "attachment; filename=export.csv"
+
+    if request.headers.get("if-none-match") == headers["ETag"]:
+        return Response(status_code=304, headers=headers)
+
+    return FileResponse(snapshot.path(output, compressed), media_type=snapshot_formats[output], headers=headers)
 
 
 @app.get("/health")
-async def health_check():
+async def health_check(request: Request):
+
+    pipeline = request.state.pipeline
+    pipeline.check_saturation(pipeline.intake_depth())
 
     health_status = {
         "status": "healthy",
-        "version": app_version
+        "version": app_version,
+        "queue": {
+            "saturated": pipeline.saturated,
+            "high_watermark": settings.queue.high_watermark,
+            "low_watermark": settings.queue.low_watermark,
+            "depths": {k[0]: v for k, v in pipeline.queue_depths().items()}
+        }
     }
 
+    if pipeline.saturated is True:
+        health_status["status"] = "saturated"
+
     form_client_health = form_client.get_health()
     if form_client_health.get("status") != "ok":
         raise HTTPException(status_code=500, detail=f'Formbricks status \'{form_client_health.get("status")}\'')
 
     try:
-        grist.list_workspaces()
+        # health checks only use spare request budget, registration writes go first
+        with traffic_class("health"):
+            default_grist_client().list_workspaces()
+    except GristBudgetExceeded:
+        health_status["grist"] = "request budget exhausted, check skipped"
     except Exception as e:
         raise HTTPException(status_code=500, detail=f'Grist error \'{e}\'')
 
     return health_status
 
 
+@app.get("/debug/slow")
+async def get_slow_items(request: Request, limit: Annotated[int, Query(ge=1, le=500)] = 20):
+    """slowest recently processed items with their span breakdown"""
+    if "localhost" not in request.headers.get("host", ""):
+        raise HTTPException(status_code=403, detail="403 - forbidden")
+
+    return trace_exporter.slowest(limit)
+
+
+@app.get("/debug/items/{item_id}")
+async def get_item_trace(request: Request, item_id: str):
+    """span breakdown of a recently finished item, 404 while it is still processed"""
+    if "localhost" not in request.headers.get("host", ""):
+        raise HTTPException(status_code=403, detail="403 - forbidden")
+
+    trace = trace_exporter.find(item_id)
+    if trace is None:
+        raise HTTPException(status_code=404, detail=f"no finished item with ID {item_id} found")
+
+    return trace.summary()
+
+
+@app.get("/debug/profile")
+async def get_profile(request: Request, seconds: Annotated[float, Query(gt=0, le=120)] = 10,
+                      interval_ms: Annotated[float, Query(ge=1, le=1000)] = 10,
+                      output: Annotated[str | None, Query()] = "collapsed"):
+    """
+    sampling profile of the API process and the pool workers, as collapsed stacks
+    for flamegraph.pl/speedscope or with 'output=top' as a table of the busiest functions
+    """
+    if "localhost" not in request.headers.get("host", ""):
+        raise HTTPException(status_code=403, detail="403 - forbidden")
+
+    loop = asyncio.get_running_loop()
+    try:
+        profile = await loop.run_in_executor(None, profiler.profile, seconds, interval_ms / 1000)
+    except RuntimeError as e:
+        raise HTTPException(status_code=409, detail=str(e))
+
+    if output == "top":
+        return PlainTextResponse(profiling.top_functions(profile))
+
+    return PlainTextResponse(profiling.collapsed(profile))
+
+
+@app.get("/metrics")
+async def get_metrics():
+    """Prometheus metrics"""
+    return PlainTextResponse(metrics.registry.render(), media_type="text/plain; version=0.0.4")
+
+
 # ========================
 # Application Entry Point
 # ========================
@@ -4,6 +4,7 @@ from email.mime.multipart import MIMEMultipart
 from email.mime.text import MIMEText
 from typing import List
 
+from app.metrics import measure_upstream
 from app.settings import get_settings
 
 logger = logging.getLogger(__name__)
@@ -51,19 +52,22 @@ class MailHandler:
         message.attach(MIMEText(body, 'plain'))
 
         # Connect to the SMTP server and send the email
-        smtp = smtplib.SMTP(self.smtp_server, self.smtp_port)
+        with measure_upstream("smtp", "connect"):
+            smtp = smtplib.SMTP(self.smtp_server, self.smtp_port)
 
         try:
             logger.info("sending email")
-            smtp.starttls()  # Use for TLS encryption
-            # smtp = smtplib.SMTP_SSL(self.smtp_server, self.smtp_port)  # Use for SSL encryption
-            if self.smtp_username is not None and self.smtp_password is not None:
-                logger.debug("authenticated login to mail server")
-                smtp.login(self.smtp_username, self.smtp_password)
-            else:
-                logger.debug("anonymous login to mail server")
-            smtp.sendmail(self.sender_mail, recipients, message.as_string())
-            smtp.quit()
+            with measure_upstream("smtp", "send"):
+                if self.settings.starttls is not False:
+                    smtp.starttls()  # Use for TLS encryption
+                # smtp = smtplib.SMTP_SSL(self.smtp_server, self.smtp_port)  # Use for SSL encryption
+                if self.smtp_username is not None and self.smtp_password is not None:
+                    logger.debug("authenticated login to mail server")
+                    smtp.login(self.smtp_username, self.smtp_password)
+                else:
+                    logger.debug("anonymous login to mail server")
+                smtp.sendmail(self.sender_mail, recipients, message.as_string())
+                smtp.quit()
             logger.info('email sent successfully')
             return True
 
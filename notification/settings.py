@@ -2,6 +2,8 @@ from typing import Optional, Self
 
 from pydantic import BaseModel, Field, SecretStr, model_validator
 
+from app.limits import LimitConfig
+
 
 class MailConfig(BaseModel):
 
@@ -13,6 +15,10 @@ class MailConfig(BaseModel):
         default=587,
         description="SMTP Port"
     )
+    starttls: Optional[bool] = Field(
+        default=True,
+        description="use STARTTLS to encrypt the connection"
+    )
     username: Optional[str] = Field(
         default=None,
         description="SMTP Username"
@@ -45,6 +51,10 @@ class MailConfig(BaseModel):
         default=None,
         description="Content of confirmation mail, supports column name substitution"
     )
+    limits: LimitConfig = Field(
+        default=LimitConfig(),
+        description="adaptive concurrency and circuit breaker settings for SMTP requests"
+    )
 
     @model_validator(mode='after')
     def check_confirmation_mail_settings(self) -> Self: